@@ -0,0 +1,324 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks of the orchestration overhead of mpirun_nlogo.py, independent of
+NetLogo.  The NetLogo launch (start_nlogo) is replaced by a stub that writes a
+table in NetLogo's format, with a configurable delay and output size.
+Measured are
+
+* planning: parsing synthetic .nlogo files with 10^3 - 10^7 combinations,
+  broadcasting the plan and decoding combinations from their index,
+* orchestration: the overhead per run of a full mpirun_nlogo.py job on the
+  stub, and the rate at which results are written,
+* collection: the time collect_data.py takes to merge the output.
+
+Run it like the real thing, e.g. mpirun -np 4 python bench_nlogo.py.  The
+results are appended as one JSON line, tagged with the git commit, to the
+results file, and compared with the last earlier entry with the same
+settings.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+from mpi4py import MPI
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import mpirun_nlogo
+import collect_data
+from nlogo_io import *
+
+
+def synthetic_model(num_combinations, every_step = False):
+    """
+    Text of a .nlogo file with one experiment giving num_combinations
+    combinations, spread over variables with ten values where possible.
+
+    Parameters
+    ----------
+
+    num_combinations : int
+       Number of combinations of the experiment.
+
+    every_step : bool, optional
+       Set runMetricsEveryStep on the experiment.
+
+    Returns
+    -------
+
+    nlogo_text : str
+    """
+    radices = []
+    n = num_combinations
+    while n > 1 and n % 10 == 0:
+        radices.append(10)
+        n //= 10
+    if n > 1 or len(radices) == 0:
+        radices.append(n)
+    value_sets = ""
+    for var_i, radix in enumerate(radices):
+        if var_i % 2 == 0:
+            value_sets += '    <steppedValueSet variable="var{0}" first="0" step="1" last="{1}"/>\n'.format(var_i, radix - 1)
+        else:
+            value_sets += '    <enumeratedValueSet variable="var{0}">\n'.format(var_i)
+            for val in range(radix):
+                value_sets += '      <value value="{0}"/>\n'.format(val)
+            value_sets += '    </enumeratedValueSet>\n'
+    return """to setup
+end
+to go
+end
+@#$#@#$#@
+GRAPHICS-WINDOW
+@#$#@#$#@
+<experiments>
+  <experiment name="bench" repetitions="1" runMetricsEveryStep="{0}">
+    <setup>setup</setup>
+    <go>go</go>
+    <timeLimit steps="10"/>
+    <metric>count turtles</metric>
+    <enumeratedValueSet variable="constant">
+      <value value="1"/>
+    </enumeratedValueSet>
+{1}  </experiment>
+</experiments>
+@#$#@#$#@
+NetLogo 5.3.1
+""".format("true" if every_step else "false", value_sets)
+
+
+VALUE_RE = re.compile(r'<enumeratedValueSet variable="([^"]*)">((?:<value value="[^"]*"/>)+)</enumeratedValueSet>')
+REPS_RE = re.compile(r'repetitions="(\d+)"')
+
+
+class StubProcess(object):
+    # Stands in for the subprocess.Popen of a NetLogo run that has finished.
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+
+def make_stub(delay, rows, row_bytes):
+    """
+    A replacement for mpirun_nlogo.start_nlogo writing a NetLogo table.  The
+    stub runs in the calling process, so runs of several --slots do not
+    overlap.
+
+    Parameters
+    ----------
+
+    delay : float
+       Seconds each run takes, so an invocation running a batch of runs
+       sleeps for all of them.
+
+    rows : int
+       Number of table rows per run (steps, as with runMetricsEveryStep).
+
+    row_bytes : int
+       Approximate size of each row.
+    """
+    def stub_start_nlogo(java, nlogo_path, model_file, setup_file, output_file, threads = None, xmx = 2048, err_file = None):
+        with open(setup_file) as setupf:
+            setup_xml = setupf.read()
+        value_sets = [(name, re.findall(r'value="([^"]*)"', values)) \
+                          for name, values in VALUE_RE.findall(setup_xml.replace("\n", ""))]
+        reps = int(REPS_RE.search(setup_xml).group(1))
+        if delay > 0:
+            time.sleep(delay * reps * numCombinations(value_sets))
+        padding = "x" * max(0, row_bytes - 40)
+        out = ['"BehaviorSpace results (stub)"\n', '"{0}"\n'.format(model_file), '"bench"\n', '"date"\n',
+               '"min-pxcor","max-pxcor","min-pycor","max-pycor"\n', '"-16","16","-16","16"\n',
+               ",".join(['"[run number]"'] + ['"' + name + '"' for name, values in value_sets] + \
+                            ['"[step]"', '"count turtles"', '"padding"']) + "\n"]
+        run_number = 0
+        for combination in expandValueSets(value_sets):
+            for rep in range(reps):
+                run_number += 1
+                for step in range(rows):
+                    out.append(",".join(['"' + str(run_number) + '"'] + ['"' + val + '"' for name, val in combination] + \
+                                            ['"' + str(step) + '"', '"' + str(run_number * step) + '"', '"' + padding + '"']) + "\n")
+        with open(output_file, "w") as fout:
+            fout.write("".join(out))
+        return StubProcess(0)
+    return stub_start_nlogo
+
+
+def bench_plan(comm, sizes, decode_samples):
+    # Time to parse and plan, broadcast the plan and decode combinations.
+    results = []
+    for size in sizes:
+        comm.Barrier()
+        start = time.time()
+        plan = None
+        if comm.Get_rank() == 0:
+            plan = experimentPlan(experimentsXML(synthetic_model(size)))
+        plan_time = time.time() - start
+        start = time.time()
+        plan = comm.bcast(plan, root = 0)
+        bcast_time = time.time() - start
+        value_tuples = plan[0]["value_tuples"]
+        num_runs = plan[0]["num_runs"]
+        stride = max(1, num_runs // decode_samples)
+        start = time.time()
+        decoded = 0
+        for exp_i in range(comm.Get_rank(), num_runs, stride):
+            combinationAt(value_tuples, exp_i)
+            decoded += 1
+        decode_time = time.time() - start
+        results.append({"combinations" : size,
+                        "plan_s" : comm.bcast(plan_time, root = 0),
+                        "bcast_s" : comm.allreduce(bcast_time, op = MPI.MAX),
+                        "decode_us" : 1e6 * comm.allreduce(decode_time, op = MPI.MAX) / max(1, decoded)})
+    return results
+
+
+def bench_run(comm, argument_ns, work_dir):
+    # A full job on the stub, then the merge.
+    model_file = os.path.join(work_dir, "bench.nlogo")
+    output_dir = os.path.join(work_dir, "output")
+    if comm.Get_rank() == 0:
+        os.mkdir(output_dir)
+        with open(model_file, "w") as fout:
+            fout.write(synthetic_model(argument_ns.run_combinations, argument_ns.stub_rows > 1))
+    comm.Barrier()
+
+    mpirun_nlogo.start_nlogo = make_stub(argument_ns.stub_delay, argument_ns.stub_rows, argument_ns.stub_row_bytes)
+    sys.argv = ["mpirun_nlogo.py", "--all_experiments", "--backend", "mpi", "--output_dir", output_dir] + \
+        argument_ns.mpirun_nlogo_args.split() + [model_file]
+    if argument_ns.stub_rows > 1 and "--all_rows" not in sys.argv:
+        sys.argv.insert(1, "--all_rows")
+    comm.Barrier()
+    start = time.time()
+    mpirun_nlogo.main()
+    comm.Barrier()
+    run_time = time.time() - start
+
+    result = {"run_combinations" : argument_ns.run_combinations,
+              "run_s" : run_time}
+    if comm.Get_rank() == 0:
+        output_bytes = sum([os.path.getsize(os.path.join(output_dir, fname)) for fname in os.listdir(output_dir)])
+        stub_time = argument_ns.stub_delay * argument_ns.run_combinations / comm.Get_size()
+        result["overhead_ms_per_run"] = 1e3 * (run_time - stub_time) * comm.Get_size() / argument_ns.run_combinations
+        result["runs_per_s"] = argument_ns.run_combinations / run_time
+        result["output_mb"] = output_bytes / 1e6
+        result["output_mb_per_s"] = output_bytes / 1e6 / run_time
+        merge_dir = os.path.join(work_dir, "merged")
+        os.mkdir(merge_dir)
+        start = time.time()
+        collect_data.collect(output_dir, merge_dir, argument_ns.collect_processes)
+        result["collect_s"] = time.time() - start
+        result["collect_mb_per_s"] = output_bytes / 1e6 / result["collect_s"]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       universal_newlines = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(entry, results_file):
+    # Find the last earlier entry with the same settings and show the change.
+    previous = None
+    if os.path.isfile(results_file):
+        with open(results_file) as fin:
+            for line in fin:
+                old = json.loads(line)
+                if old.get("settings") == entry["settings"]:
+                    previous = old
+    if previous == None:
+        return "No earlier results with the same settings in '{0}'.\n".format(results_file)
+    text = "Compared with commit {0}:\n".format(previous["commit"])
+    for key in sorted(entry["run"]):
+        if key in previous["run"] and previous["run"][key] != 0:
+            text += "  {0:<22} {1:>12.4g} -> {2:<12.4g} ({3:+.1f}%)\n".format(key, previous["run"][key], entry["run"][key],
+                                                                           100.0 * (entry["run"][key] / previous["run"][key] - 1))
+    for old_plan, new_plan in zip(previous["plan"], entry["plan"]):
+        for key in ["plan_s", "decode_us"]:
+            text += "  {0:<12} {1:>9} {2:>12.4g} -> {3:<12.4g}\n".format(key, new_plan["combinations"], old_plan[key], new_plan[key])
+    return text
+
+
+def main():
+    comm = MPI.COMM_WORLD
+    aparser = argparse.ArgumentParser(description = "Benchmark the orchestration overhead of mpirun_nlogo.py with a stub NetLogo.")
+    aparser.add_argument("--plan_sizes", default = "1000,10000,100000,1000000,10000000", help = "Comma separated numbers of combinations of the synthetic models used for the planning benchmark.")
+    aparser.add_argument("--decode_samples", type = int, default = 100000, help = "Number of combinations decoded per planning size.")
+    aparser.add_argument("--run_combinations", type = int, default = 2000, help = "Number of combinations run through the stub in the orchestration benchmark.")
+    aparser.add_argument("--stub_delay", type = float, default = 0.0, help = "Seconds each stub NetLogo run takes.")
+    aparser.add_argument("--stub_rows", type = int, default = 1, help = "Table rows written by each stub run. More than one implies --all_rows.")
+    aparser.add_argument("--stub_row_bytes", type = int, default = 64, help = "Approximate size of each table row written by the stub.")
+    aparser.add_argument("--mpirun_nlogo_args", default = "", help = "Extra options for mpirun_nlogo.py, e.g. \"--schedule dynamic --batch_size 10\".")
+    aparser.add_argument("--collect_processes", type = int, default = 1, help = "--processes given to the collect_data.py merge.")
+    aparser.add_argument("--work_dir", default = None, help = "Directory for the temporary files. Defaults to a new directory in $TMPDIR.")
+    aparser.add_argument("--results", default = "bench_results.jsonl", help = "File the results are appended to.")
+    argument_ns = aparser.parse_args()
+
+    work_dir = None
+    if comm.Get_rank() == 0:
+        work_dir = tempfile.mkdtemp(prefix = "bench_nlogo_", dir = argument_ns.work_dir)
+    work_dir = comm.bcast(work_dir, root = 0)
+
+    try:
+        sizes = [int(size) for size in argument_ns.plan_sizes.split(",") if size != ""]
+        plan_results = bench_plan(comm, sizes, argument_ns.decode_samples)
+        run_result = bench_run(comm, argument_ns, work_dir)
+    finally:
+        comm.Barrier()
+        if comm.Get_rank() == 0:
+            shutil.rmtree(work_dir, True)
+
+    if comm.Get_rank() == 0:
+        settings = dict(vars(argument_ns))
+        for key in ["results", "work_dir"]:
+            del settings[key]
+        settings["np"] = comm.Get_size()
+        entry = {"commit" : git_commit(),
+                 "date" : time.strftime("%Y-%m-%d %H:%M:%S"),
+                 "settings" : settings,
+                 "plan" : plan_results,
+                 "run" : run_result}
+        sys.stdout.write("{0:>12} {1:>10} {2:>10} {3:>12}\n".format("combinations", "plan [s]", "bcast [s]", "decode [us]"))
+        for res in plan_results:
+            sys.stdout.write("{0:>12} {1:>10.3f} {2:>10.4f} {3:>12.2f}\n".format(res["combinations"], res["plan_s"],
+                                                                              res["bcast_s"], res["decode_us"]))
+        for key in sorted(run_result):
+            sys.stdout.write("{0:<22} {1:.4g}\n".format(key, run_result[key]))
+        sys.stdout.write(compare(entry, argument_ns.results))
+        with open(argument_ns.results, "a") as fout:
+            fout.write(json.dumps(entry) + "\n")
+
+
+if __name__ == "__main__":
+    main()
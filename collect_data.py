@@ -1,36 +1,598 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collects the per process proc*.csv files written by mpirun_nlogo.py into one
+bs_NNN.csv file per experiment, sorted by run number (and repetition, for
+split repetitions) and headed by the experiment's line from headers.dat.
+Experiments are numbered in the order of their names.
+
+The rows are never all held in memory.  Every input file is split into the
+stretches that are already sorted (normally one per experiment) and these
+are merged with a k-way merge, one experiment at a time.
+
+Compressed output (--output_format csv.gz) is read one gzip block at a time,
+only the blocks complete in the index procNNNN.csv.gz.idx, and collected
+into the same bs_NNN.csv files.  --lookup EXPERIMENT RUN_NUMBER instead
+prints the rows of a single run, decompressing only the blocks the index
+gives for it.
+
+Output written with --output_format npz or parquet is collected into one
+bs_NNN.npz or bs_NNN.parquet file per experiment in the same way, sorted by
+run_number and taking a run written twice from the first file.  These are
+columnar, so each experiment is loaded whole.  Part files whose
+combinations are not all in the completion journals (procNNNN.done), left
+by a killed job, are skipped; a restart runs those combinations again.  A
+column that is numeric in some parts and text in others is collected as
+text.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import os
+import re
+import sys
 import glob
+import zlib
+import heapq
+import bisect
+import struct
+import argparse
+import tempfile
+import multiprocessing
+
+# Most segment files kept open at the same time by a merge.
+MAX_OPEN = 64
+
+
+def line_key(line, rep_experiments = ()):
+    # Rows are experiment,run_number,values... or, for the experiments in
+    # rep_experiments, experiment,run_number,rep,values...
+    parts = line.split(b",", 3)
+    try:
+        run = int(parts[1])
+    except (IndexError, ValueError):
+        run = -1
+    if parts[0] not in rep_experiments:
+        return (parts[0] + b",", run)
+    try:
+        rep = int(parts[2])
+    except (IndexError, ValueError):
+        rep = -1
+    return (parts[0] + b",", run, rep)
+
+
+def read_index(fname):
+    """
+    Read the index of a compressed csv file, fname.idx.  Lines cut short and
+    blocks with fewer lines than their number of runs, left by a killed job,
+    are skipped.
+
+    Returns
+    -------
+
+    index : list
+       List of (offset, length, runs) tuples of the complete blocks, in the
+       order they were written, where runs is a list of the
+       (experiment, run_number) of the rows of the block.
+    """
+    blocks = {}
+    order = []
+    try:
+        with open(fname + ".idx", "rb") as fin:
+            for line in fin:
+                fields = line.rstrip(b"\n").rsplit(b",", 4)
+                if not line.endswith(b"\n") or len(fields) != 5:
+                    continue
+                try:
+                    (run, offset, length, num_runs) = [int(field) for field in fields[1:]]
+                except ValueError:
+                    continue
+                if (offset, length) not in blocks:
+                    blocks[(offset, length)] = (num_runs, [])
+                    order.append((offset, length))
+                blocks[(offset, length)][1].append((fields[0], run))
+    except IOError:
+        return []
+    return [(offset, length, blocks[(offset, length)][1]) for offset, length in order \
+                if len(blocks[(offset, length)][1]) == blocks[(offset, length)][0]]
+
+
+def read_blocks(fname, blocks):
+    # The decompressed blocks, (offset, length, ...) tuples, of a compressed
+    # csv file, one after the other.
+    with open(fname, "rb") as fin:
+        for block in blocks:
+            fin.seek(block[0])
+            yield zlib.decompress(fin.read(block[1]), 16 + zlib.MAX_WBITS)
+
+
+def sorted_segments(fname, rep_experiments = ()):
+    """
+    Split a file into stretches of lines that are sorted and belong to a
+    single experiment.
+
+    Parameters
+    ----------
+
+    fname : str
+       Name of the file, a compressed csv file if it ends with .gz.
+
+    rep_experiments : set, optional
+       Experiments whose rows have a rep column, which are sorted by run
+       number and repetition.
+
+    Returns
+    -------
+
+    segments : list
+       List of (experiment, fname, start, end, blocks) tuples, where start
+       and end are byte offsets in the file or, for a compressed file, in
+       its decompressed blocks, given by blocks as a list of (start, offset,
+       length) tuples. blocks is None for an uncompressed file.
+    """
+    segments = []
+    start = 0
+    offset = 0
+    prev_key = None
+    if fname.endswith(".gz"):
+        index = read_index(fname)
+        blocks = []
+        def lines():
+            for (block_offset, length, runs), data in zip(index, read_blocks(fname, index)):
+                blocks.append((offset, block_offset, length))
+                for line in data.splitlines(True):
+                    yield line
+    else:
+        blocks = None
+        def lines():
+            with open(fname, "rb") as fin:
+                for line in iter(fin.readline, b""):
+                    yield line
+    for line in lines():
+        key = line_key(line, rep_experiments)
+        if prev_key != None and (key[0] != prev_key[0] or key < prev_key):
+            segments.append((prev_key[0][:-1], fname, start, offset, blocks))
+            start = offset
+        prev_key = key
+        offset += len(line)
+    if prev_key != None:
+        segments.append((prev_key[0][:-1], fname, start, offset, blocks))
+    return segments
+
+
+def read_segment(segment):
+    (experiment, fname, start, end, blocks) = segment
+    if blocks != None:
+        # Start with the block holding start.
+        block_i = bisect.bisect_right([block[0] for block in blocks], start) - 1
+        pos = blocks[block_i][0]
+        for data in read_blocks(fname, [block[1:] for block in blocks[block_i:]]):
+            for line in data.splitlines(True):
+                if pos >= end:
+                    return
+                if pos >= start:
+                    yield line if line.endswith(b"\n") else line + b"\n"
+                pos += len(line)
+        return
+    with open(fname, "rb") as fin:
+        fin.seek(start)
+        pos = start
+        while pos < end:
+            line = fin.readline()
+            if line == b"":
+                break
+            pos += len(line)
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            yield line
+
+
+def keyed_lines(segment, seg_i, rep_experiments = ()):
+    # Rows of the same run (all steps with --all_rows) keep their order.
+    for line_i, line in enumerate(read_segment(segment)):
+        yield (line_key(line, rep_experiments) + (seg_i, line_i), line)
+
+
+def unique_runs(keyed):
+    # The rows of a run come from one segment. A run that is in several,
+    # written again by a job restarted after it was killed, is taken from
+    # the first.
+    owner = None
+    for key, line in keyed:
+        if owner == None or owner[0] != key[:-2]:
+            owner = (key[:-2], key[-2])
+        elif owner[1] != key[-2]:
+            continue
+        yield (key, line)
+
+
+def merge_segments(segments, tmp_dir, rep_experiments = ()):
+    """
+    k-way merge of sorted segments.  If there are more segments than can be
+    kept open they are first merged in groups into temporary files.  Runs
+    found in more than one segment are only taken once.
+
+    Parameters
+    ----------
+
+    segments : list
+       Segments as given by sorted_segments.
+
+    tmp_dir : str
+       Directory for the intermediate files.
+
+    rep_experiments : set, optional
+       Experiments whose rows have a rep column, see sorted_segments.
+
+    Yields
+    ------
+       : The lines of all segments in sorted order.
+    """
+    tmp_files = []
+    try:
+        while len(segments) > MAX_OPEN:
+            merged = []
+            for i in range(0, len(segments), MAX_OPEN):
+                group = segments[i:i + MAX_OPEN]
+                (fd, tmp_name) = tempfile.mkstemp(prefix = "collect_", suffix = ".csv", dir = tmp_dir)
+                tmp_files.append(tmp_name)
+                with os.fdopen(fd, "wb") as fout:
+                    for key, line in unique_runs(heapq.merge(*[keyed_lines(seg, seg_i, rep_experiments) for seg_i, seg in enumerate(group)])):
+                        fout.write(line)
+                merged.append((group[0][0], tmp_name, 0, os.path.getsize(tmp_name), None))
+            segments = merged
+        for key, line in unique_runs(heapq.merge(*[keyed_lines(seg, seg_i, rep_experiments) for seg_i, seg in enumerate(segments)])):
+            yield line
+    finally:
+        for tmp_name in tmp_files:
+            os.remove(tmp_name)
+
+
+def write_experiment(args):
+    (out_name, header, segments, tmp_dir, rep_experiments) = args
+    with open(out_name, "wb") as fout:
+        if header != None:
+            fout.write(header)
+        for line in merge_segments(segments, tmp_dir, rep_experiments):
+            fout.write(line)
+    return out_name
+
+
+def collect(input_dir = ".", output_dir = ".", processes = 1, compressed = False):
+    """
+    Merge the proc*.csv files in input_dir into bs_NNN.csv files.
+
+    Parameters
+    ----------
+
+    input_dir : str, optional
+       Directory with the proc*.csv files and headers.dat.
+
+    output_dir : str, optional
+       Directory the bs_NNN.csv files are written to.
+
+    processes : int, optional
+       Number of experiments merged in parallel.
+
+    compressed : bool, optional
+       Merge the compressed proc*.csv.gz files instead.
+
+    Returns
+    -------
+
+    out_names : list
+       Names of the files written.
+    """
+    data_files = csv_files(input_dir, compressed)
+    headers = read_headers(input_dir)
+    # Experiments with split repetitions have a rep column.
+    rep_experiments = set([name for name, header in headers.items() \
+                               if header.startswith(name + b",run_number,rep,")])
+
+    by_experiment = {}
+    for fname in data_files:
+        for segment in sorted_segments(fname, rep_experiments):
+            by_experiment.setdefault(segment[0], []).append(segment)
+
+    # Experiments are numbered in the order of their names.
+    experiments = sorted(by_experiment.keys(), key = lambda name: name + b",")
+    jobs = []
+    for bsnum, experiment in enumerate(experiments):
+        out_name = os.path.join(output_dir, "bs_" + str(bsnum).zfill(3) + ".csv")
+        jobs.append((out_name, headers.get(experiment), by_experiment[experiment], output_dir, rep_experiments))
+
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            out_names = pool.map(write_experiment, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        out_names = [write_experiment(job) for job in jobs]
+    return out_names
+
+
+def csv_files(input_dir, compressed = False):
+    # procNNNN.csv, or procNNNN.csv.gz, but not the failure tables.
+    pattern = r"^proc\d+\.csv\.gz$" if compressed else r"^proc\d+\.csv$"
+    return sorted([fname for fname in glob.glob(os.path.join(input_dir, "proc*.csv*")) \
+                       if re.match(pattern, os.path.basename(fname))])
+
+
+def read_headers(input_dir):
+    # The header line of every experiment in headers.dat, by experiment.
+    headers = {}
+    hdr_filename = os.path.join(input_dir, "headers.dat")
+    if os.path.isfile(hdr_filename):
+        with open(hdr_filename, "rb") as fin:
+            for header in fin:
+                headers.setdefault(header.partition(b",")[0], header)
+    return headers
+
+
+def lookup(input_dir, experiment, run_number):
+    """
+    Find the rows of one run.  Of compressed files only the blocks that the
+    index gives for the run are read, uncompressed files are scanned.  A run
+    written more than once, by a job restarted after it was killed, is taken
+    from the first block or stretch of a file holding it, as by collect.
+
+    Parameters
+    ----------
+
+    input_dir : str
+       Directory with the proc*.csv or proc*.csv.gz files.
+
+    experiment : str
+       Name of the experiment as in the results (spaces are underscores).
+
+    run_number : int
+
+    Returns
+    -------
+
+    lines : list
+       The rows, sorted by repetition if there is a rep column, with the
+       header line of the experiment first if there is one.
+    """
+    if not isinstance(experiment, bytes):
+        experiment = experiment.encode("utf-8")
+    header = read_headers(input_dir).get(experiment)
+    rep_experiments = ()
+    if header != None and header.startswith(experiment + b",run_number,rep,"):
+        rep_experiments = (experiment,)
+    def sources():
+        for fname in csv_files(input_dir, True):
+            blocks = [block for block in read_index(fname) if (experiment, run_number) in block[2]]
+            for data in read_blocks(fname, blocks):
+                yield data.splitlines(True)
+        for fname in csv_files(input_dir, False):
+            with open(fname, "rb") as fin:
+                yield fin
+    # Lines are split into sorted segments as by sorted_segments.
+    keyed = []
+    seg_i = 0
+    for source in sources():
+        prev_key = None
+        for line in source:
+            key = line_key(line, rep_experiments)
+            if prev_key != None and (key[0] != prev_key[0] or key < prev_key):
+                seg_i += 1
+            prev_key = key
+            if key[:2] == (experiment + b",", run_number):
+                keyed.append((key + (seg_i, len(keyed)), line))
+        seg_i += 1
+    keyed.sort()
+    return ([header] if header != None else []) + [line for key, line in unique_runs(keyed)]
+
+
+def read_journals(input_dir):
+    # Bitmap of the global ids in the completion journals procNNNN.done.
+    ids = []
+    for fname in glob.glob(os.path.join(input_dir, "proc*.done")):
+        with open(fname, "rb") as fin:
+            data = fin.read()
+        count = len(data) // 8
+        ids.extend(struct.unpack("<{0}q".format(count), data[:count * 8]))
+    bitmap = bytearray((max(ids) + 8) // 8 if len(ids) > 0 else 0)
+    for global_id in ids:
+        bitmap[global_id >> 3] |= 1 << (global_id & 7)
+    return bitmap
+
+
+def journaled(bitmap, global_ids):
+    for global_id in global_ids:
+        if global_id >> 3 >= len(bitmap) or not bitmap[global_id >> 3] & (1 << (global_id & 7)):
+            return False
+    return True
+
+
+def columnar_files(input_dir, output_format):
+    # Files are named procNNNN_<experiment>_partNNNNN.npz (or .parquet).
+    pattern = re.compile(r"^proc\d+_(.*)_part\d+\." + output_format + "$")
+    by_experiment = {}
+    for fname in sorted(glob.glob(os.path.join(input_dir, "proc*." + output_format))):
+        match = pattern.match(os.path.basename(fname))
+        if match != None:
+            by_experiment.setdefault(match.group(1), []).append(fname)
+    return by_experiment
+
+
+def unique_run_order(numpy, parts, keys):
+    # Row order sorted by the key columns (run_number, then rep if there is
+    # one), with a run that is in several parts, written again by a job
+    # restarted after it was killed, taken from the first, as unique_runs
+    # does for csv.
+    order = numpy.lexsort([parts] + keys[::-1])
+    starts = numpy.zeros(len(order), dtype = bool)
+    starts[0] = True
+    for key in keys:
+        key = key[order]
+        starts[1:] |= key[1:] != key[:-1]
+    owner = parts[order][numpy.maximum.accumulate(numpy.where(starts, numpy.arange(len(order)), 0))]
+    return order[parts[order] == owner]
+
+
+def write_columnar_experiment(args):
+    (out_name, fnames, output_format, done) = args
+    if output_format == "npz":
+        import numpy
+        columns = None
+        parts = []
+        for fname in fnames:
+            with numpy.load(fname) as npz:
+                if "global_ids" not in npz.files or not journaled(done, npz["global_ids"].tolist()):
+                    sys.stderr.write("Warning - Skipping '{0}', its runs are not journaled.\n".format(fname))
+                    continue
+                columns = list(npz["columns"])
+                parts.append([npz["c" + str(i)] for i in range(len(columns))])
+        if len(parts) == 0:
+            return None
+        part_nos = numpy.concatenate([numpy.full(len(part[0]), part_i, dtype = numpy.int64) for part_i, part in enumerate(parts)])
+        arrays = []
+        for i in range(len(columns)):
+            # Text if any part has text.
+            if any([part[i].dtype.kind in "USO" for part in parts]):
+                arrays.append(numpy.concatenate([part[i].astype(str) for part in parts]))
+            else:
+                arrays.append(numpy.concatenate([part[i] for part in parts]))
+        order = unique_run_order(numpy, part_nos, arrays[:2] if columns[1:2] == ["rep"] else arrays[:1])
+        numpy.savez(out_name, columns = numpy.array(columns),
+                    **dict([("c" + str(i), arr[order]) for i, arr in enumerate(arrays)]))
+    else:
+        import numpy
+        import pyarrow
+        import pyarrow.parquet
+        tables = []
+        for fname in fnames:
+            table = pyarrow.parquet.read_table(fname)
+            metadata = table.schema.metadata or {}
+            if b"global_ids" not in metadata or \
+                    not journaled(done, [int(global_id) for global_id in metadata[b"global_ids"].split(b",") if global_id != b""]):
+                sys.stderr.write("Warning - Skipping '{0}', its runs are not journaled.\n".format(fname))
+                continue
+            tables.append(table.replace_schema_metadata(None))
+        if len(tables) == 0:
+            return None
+        # Text if any part has text.
+        for name in tables[0].column_names:
+            if len(set([str(table.schema.field(name).type) for table in tables])) > 1:
+                tables = [table.set_column(table.column_names.index(name), name, table.column(name).cast(pyarrow.string())) \
+                              for table in tables]
+        part_nos = numpy.concatenate([numpy.full(table.num_rows, part_i, dtype = numpy.int64) for part_i, table in enumerate(tables)])
+        table = pyarrow.concat_tables(tables)
+        keys = [table.column(name).to_numpy() for name in ["run_number", "rep"] if name in table.column_names]
+        table = table.take(pyarrow.array(unique_run_order(numpy, part_nos, keys)))
+        pyarrow.parquet.write_table(table, out_name)
+    return out_name
+
+
+def collect_columnar(input_dir = ".", output_dir = ".", output_format = "npz", processes = 1):
+    """
+    Merge the columnar procNNNN_<experiment> files in input_dir into one
+    bs_NNN file per experiment.
+
+    Parameters
+    ----------
+
+    input_dir : str, optional
+       Directory with the files written by mpirun_nlogo.py.
+
+    output_dir : str, optional
+       Directory the bs_NNN files are written to.
+
+    output_format : str, optional
+       npz or parquet.
+
+    processes : int, optional
+       Number of experiments merged in parallel.
+
+    Returns
+    -------
+
+    out_names : list
+       Names of the files written.
+    """
+    by_experiment = columnar_files(input_dir, output_format)
+    done = read_journals(input_dir)
+    jobs = []
+    for bsnum, experiment in enumerate(sorted(by_experiment.keys(), key = lambda name: name + ",")):
+        out_name = os.path.join(output_dir, "bs_" + str(bsnum).zfill(3) + "." + output_format)
+        jobs.append((out_name, by_experiment[experiment], output_format, done))
+
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            out_names = pool.map(write_columnar_experiment, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        out_names = [write_columnar_experiment(job) for job in jobs]
+    return [out_name for out_name in out_names if out_name != None]
+
+
+
+def collect_failures(input_dir = ".", output_dir = "."):
+    """
+    Merge the failure tables procNNNN.failed.csv of the runs that failed for
+    good into failures.csv, sorted by experiment and run number.
+
+    Returns
+    -------
+
+    out_name : str
+       Name of the file written, or None if no run failed.
+    """
+    header = None
+    rows = []
+    for fname in sorted(glob.glob(os.path.join(input_dir, "proc*.failed.csv"))):
+        with open(fname, "rb") as fin:
+            header = fin.readline()
+            rows.extend(fin.readlines())
+    if header == None:
+        return None
+    out_name = os.path.join(output_dir, "failures.csv")
+    with open(out_name, "wb") as fout:
+        fout.write(header)
+        for row in sorted(rows, key = lambda row: row.split(b",", 2)[:2]):
+            fout.write(row)
+    return out_name
+
 
-data_files = glob.glob("./proc*.csv")
-data_files.sort()
-
-all_lines = [];
-for fname in data_files:
-    with open(fname, "r") as fin:
-        all_lines += fin.readlines()
-all_lines.sort()
-
-with open("headers.dat", "r") as fin:
-    headers = fin.readlines()
-
-for header in headers:
-    header_exp = header.partition(",")[0]
-    for i in range(len(all_lines)):
-        line_exp = all_lines[i].partition(",")[0]
-        if header_exp == line_exp:
-            all_lines.insert(i, header)
-            break 
-
-bsnum = 0
-bsexp = all_lines[0].partition(",")[0]
-fout = open("bs_000.csv", "w")
-for line in all_lines:
-    lineexp = line.partition(",")[0]
-    if lineexp == bsexp:
-        fout.write(line)
+if __name__ == "__main__":
+    aparser = argparse.ArgumentParser(description = "Collect the output of mpirun_nlogo.py into one csv file per experiment.")
+    aparser.add_argument("--input_dir", default = "./", help = "Directory with the proc*.csv and headers.dat files.")
+    aparser.add_argument("--output_dir", default = "./", help = "Directory to write the bs_NNN.csv files to.")
+    aparser.add_argument("--processes", type = int, default = 1, help = "Merge this many experiments in parallel.")
+    aparser.add_argument("--format", choices = ["csv", "csv.gz", "npz", "parquet"], default = "csv", help = "The --output_format the results were written with.")
+    aparser.add_argument("--lookup", nargs = 2, metavar = ("EXPERIMENT", "RUN_NUMBER"), help = "Print the rows of one run (with the header of the experiment) instead of collecting. Compressed csv.gz results are read through their index, plain csv files are scanned.")
+    argument_ns = aparser.parse_args()
+    if argument_ns.lookup != None:
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        for line in lookup(argument_ns.input_dir, argument_ns.lookup[0], int(argument_ns.lookup[1])):
+            out.write(line)
+        sys.exit(0)
+    if argument_ns.format in ["csv", "csv.gz"]:
+        collect(argument_ns.input_dir, argument_ns.output_dir, argument_ns.processes, argument_ns.format == "csv.gz")
     else:
-        fout.close()
-        bsnum += 1
-        bsexp = lineexp
-        fout = open("bs_" + str(bsnum).zfill(3) + ".csv", "w")
-        fout.write(line)
-fout.close()
+        collect_columnar(argument_ns.input_dir, argument_ns.output_dir, argument_ns.format, argument_ns.processes)
+    collect_failures(argument_ns.input_dir, argument_ns.output_dir)
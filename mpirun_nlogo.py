@@ -31,20 +31,34 @@ __license__ = "GPL3"
 
 __version__ = "0.3"
 
-from mpi4py import MPI
-import string
 import sys
 import os
+import re
+import glob
 import argparse
+import atexit
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+import subprocess
+import time
 from xml.dom import minidom
 import csv
 from nlogo_io import *
+from nlogo_sample import SAMPLING_METHODS
+from nlogo_worker import NetLogoWorker
+from nlogo_sched import *
+from nlogo_results import *
+from nlogo_trace import Tracer, summarize
+from nlogo_cost import CostModel, learn_cost_model
+from nlogo_cache import *
+from nlogo_comm import *
+from nlogo_stage import stage_files
+from nlogo_supervise import *
+from nlogo_stats import StudyStats, StatsJournal, DEFAULT_QUANTILES, load_checkpoints, reduce_stats, write_summary
                 
 def main():    
-    comm = MPI.COMM_WORLD
-    mpi_size = comm.Get_size()
-    mpi_rank = comm.Get_rank()
-
     experiments_to_expand = []
     
     aparser = argparse.ArgumentParser(description = "MPI run nlogo behavioral space experiments.")
@@ -53,6 +67,9 @@ def main():
     aparser.add_argument("--all_experiments", action="store_true", help = "If set all experiments in the .nlogo file will be expanded.")
     aparser.add_argument("--repetitions_per_run", type=int, nargs = 1, help="Number of repetitions per generated experiment run. If the nlogo file is set to repeat an experiment N times, these will be split into N/n individual experiment runs (each repeating n times), where n is the argument given to this switch. Note that if n does not divide N this operation will result in a lower number of total repetitions.")
     aparser.add_argument("--output_dir", default="./", help = "Path to output directory if not current directory.")
+    aparser.add_argument("--scratch_dir", default=os.environ.get("TMPDIR", "/dev/shm" if os.path.isdir("/dev/shm") else None), help = "Node local directory for the temporary setup and table files of the individual runs. Defaults to $TMPDIR or /dev/shm. Each process uses its own subdirectory, which is removed on exit. Only the aggregated results are written to the output directory.")
+    aparser.add_argument("--stage", action="store_true", help="Copy the model and NetLogo (the jar, its libraries and extensions) to --scratch_dir on every node at startup and run from the copies. Rank 0 reads them once and broadcasts them to one process per node, instead of every NetLogo run loading them from the shared file system.")
+    aparser.add_argument("--stage_files", action="append", metavar="PATTERN", help="With --stage, glob pattern relative to the directory of the model of further files or directories to stage with it, may be repeated, such as data files the model reads with file-open, import-world or an extension. \"*\" stages the whole directory.")
     aparser.add_argument("--output_prefix", default="", help = "Generated files are named after the experiment, if set, the value given for this option will be prefixed to that name.")
     # Scripting options.
     aparser.add_argument("--create_script", dest = "script_template_file", help = "Tell the program to generate script files (for instance PBS files) alongside the xml setup files. A template file must be provided. See the external documentation for more details.")
@@ -64,29 +81,129 @@ def main():
 
     aparser.add_argument("--java", help="Command to launch java.", default="java")
     aparser.add_argument("--nlogo_path", help="Path to the nlogo java file.")
+    aparser.add_argument("--worker", action="store_true", help="Keep one persistent NetLogo worker per process with the model loaded instead of launching java for every run. Requires the jpype module.")
+    aparser.add_argument("--backend", choices=["auto", "mpi", "local"], default="auto", help="How the processes are run. mpi uses the processes started by mpirun. local starts --processes processes on this machine and does not need MPI. auto uses mpi when started by mpirun and local otherwise.")
+    aparser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="Number of processes started by the local backend. Defaults to the number of cores.")
+    aparser.add_argument("--schedule", choices=["static", "dynamic"], default="static", help="How combinations are divided among the MPI processes. static gives every process a fixed stride of the combinations. dynamic lets processes pull chunks of combinations from a shared counter as they finish, which balances experiments with very uneven run times.")
+    aparser.add_argument("--min_chunk", type=int, default=1, help="Smallest number of combinations handed out at once by the dynamic schedule.")
+    aparser.add_argument("--slots", type=int, default=1, help="Number of NetLogo runs each process keeps going at the same time. With one process per node (e.g. mpirun --map-by ppr:1:node) and --slots set to the number of cores, a single Python process drives all runs on a node. Not used with --worker.")
+    aparser.add_argument("--sample", choices=SAMPLING_METHODS, help="Run a sampling design over the value sets instead of all their combinations: lhs (Latin hypercube), sobol, halton or random. steppedValueSets are sampled over their range, enumeratedValueSets pick one of their values. The design is written to design_<experiment>.csv in the output directory.")
+    aparser.add_argument("--samples", type=int, default=1000, help="Number of points of the sampling design of each experiment.")
+    aparser.add_argument("--sample_seed", type=int, default=0, help="Seed of the lhs and random sampling designs.")
+    aparser.add_argument("--seed", type=int, help="Seed the random generator of every run. Each run (repetition of a combination) gets its own seed, this plus its number in the study, so results are reproducible however the runs are distributed.")
+    aparser.add_argument("--timeout", type=float, help="Stop a NetLogo run that takes longer than this many seconds per repetition of a combination (a batch gets the time of all its runs). Not with --worker.")
+    aparser.add_argument("--timeout_factor", type=float, help="Once a few runs of an experiment have succeeded, stop runs that take longer than this multiple of their median time instead. Not with --worker.")
+    aparser.add_argument("--retries", type=int, default=1, help="Number of times a failed or stopped NetLogo run is tried again before it is recorded in procNNNN.failed.csv.")
+    aparser.add_argument("--retry_delay", type=float, default=5.0, help="Seconds before the first retry of a run, doubled for every further retry.")
+    aparser.add_argument("--xmx", type=int, default=2048, help="Java heap size (-Xmx) of NetLogo in MB.")
+    aparser.add_argument("--max_xmx", type=int, default=8192, help="A run that ran out of memory is retried with twice the heap size, up to this many MB.")
+    aparser.add_argument("--batch_size", type=int, default=1, help="Run up to this many combinations in a single NetLogo invocation to spread the JVM startup and model loading over several runs. A batch only varies the last varied variable of the experiment, so the effective batch size is limited by its number of values.")
+    aparser.add_argument("--nlogo_threads", type=int, help="Number of threads NetLogo should use for the runs of a batch (passed on as --threads).")
+    aparser.add_argument("--flush_rows", type=int, default=1000, help="Number of result rows buffered in memory before they are written to the output file, at the end of the combination that reaches it.")
+    aparser.add_argument("--flush_seconds", type=float, default=60.0, help="Longest time in seconds result rows are buffered before they are written to the output file.")
+    aparser.add_argument("--output_format", choices=["csv", "csv.gz"] + COLUMNAR_FORMATS, default="csv", help="Format of the result files. csv writes procNNNN.csv text files. csv.gz writes the same rows to procNNNN.csv.gz in gzip compressed blocks, with an index procNNNN.csv.gz.idx of the block of every experiment and run number, so that collect_data.py --lookup reads single runs without decompressing the rest. npz and parquet write typed columns per experiment (procNNNN_<experiment>...), one column per varied variable and per column of the NetLogo table. npz requires numpy, parquet requires pyarrow.")
+    aparser.add_argument("--all_rows", action="store_true", help="Keep every row of the NetLogo table, for instance every step of experiments that measure runs at every step, instead of only the first row of each run. Rows are tagged with the experiment, run number and step (csv rows are experiment,run_number,step,...). The table is read row by row, so runs with very large tables do not need to fit in memory.")
+    aparser.add_argument("--trace", action="store_true", help="Record the time of each phase of every run (setup writing, NetLogo, result handling) with exit codes and output sizes to procNNNN.trace.json, in the Chrome trace format that chrome://tracing and ui.perfetto.dev can show as a timeline. A summary of busy and idle time per process, load imbalance and runs per second is printed at the end.")
+    aparser.add_argument("--cost_expr", help="Expression over the variables of the experiments estimating the run time of a combination, e.g. \"initial_number_sheep * max_steps\". Characters not allowed in Python names are written as underscores. The most expensive combinations are run first, and the static schedule balances the estimated cost across the processes.")
+    aparser.add_argument("--cost_traces", help="Glob pattern of trace files (procNNNN.trace.json, see --trace) of an earlier job of the same experiments. The run time of each combination is estimated from the effects of the values of its variables on the recorded NetLogo times and used like --cost_expr.")
+    aparser.add_argument("--cache_dir", help="Directory of a cache of NetLogo results shared by all processes (and jobs). Before a combination is run the cache is checked for a result of the same model file, NetLogo version, parameter values, repetitions and seed, and if one is found it is used instead of running NetLogo. New results are added to the cache.")
+    aparser.add_argument("--cache_size", type=float, default=10240.0, help="Size limit of the cache in MB. The least recently used results are evicted when it is exceeded.")
+    aparser.add_argument("--summarize", action="store_true", help="Keep the count, mean, variance, minimum, maximum and quantiles of every reporter of every combination over its repetitions as the runs finish, and write them to summary_<experiment>.csv in the output directory at the end, one row per combination (and step, with --all_rows) and reporter. Without --all_rows the last row of every repetition is used. The statistics of the processes are combined with an MPI reduction, so no pass over the raw results is needed. Not with --node_writer.")
+    aparser.add_argument("--summary_only", action="store_true", help="With --summarize, only write the summary tables and not the result rows of the runs.")
+    aparser.add_argument("--summary_quantiles", type=float, nargs="+", default=DEFAULT_QUANTILES, help="Quantiles of the summary tables, between 0 and 1. The quantiles are exact up to 128 repetitions and estimated from a sketch of the values beyond that.")
+    aparser.add_argument("--node_writer", action="store_true", help="Send the result rows of all processes on a node to one writer process, so there is only one output file per node. Only used with the csv and csv.gz output formats.")
     argument_ns = aparser.parse_args()
 
     # Check so that there's either experiments listed, or the all_experiments switch is set.
     if len(argument_ns.experiment) < 1 and argument_ns.all_experiments == False:
         print("Warning. You must either list one or more experiments to expand, or use the --all_experiments switch.")
         exit(0)
+    if argument_ns.summarize and argument_ns.node_writer:
+        sys.stderr.write("--summarize cannot be used with --node_writer.\n")
+        exit(1)
+    if argument_ns.summary_only:
+        argument_ns.summarize = True
+    if argument_ns.worker and (argument_ns.timeout != None or argument_ns.timeout_factor != None):
+        sys.stderr.write("--timeout and --timeout_factor cannot be used with --worker.\n")
+        exit(1)
+
+    if choose_backend(argument_ns.backend) == "local":
+        exit(run_local(run_study, max(1, argument_ns.processes), (argument_ns,)))
+    else:
+        run_mpi(run_study, (argument_ns,))
 
-    experiments_xml = ""
-    try:
-        with open(argument_ns.nlogo_file) as nlogof:
-            # An .nlogo file contain a lot of non-xml data
-            # this is a hack to ignore those lines and
-            # read the experiments data into an xml string
-            # that can be parsed.
-            nlogo_text = nlogof.read()
-            alist = nlogo_text.split("<experiments>")
-            for elem in alist[1:]:
-                blist = elem.split("</experiments>")
-                experiments_xml += "<experiments>{0}</experiments>\n".format(blist[0])
-    except IOError as ioe:
-        sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
-        exit(ioe.errno)
+def run_study(comm, argument_ns):
+    # Run the study as one of the processes of comm.
+    mpi_size = comm.Get_size()
+    mpi_rank = comm.Get_rank()
 
+    if argument_ns.trace:
+        tracer = Tracer(os.path.join(argument_ns.output_dir, "proc" + str(mpi_rank).zfill(4) + ".trace.json"), mpi_rank)
+    else:
+        tracer = Tracer(None, mpi_rank)
+
+    # Only rank 0 reads and parses the model file. Everything the other
+    # processes need is in the plan, which is broadcast to them.
+    plan = None
+    error = 0
+    if mpi_rank == 0:
+        with tracer.phase("plan"):
+            try:
+                with open(argument_ns.nlogo_file) as nlogof:
+                    experiments_xml = experimentsXML(nlogof.read())
+                if argument_ns.all_experiments == True:
+                    selected = None
+                else:
+                    selected = argument_ns.experiment
+                reps_per_run = None
+                if argument_ns.repetitions_per_run != None:
+                    reps_per_run = argument_ns.repetitions_per_run[0]
+                sampling = None
+                if argument_ns.sample != None:
+                    sampling = {"method" : argument_ns.sample, "samples" : argument_ns.samples, "seed" : argument_ns.sample_seed}
+                plan = experimentPlan(experiments_xml, selected, reps_per_run, sampling)
+            except IOError as ioe:
+                sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
+                error = ioe.errno
+            except ValueError as ve:
+                sys.stderr.write(str(ve) + "\n")
+                error = 1
+    (plan, error) = comm.bcast((plan, error), root = 0)
+    if error != 0:
+        exit(error)
+
+    # Cost estimates. Rank 0 checks the expression and learns the model
+    # from the traces, and every process gets the same estimates.
+    cost_model = None
+    if argument_ns.cost_expr != None or argument_ns.cost_traces != None:
+        model = None
+        cost_experiments = None
+        if mpi_rank == 0:
+            try:
+                if argument_ns.cost_expr != None:
+                    # The expression only applies to the experiments that
+                    # have all the variables it uses.
+                    check_model = CostModel(argument_ns.cost_expr)
+                    cost_experiments = []
+                    for exp_plan in plan:
+                        try:
+                            check_model.cost(exp_plan["safe_name"], planCombination(exp_plan, 0))
+                            cost_experiments.append(exp_plan["safe_name"])
+                        except ValueError as ve:
+                            sys.stderr.write("Warning - Not using the cost expression for experiment '{0}'. {1}\n".format(exp_plan["name"], ve))
+                    if len(cost_experiments) == 0:
+                        sys.stderr.write("Warning - The cost expression cannot be used for any of the experiments, all their combinations cost the same.\n")
+                else:
+                    model = learn_cost_model(sorted(glob.glob(argument_ns.cost_traces)), plan)
+                    if len(model) == 0:
+                        sys.stderr.write("Warning - No NetLogo timings for these experiments in '{0}'\n".format(argument_ns.cost_traces))
+            except ValueError as ve:
+                sys.stderr.write(str(ve) + "\n")
+                error = 1
+        (model, cost_experiments, error) = comm.bcast((model, cost_experiments, error), root = 0)
+        if error != 0:
+            exit(error)
+        cost_model = CostModel(argument_ns.cost_expr, model, cost_experiments)
 
     # Absolute paths.
     # We create absolute paths for some files and paths in case given relative.
@@ -118,279 +235,692 @@ def main():
             exit(ioe.errno)
             sys.stdout.write("tst {0}: ".format(argument_ns.repetitions_per_run))
         
-    # Start processing.
-    original_dom = minidom.parseString(experiments_xml)
-    # Need a document to create nodes.
-    # Create a new experiments document to use as container.
-    experimentDoc = minidom.getDOMImplementation().createDocument(None, "experiments", None)    
-
     # Get all of the filenames for the outputs both temporary and permenent
-    xml_filename = os.path.join(argument_ns.output_dir, "proc" + str(mpi_rank).zfill(4) + ".xml")
-    dat_filename = os.path.join(argument_ns.output_dir, "proc" + str(mpi_rank).zfill(4) + ".dat")
+    scratch_dir = make_scratch_dir(argument_ns.scratch_dir, argument_ns.output_dir, mpi_rank)
     hdr_filename = os.path.join(argument_ns.output_dir, "headers.dat")
     csv_filename = os.path.join(argument_ns.output_dir, "proc" + str(mpi_rank).zfill(4) + ".csv")
-
-    experiment_names = get_experiment_names(original_dom, argument_ns)
-    experiment_lengths = get_experiment_lengths(original_dom, argument_ns)
-    (start_exp_name, start_i) = get_start_run(experiment_names, experiment_lengths, csv_filename, mpi_rank, mpi_size) 
-    started = False
+    compressed = argument_ns.output_format == "csv.gz"
+    if compressed:
+        csv_filename += ".gz"
+
+    # Restart. Every writer journals the global ids of the combinations it
+    # has finished. Rank 0 reads all journals, whatever number of processes
+    # wrote them, and all processes skip what is already done.
+    journal = CompletionJournal(os.path.join(argument_ns.output_dir, "proc" + str(mpi_rank).zfill(4) + ".done"))
+    done_bitmap = None
+    # Statistics of the earlier jobs, on rank 0, and the number of this job.
+    prior_stats = None
+    job = 0
+    error = 0
+    if mpi_rank == 0:
+        done_bitmap = check_study_journals(argument_ns.output_dir, plan, argument_ns.seed)
+        if done_bitmap == False:
+            error = 1
+        else:
+            # Runs that failed before are tried again, and recorded again
+            # if they still fail.
+            for fname in glob.glob(os.path.join(argument_ns.output_dir, "proc*.failed.csv")):
+                os.remove(fname)
+            if argument_ns.summarize:
+                (prior_stats, job, done_bitmap) = resume_summary(argument_ns.output_dir, plan, done_bitmap)
+    (done_bitmap, job, error) = comm.bcast((done_bitmap, job, error), root = 0)
+    if error != 0:
+        exit(error)
+
+    # Statistics of the reporters over the repetitions. Every job saves
+    # them to files of its own, which are merged by a restarted job.
+    stats = None
+    if argument_ns.summarize:
+        stats = StudyStats(os.path.join(argument_ns.output_dir, "proc" + str(mpi_rank).zfill(4) + ".job" + str(job).zfill(4) + ".stats"))
+        journal = StatsJournal(stats, journal)
+
+    # The design tables of sampled experiments.
+    if mpi_rank == 0:
+        for exp_plan in plan:
+            if exp_plan["design"] != None:
+                write_design_table(os.path.join(argument_ns.output_dir, "design_" + exp_plan["safe_name"] + ".csv"), exp_plan)
+
+    # Results are cached by the content of the model and the NetLogo jar.
+    cache = None
+    if argument_ns.cache_dir != None:
+        cache_id = (None, None)
+        error = 0
+        if mpi_rank == 0:
+            try:
+                cache_id = (file_hash(argument_ns.nlogo_file), netlogo_version(argument_ns.nlogo_path))
+                ResultCache(argument_ns.cache_dir, 0)
+            except (IOError, OSError) as ioe:
+                sys.stderr.write(str(ioe.strerror) + " '{0}'\n".format(ioe.filename))
+                error = ioe.errno
+        ((model_hash, nlogo_version), error) = comm.bcast((cache_id, error), root = 0)
+        if error != 0:
+            exit(error)
+        cache = ResultCache(argument_ns.cache_dir, int(argument_ns.cache_size * 1e6))
+
+    # Runs load the model and NetLogo from node local copies.
+    if argument_ns.stage:
+        with tracer.phase("stage"):
+            stage_dir = argument_ns.scratch_dir if argument_ns.scratch_dir != None else argument_ns.output_dir
+            (nlogo_file_abs, argument_ns.nlogo_path) = stage_files(comm, stage_dir, nlogo_file_abs, argument_ns.nlogo_path,
+                                                                   argument_ns.stage_files)
 
     # Remember which experiments were processed.
     processed_experiments = []
+    headers_written = []
+
+    worker = None
+    # Heap size of the worker, which grows when it runs out of memory.
+    worker_heap = {"xmx" : argument_ns.xmx}
+    if argument_ns.worker:
+        worker = NetLogoWorker(argument_ns.java, argument_ns.nlogo_path, nlogo_file_abs, jvm_args(argument_ns.xmx))
+        worker.start()
+
+    # Rows are buffered and written in large appends, optionally by one
+    # writer process per node. Only the journal is kept if the rows are not.
+    if argument_ns.summary_only:
+        sink = ResultSink(csv_filename, argument_ns.flush_rows, argument_ns.flush_seconds, journal)
+    elif argument_ns.output_format in COLUMNAR_FORMATS:
+        sink = ColumnarSink(os.path.join(argument_ns.output_dir, "proc" + str(mpi_rank).zfill(4)),
+                            argument_ns.output_format, argument_ns.flush_rows, argument_ns.flush_seconds, journal)
+    elif argument_ns.node_writer and not isinstance(comm, LocalComm):
+        from mpi4py import MPI
+        node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key = mpi_rank)
+        leader_rank = node_comm.bcast(mpi_rank, root = 0)
+        node_csv_filename = os.path.join(argument_ns.output_dir, "proc" + str(leader_rank).zfill(4) + ".csv")
+        if compressed:
+            node_csv_filename += ".gz"
+        sink = NodeResultSink(node_comm, node_csv_filename, argument_ns.flush_rows, argument_ns.flush_seconds, journal, compressed)
+    else:
+        sink = ResultSink(csv_filename, argument_ns.flush_rows, argument_ns.flush_seconds, journal, compressed)
+
+    counter = None
+    if argument_ns.schedule == "dynamic":
+        counter = shared_counter(comm, 1)
     
-    for orig_experiment in original_dom.getElementsByTagName("experiment"):
-        if argument_ns.all_experiments == True \
-                or orig_experiment.getAttribute("name") \
-                in argument_ns.experiment:
-
-            processed_experiments.append(orig_experiment.getAttribute("name"))
-
-            experiment = orig_experiment.cloneNode(deep = True)
-            experiment_name = experiment.getAttribute("name").replace(' ', '_').replace('/', '-').replace('\\','-')
-            
-            # Store tuples of varying variables and their possible values.
-            value_tuples = []
-            num_individual_runs = 1
-
-            # Number of repetieitons.
-            # In the experiment.
-            # Read original value first. Default is to have all internal.
-            reps_in_experiment = int(experiment.getAttribute("repetitions"));
-            # Repeats of the created experiment.
-            reps_of_experiment = 1;
-            # Check if we should split experiments. An unset switch or value <= 0 means no splitting.
-            if argument_ns.repetitions_per_run != None \
-                    and argument_ns.repetitions_per_run[0] > 0:
-                original_reps = int(experiment.getAttribute("repetitions"))
-                if original_reps >= argument_ns.repetitions_per_run[0]:
-                    reps_in_experiment = int(argument_ns.repetitions_per_run[0])
-                    reps_of_experiment = int(original_reps / reps_in_experiment)
-                    if(original_reps % reps_in_experiment != 0):
-                        sys.stderr.write("Warning: Number of repetitions per experiment does not divide the number of repetitions in the nlogo file. New number of repetitions is {0} ({1} per experiment in {2} unique script(s)). Original number of repetitions per experiment: {3}.\n"\
-                                             .format((reps_in_experiment*reps_of_experiment), 
-                                                     reps_in_experiment, 
-                                                     reps_of_experiment,
-                                                     original_reps))
-
-            # Handle enumeratedValueSets
-            for evs in experiment.getElementsByTagName("enumeratedValueSet"):
-                values = evs.getElementsByTagName("value")
-                # If an enumeratedValueSet has more than a single value, it should
-                # be included in the value expansion tuples.
-                if len(values) > 1:
-                    # A tuple is the name of the variable and
-                    # A list of all the values.
-                    value_tuples.append((evs.getAttribute("variable"), 
-                                         [val.getAttribute("value") \
-                                              for val in values]
-                                         )
-                                        )
-                    num_individual_runs *= len(value_tuples[-1][1])
-                    # Remove the node.
-                    experiment.removeChild(evs)
-                    
-
-            # Handle steppedValueSet
-            for svs in experiment.getElementsByTagName("steppedValueSet"):
-                first = float(svs.getAttribute("first"))
-                last = float(svs.getAttribute("last"))
-                step = float(svs.getAttribute("step"))
-                # Add values to the tuple list.
-                value_tuples.append((svs.getAttribute("variable"),
-                                     steppedValueSet(first, step, last)
-                                     )
-                                    )
-                num_individual_runs *= len(value_tuples[-1][1])
-                # Remove node.
-                experiment.removeChild(svs)
-
-            
-            # Now create the different individual runs.
-            enum = 0
-            # Keep track of the parameter values in a run table.
-            run_table = []
-            ENR_STR = "Experiment number"
-            exp_all = []
-            if num_individual_runs > 1:
-                vsgen = expandValueSets(value_tuples)
-                for exp in vsgen:
-                    exp_all.append(exp)
-            else:
-                # If there were no experiments to expand create a dummy-
-                # expansion just to make sure the single experiment is still
-                # created.
-                vsgen = [[]]
-          
-            #Handle the restart if we doing that now 
-            if started:
-                exp_start_i = mpi_rank
+    # NetLogo runs in progress. Each uses one of the slots, which has its
+    # own setup and table files.
+    slots = max(1, argument_ns.slots)
+    running = []
+    free_slots = list(range(slots - 1, -1, -1))
+    xml_filenames = [os.path.join(scratch_dir, "proc" + str(mpi_rank).zfill(4) + "_" + str(slot) + ".xml") for slot in range(slots)]
+    dat_filenames = [os.path.join(scratch_dir, "proc" + str(mpi_rank).zfill(4) + "_" + str(slot) + ".dat") for slot in range(slots)]
+    err_filenames = [os.path.join(scratch_dir, "proc" + str(mpi_rank).zfill(4) + "_" + str(slot) + ".err") for slot in range(slots)]
+
+    # Runs are stopped when they take too long, and retried when they fail.
+    # Failed runs waiting to be retried.
+    retry_tasks = []
+    timer = RunTimer(argument_ns.timeout, argument_ns.timeout_factor)
+    failures = FailureTable(os.path.join(argument_ns.output_dir, "proc" + str(mpi_rank).zfill(4) + ".failed.csv"))
+
+    def stop_runs():
+        # The runs are in process groups of their own, so they are not
+        # stopped with this process unless it does so itself.
+        for task in running:
+            if task["proc"].poll() == None:
+                kill_group(task["proc"], 1.0)
+    atexit.register(stop_runs)
+
+    def write_results(task, header_lines, rows, writers):
+        # The table is streamed, one row at a time. Unless all rows are
+        # kept only the first row of each combination is used.
+        (first_i, stop_i) = (task["first_i"], task["stop_i"])
+        (offset, block) = (task["unit"]["offset"], task["block"])
+        reps_of_experiment = task["exp_plan"]["reps_of_experiment"]
+        experiment_name = task["experiment"]
+        if len(writers) > 0:
+            for writer in writers:
+                for line in header_lines:
+                    writer.write(line)
+            rows = caching_rows(rows, writers)
+        step_col = table_step_column(header_lines)
+        written = [False] * (stop_i - first_i)
+        # Rows for the statistics, kept until the unit is complete. Without
+        # all rows only the last row of each repetition is used.
+        pending = task["unit"].setdefault("stats", {})
+        last_rows = {}
+        for comb_i, line in itertools.chain(rows, [(comb_i, None) for comb_i in range(stop_i - first_i)]):
+            exp_i = first_i + comb_i
+            if is_done(done_bitmap, offset + exp_i * reps_of_experiment + block):
+                continue
+            if stats != None and line != None:
+                if argument_ns.all_rows:
+                    stats.add_row(pending, experiment_name, exp_i, header_lines, line, True)
+                else:
+                    last_rows[(exp_i, table_repetition(line))] = line
+            if argument_ns.summary_only or (written[comb_i] and (line == None or not argument_ns.all_rows)):
+                continue
+            written[comb_i] = True
+            # Split repetitions are numbered over all blocks.
+            rep = None
+            if reps_of_experiment > 1:
+                rep = block * task["reps"] + table_repetition(line)
+            if argument_ns.output_format in COLUMNAR_FORMATS:
+                sink.write(experiment_name, exp_i, planCombination(task["exp_plan"], exp_i), header_lines, line, rep)
             else:
-                if start_exp_name == experiment_name:
-                    exp_start_i = start_i
-                    started = True
+                append_data_to_cvs(line, experiment_name, exp_i, sink, step_col if argument_ns.all_rows else None, rep)
+            if exp_i == 0 and block == 0 and experiment_name not in headers_written:
+                append_header(header_lines, experiment_name, hdr_filename, argument_ns.all_rows, reps_of_experiment > 1)
+                headers_written.append(experiment_name)
+        for (exp_i, rep), line in last_rows.items():
+            stats.add_row(pending, experiment_name, exp_i, header_lines, line)
+        for writer in writers:
+            writer.commit()
+
+    def table_results(task, table):
+        # Results of a successful run of NetLogo, which are added to the
+        # cache.
+        with tracer.phase("results", experiment = task["experiment"], run = task["first_i"]):
+            header_lines = list(itertools.islice(table, 7))
+            rows = batch_table_rows(table, task["stop_i"] - task["first_i"], task["reps"])
+            writers = []
+            try:
+                if task["cache_keys"] != None:
+                    for key in task["cache_keys"]:
+                        writers.append(cache.writer(key))
+                write_results(task, header_lines, rows, writers)
+            finally:
+                # Entries of a unit that raised are not left half written.
+                for writer in writers:
+                    writer.discard()
+        finish_unit(task["unit"], 0, task["begin"])
+
+    def finish_unit(unit, failed, begin):
+        # The repetition block of the combinations of the unit is complete.
+        # Failed units are not, so a restart runs them again. The
+        # statistics of the unit are staged before the sink can journal it.
+        if failed == 0:
+            global_ids = [global_id for global_id in unit["global_ids"] if not is_done(done_bitmap, global_id)]
+            if stats != None:
+                stats.stage(unit.get("stats", {}), global_ids)
+            sink.complete_all(global_ids)
+        tracer.unit_done(begin, time.time(), len(unit["global_ids"]), failed)
+
+    def launch(task):
+        # Start NetLogo for the task in a free slot, without waiting for it.
+        task["slot"] = free_slots.pop()
+        task["attempts"] += 1
+        task["launched"] = time.time()
+        limit = timer.limit(task["experiment"], (task["stop_i"] - task["first_i"]) * task["reps"])
+        task["deadline"] = task["launched"] + limit if limit != None else None
+        task["timed_out"] = False
+        write_instance_xml(xml_filenames[task["slot"]], task["setup_xml"])
+        task["proc"] = start_nlogo(argument_ns.java, argument_ns.nlogo_path, nlogo_file_abs,
+                                   xml_filenames[task["slot"]], dat_filenames[task["slot"]], argument_ns.nlogo_threads,
+                                   task["xmx"], err_filenames[task["slot"]])
+        running.append(task)
+
+    def run_failed(task, exit_code, err_lines):
+        # Retry a failed run after a delay that doubles with every attempt,
+        # with twice the memory if java ran out of it, or record it as failed
+        # for good.
+        if task["timed_out"]:
+            reason = "timeout"
+        elif out_of_memory(err_lines):
+            reason = "out of memory"
+        elif exit_code == 0:
+            reason = "no table"
+        else:
+            reason = "exit code {0}".format(exit_code)
+        if retry_failed(task, exit_code, reason):
+            retry_tasks.append(task)
+
+    def retry_failed(task, exit_code, reason):
+        # Whether a failed run is tried again, after task["retry_at"] and
+        # with twice the memory if java ran out of it. Otherwise the run is
+        # recorded as failed for good and its unit is finished.
+        seconds = time.time() - task["launched"]
+        sys.stderr.write("NetLogo run of experiment '{0}' run {1} failed ({2}), attempt {3} of {4}.\n"\
+                             .format(task["experiment"], task["first_i"], reason, task["attempts"], argument_ns.retries + 1))
+        if task["attempts"] <= argument_ns.retries:
+            if reason == "out of memory":
+                task["xmx"] = min(2 * task["xmx"], max(argument_ns.max_xmx, task["xmx"]))
+            task["retry_at"] = time.time() + argument_ns.retry_delay * 2 ** (task["attempts"] - 1)
+            return True
+        for exp_i in range(task["first_i"], task["stop_i"]):
+            failures.record(task["experiment"], exp_i, task["block"], task["attempts"], exit_code, reason, seconds)
+        finish_unit(task["unit"], task["stop_i"] - task["first_i"], task["begin"])
+        return False
+
+    def worker_run(task):
+        # Run the task in the persistent worker, which has no time limit.
+        # Failed runs are retried and recorded like those launched with
+        # java, and a worker that exited is started again for the retry. A
+        # worker that ran out of memory is started again with the larger
+        # heap of the retry, which it keeps for the later runs.
+        while True:
+            task["attempts"] += 1
+            task["launched"] = time.time()
+            with tracer.phase("netlogo", experiment = task["experiment"], run = task["first_i"],
+                              runs = task["stop_i"] - task["first_i"], block = task["block"]) as trace_args:
+                try:
+                    lines = worker.run(task["setup_xml"])
+                    trace_args["exit_code"] = 0
+                except RuntimeError as rte:
+                    lines = None
+                    trace_args["exit_code"] = 1
+                    sys.stderr.write(str(rte) + "\n")
+                    reason = "out of memory" if out_of_memory([str(rte)]) else "worker error"
+            if lines != None:
+                table_results(task, iter(lines))
+                return
+            if not retry_failed(task, 1, reason):
+                return
+            if task["xmx"] > worker_heap["xmx"]:
+                worker.close()
+                worker.jvm_args = jvm_args(task["xmx"])
+                worker_heap["xmx"] = task["xmx"]
+            time.sleep(max(0.0, task["retry_at"] - time.time()))
+
+    def wait_runs(max_running):
+        # Wait until at most max_running runs are in progress, handling the
+        # results of those that finish and stopping those over their time
+        # limit. Retries are started as soon as their delay is over and a
+        # slot is free, and with max_running 0 they are waited for as well.
+        while True:
+            now = time.time()
+            for task in list(retry_tasks):
+                if task["retry_at"] <= now and len(free_slots) > 0:
+                    retry_tasks.remove(task)
+                    launch(task)
+            if len(running) <= max_running and (max_running > 0 or len(retry_tasks) == 0):
+                return
+            finished = []
+            for task in running:
+                if task["proc"].poll() == None and task["deadline"] != None and now > task["deadline"]:
+                    kill_group(task["proc"])
+                    task["timed_out"] = True
+                if task["proc"].poll() != None:
+                    finished.append(task)
+            if len(finished) == 0:
+                time.sleep(0.01)
+                continue
+            for task in finished:
+                running.remove(task)
+                slot = task["slot"]
+                exit_code = task["proc"].returncode
+                output_bytes = os.path.getsize(dat_filenames[slot]) if os.path.isfile(dat_filenames[slot]) else 0
+                tracer.event("netlogo", task["launched"], time.time(), tid = slot, experiment = task["experiment"],
+                             run = task["first_i"], runs = task["stop_i"] - task["first_i"], block = task["block"],
+                             exit_code = exit_code, output_bytes = output_bytes)
+                # What java wrote to stderr is passed on.
+                err_lines = read_tail(err_filenames[slot])
+                if len(err_lines) > 0:
+                    sys.stderr.write("".join(err_lines))
+                if exit_code == 0 and not task["timed_out"] and os.path.isfile(dat_filenames[slot]):
+                    timer.observe(task["experiment"], time.time() - task["launched"], (task["stop_i"] - task["first_i"]) * task["reps"])
+                    with open_table(dat_filenames[slot]) as table:
+                        table_results(task, table)
                 else:
-                    exp_start_i = num_individual_runs + 1   #Skip this experiment
- 
-            for exp_i in range(exp_start_i, num_individual_runs, mpi_size):
-                exp = exp_all[exp_i]
-                for exp_clone in range(reps_of_experiment):
-                    # Add header in case we are on the first row.
-                    if enum < 1:
-                        run_table.append([ENR_STR])
-                    run_table.append([enum])
-
-                    experiment_instance = experiment.cloneNode(deep = True)
-                    experiment_instance.setAttribute("repetitions",str(reps_in_experiment))
-                    for evs_name, evs_value in exp:
-                        evs = experimentDoc.createElement("enumeratedValueSet")
-                        evs.setAttribute("variable", evs_name)
-                        vnode = experimentDoc.createElement("value")
-                        vnode.setAttribute("value", str(evs_value))
-                        evs.appendChild(vnode)
-                        experiment_instance.appendChild(evs)
-
-                    write_instance_xml(xml_filename, experiment_instance)
-                    run_nlogo(argument_ns.java, argument_ns.nlogo_path, argument_ns.nlogo_file, xml_filename, dat_filename)
-                    append_data_to_cvs(dat_filename, experiment_name, exp_i, csv_filename)
-                    if exp_i == 0:
-                        append_header(dat_filename, experiment_name, hdr_filename)
-                    
-                    #Finally remove the temp files
-                    os.remove(xml_filename)
-                    os.remove(dat_filename)
+                    run_failed(task, exit_code, err_lines)
+                #Finally remove the temp files
+                for fname in [xml_filenames[slot], dat_filenames[slot], err_filenames[slot]]:
+                    if os.path.isfile(fname):
+                        os.remove(fname)
+                free_slots.append(slot)
+
+    # Every unit of work of the study, a repetition block of a batch of
+    # combinations of an experiment, has an index in one global space, the
+    # units of each experiment following those of the one before. Restart,
+    # partitioning and scheduling all work on this space, so the processes
+    # share the work of all experiments and none idles at their boundaries.
+    batch_size = max(1, argument_ns.batch_size)
+    layouts = []
+    unit_offsets = []
+    num_units = 0
+    for exp_plan in plan:
+        processed_experiments.append(exp_plan["name"])
+        # Combinations are handed out in batches of consecutive
+        # combinations that only differ in the last variable.
+        # Design points are not batched.
+        if len(exp_plan["value_tuples"]) > 0 and exp_plan["design"] == None:
+            inner_size = len(exp_plan["value_tuples"][-1][1])
+        else:
+            inner_size = 1
+        layouts.append({"exp_plan" : exp_plan, "inner_size" : inner_size, "template" : None})
+        unit_offsets.append(num_units)
+        # A unit of work is one repetition block of a batch, so the blocks
+        # of a combination are spread over the processes like batches are.
+        num_units += num_batches(exp_plan["num_runs"], inner_size, batch_size) * exp_plan["reps_of_experiment"]
+
+    def unit_location(unit_i):
+        # The experiment layout, batch and repetition block of a unit.
+        (layout_i, local_i) = locate_unit(unit_offsets, unit_i)
+        (batch_i, block) = divmod(local_i, layouts[layout_i]["exp_plan"]["reps_of_experiment"])
+        return (layouts[layout_i], batch_i, block)
+
+    def unit_ids(unit_i):
+        # Global ids of the combinations of a unit, in its block.
+        (layout, batch_i, block) = unit_location(unit_i)
+        exp_plan = layout["exp_plan"]
+        return [exp_plan["offset"] + exp_i * exp_plan["reps_of_experiment"] + block \
+                    for exp_i in range(*batch_range(batch_i, layout["inner_size"], batch_size))]
+
+    def unit_cost(unit_i):
+        (layout, batch_i, block) = unit_location(unit_i)
+        exp_plan = layout["exp_plan"]
+        return sum([cost_model.cost(exp_plan["safe_name"], planCombination(exp_plan, exp_i)) \
+                        for exp_i in range(*batch_range(batch_i, layout["inner_size"], batch_size))])
+
+    # Only units with unfinished combinations are handed out.
+    if done_bitmap != None:
+        units = pending_units(num_units, lambda unit_i: all([is_done(done_bitmap, global_id) \
+                                                                 for global_id in unit_ids(unit_i)]))
+    else:
+        units = index_range(num_units)
+
+    # Most expensive units first, if there are estimates.
+    costs = None
+    if cost_model != None:
+        # The expression was only checked with the first combination of
+        # every experiment. Every process computes the same costs, so all
+        # fall back to equal costs if one cannot be computed.
+        try:
+            costs = [unit_cost(unit_i) for unit_i in units]
+        except ValueError as ve:
+            if mpi_rank == 0:
+                sys.stderr.write("Warning - Not using the cost estimates. {0}\n".format(ve))
+        if costs != None:
+            (units, costs) = order_by_cost(units, costs)
+
+    if counter != None:
+        chunks = guided_chunks(len(units), mpi_size, argument_ns.min_chunk, costs)
+        unit_indices = (units[i] for i in dynamic_indices(counter, 0, chunks))
+    elif costs != None:
+        unit_indices = [units[i] for i in lpt_partition(costs, mpi_size, mpi_rank)]
+    else:
+        unit_indices = itertools.islice(units, mpi_rank, None, mpi_size)
+
+    # Now create the different individual runs.
+    enum = 0
+    # Keep track of the parameter values in a run table.
+    run_table = []
+    ENR_STR = "Experiment number"
+
+    for unit_i in unit_indices:
+        (layout, batch_i, block) = unit_location(unit_i)
+        exp_plan = layout["exp_plan"]
+        # The setup xml of every run is formatted from this template.
+        if layout["template"] == None:
+            layout["template"] = compileExperimentTemplate(exp_plan["template"])
+        template = layout["template"]
+        experiment_name = exp_plan["safe_name"]
+        value_tuples = exp_plan["value_tuples"]
+        reps_in_experiment = exp_plan["reps_in_experiment"]
+        reps_of_experiment = exp_plan["reps_of_experiment"]
+        inner_size = layout["inner_size"]
+
+        (first_i, stop_i) = batch_range(batch_i, inner_size, batch_size)
+        unit = {"offset" : exp_plan["offset"], "global_ids" : unit_ids(unit_i)}
+        # Combinations are decoded from their index, so no process
+        # needs to hold the full expansion. With no variables to
+        # expand this is the single, empty, combination.
+        exp = planCombination(exp_plan, first_i)
+        if stop_i - first_i > 1:
+            exp[-1] = (exp[-1][0], value_tuples[-1][1][first_i % inner_size:first_i % inner_size + stop_i - first_i])
+        # Add header in case we are on the first row.
+        if enum < 1:
+            run_table.append([ENR_STR])
+        run_table.append([enum])
+
+        # Every run of the study has its own seed, the study seed plus
+        # its number, global id * repetitions + repetition.
+        seed_command = ""
+        if argument_ns.seed != None:
+            seed_command = seedCommand(argument_ns.seed + unit["global_ids"][0] * reps_in_experiment,
+                                       reps_of_experiment * reps_in_experiment, reps_in_experiment)
+
+        task = {"unit" : unit, "experiment" : experiment_name, "exp_plan" : exp_plan, "block" : block,
+                "reps" : reps_in_experiment, "first_i" : first_i, "stop_i" : stop_i, "cache_keys" : None,
+                "begin" : time.time()}
+        with tracer.phase("setup", experiment = experiment_name, run = first_i, block = block) as trace_args:
+            # Results already in the cache are used as they are.
+            entries = None
+            if cache != None:
+                task["cache_keys"] = [cache_key(model_hash, nlogo_version,
+                                                renderExperiment(template, planCombination(exp_plan, first_i + comb_i), reps_in_experiment),
+                                                block, None if argument_ns.seed == None else \
+                                                    argument_ns.seed + global_id * reps_in_experiment) \
+                                          for comb_i, global_id in enumerate(unit["global_ids"])]
+                entries = cached_tables(cache, task["cache_keys"])
+                trace_args["cached"] = entries != None
+            if entries == None:
+                setup_xml = renderExperiment(template, exp, reps_in_experiment, seed_command)
+
+        if entries != None:
+            with tracer.phase("results", experiment = experiment_name, run = first_i):
+                rows = ((comb_i, line) for comb_i, entry in enumerate(entries) for line in entry[7:])
+                write_results(task, entries[0][:7], rows, [])
+            finish_unit(unit, 0, task["begin"])
+        elif worker != None:
+            task.update({"setup_xml" : setup_xml, "attempts" : 0, "xmx" : worker_heap["xmx"]})
+            worker_run(task)
+        else:
+            # Wait for a free slot, then launch NetLogo without
+            # waiting for it to finish.
+            wait_runs(slots - 1)
+            task.update({"setup_xml" : setup_xml, "attempts" : 0, "xmx" : argument_ns.xmx})
+            launch(task)
+
+    # The last runs.
+    wait_runs(0)
+    if failures.num_failed > 0:
+        sys.stderr.write("Warning - {0} runs failed, see '{1}'\n".format(failures.num_failed, failures.filename))
+
+    with tracer.phase("flush"):
+        sink.close()
+        if cache != None:
+            cache.close()
+    if worker != None:
+        worker.close()
+    if counter != None:
+        counter.free()
+
+    # The summary tables, from the statistics of all processes and of the
+    # earlier jobs of the study.
+    if stats != None:
+        with tracer.phase("summary"):
+            stats.save()
+            stats = reduce_stats(comm, stats)
+            if mpi_rank == 0:
+                if prior_stats != None:
+                    stats.merge(prior_stats)
+                for exp_plan in plan:
+                    summary_filename = os.path.join(argument_ns.output_dir, "summary_" + exp_plan["safe_name"] + ".csv")
+                    try:
+                        write_summary(summary_filename, exp_plan, stats, argument_ns.summary_quantiles)
+                    except IOError as ioe:
+                        sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
+
+    # Summary of where the time went, over all processes.
+    tracer.close()
+    all_totals = comm.gather(tracer.totals(), root = 0)
+    if argument_ns.trace and mpi_rank == 0:
+        sys.stdout.write(summarize(all_totals))
+    if cache != None:
+        counts = comm.gather((cache.hits, cache.misses), root = 0)
+        if mpi_rank == 0:
+            print("Cache: {0} hits, {1} misses.".format(sum([hits for hits, misses in counts]),
+                                                        sum([misses for hits, misses in counts])))
 
     # Warn if some experiments could not be found in the file.
     for ename in argument_ns.experiment:
-        if ename not in processed_experiments:
+        if ename not in processed_experiments and mpi_rank == 0:
             print("Warning - Experiment named '{0}' not found in model file '{1}'".format(ename, argument_ns.nlogo_file))
 
-def get_last_run(cvs_filename):
-    last_exp = ""
-    last_i = -1
-    if os.path.isfile(cvs_filename):
-        with open(csv_filename, "r") as fout:
-            for line in fout:
-                last = line
-            else:
-                last = ""                
-            part = string.split(last,",")
-            if len(part) >= 2:
-                last_exp = part[0]
-                last_i = int(part[1])
-    return (last_exp, last_i)
-
-def get_experiment_names(original_dom, argument_ns):
-    experiment_names = []
-    for orig_experiment in original_dom.getElementsByTagName("experiment"):
-        if argument_ns.all_experiments == True \
-                or orig_experiment.getAttribute("name") \
-                in argument_ns.experiment:
-            experiment = orig_experiment.cloneNode(deep = True)
-            experiment_name = experiment.getAttribute("name").replace(' ', '_').replace('/', '-').replace('\\','-')
-            experiment_names.append(experiment_name)
-    return experiment_names
-
-def get_experiment_lengths(original_dom, argument_ns):
-    experiment_lengths = []
-    for orig_experiment in original_dom.getElementsByTagName("experiment"):
-        if argument_ns.all_experiments == True \
-                or orig_experiment.getAttribute("name") \
-                in argument_ns.experiment:
-            experiment = orig_experiment.cloneNode(deep = True)
-
-            num_individual_runs = 1
-            # Handle enumeratedValueSets
-            for evs in experiment.getElementsByTagName("enumeratedValueSet"):
-                values = evs.getElementsByTagName("value")
-                # If an enumeratedValueSet has more than a single value, it should
-                # be included in the value expansion tuples.
-                if len(values) > 1:
-                    # A tuple is the name of the variable and
-                    # A list of all the values.
-                    temp = [val.getAttribute("value") for val in values]
-                    num_individual_runs *= len(temp)
-
-            # Handle steppedValueSet
-            for svs in experiment.getElementsByTagName("steppedValueSet"):
-                first = float(svs.getAttribute("first"))
-                last = float(svs.getAttribute("last"))
-                step = float(svs.getAttribute("step"))
-                # Add values to the tuple list.
-                temp = steppedValueSet(first, step, last)
-                num_individual_runs *= len(temp)
-
-            experiment_lengths.append(num_individual_runs)
-    return experiment_lengths
-
-def get_start_run(experiment_names, experiment_lengths, csv_filename, mpi_rank, mpi_size):
-    (last_exp_name, last_i) = get_last_run(csv_filename)
-    num_exp = len(experiment_names)
-    if last_i > -1:
-        for exp_i in range(num_exp):
-            if last_exp_name == experiment_names[exp_i]:
-                if last_i + mpi_size < experiment_lengths[exp_i]:
-                    start_exp = experiment_names[exp_i]
-                    start_i = last_i + mpi_size
-                    break
-                else:
-                    if exp_i + 1 < len(experiment_names):
-                        start_exp = experiment_names[exp_i+1]
-                        start_i = mpi_rank
-                        break
-                    else:
-                        start_exp = experiment_names[exp_i]
-                        start_i = last_i + mpi_size
-                        break
-    else:
-        start_exp = experiment_names[0]
-        start_i = mpi_rank
-    return (start_exp, start_i)
-
-def write_instance_xml(xml_filename, experiment_instance):
+def make_scratch_dir(scratch_dir, output_dir, mpi_rank):
+    # Private directory for the temporary files of this process, removed
+    # when the process exits however that happens.
+    if scratch_dir == None:
+        scratch_dir = output_dir
     try:
-        with open(xml_filename, 'w') as xmlfile:
-            saveExperimentToXMLFile(experiment_instance, xmlfile)
+        path = tempfile.mkdtemp(prefix = "mpirun_nlogo_" + str(mpi_rank).zfill(4) + "_", dir = scratch_dir)
+    except OSError as ose:
+        sys.stderr.write(ose.strerror + " '{0}'\n".format(scratch_dir))
+        exit(ose.errno)
+    atexit.register(shutil.rmtree, path, True)
+    return path
+
+def check_study_journals(output_dir, plan, seed = None):
+    # The journals are only valid for the study they were written for. The
+    # signature of the study is kept next to them.
+    sig_filename = os.path.join(output_dir, "journal.sig")
+    signature = study_signature(plan, seed)
+    try:
+        if os.path.isfile(sig_filename):
+            with open(sig_filename, "r") as sigf:
+                if sigf.read().strip() != signature:
+                    sys.stderr.write("The output directory '{0}' holds results of a different set of experiments (or repetition split). Use an empty output directory.\n".format(output_dir))
+                    return False
+        else:
+            with open(sig_filename, "w") as sigf:
+                sigf.write(signature + "\n")
+    except IOError as ioe:
+        sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
+        return False
+    num_ids = sum([exp_plan["num_runs"] * exp_plan["reps_of_experiment"] for exp_plan in plan])
+    (bitmap, num_done) = read_journals(output_dir, num_ids)
+    if num_done == 0:
+        return None
+    print("Restarting: {0} of {1} runs already done.".format(num_done, num_ids))
+    return bitmap
+
+def resume_summary(output_dir, plan, done_bitmap):
+    # The statistics saved by the earlier jobs of the study and the number
+    # of this job. The runs in the statistics are done too, even if the job
+    # was stopped before it journaled them.
+    job = 0
+    for fname in glob.glob(os.path.join(output_dir, "proc*.job*.stats")):
+        match = re.search(r"\.job(\d+)\.stats$", fname)
+        if match != None:
+            job = max(job, int(match.group(1)) + 1)
+    prior_stats = load_checkpoints(output_dir)
+    num_ids = sum([exp_plan["num_runs"] * exp_plan["reps_of_experiment"] for exp_plan in plan])
+    summarized = set(prior_stats.ids) if prior_stats != None else set()
+    missing = len([global_id for global_id in range(num_ids) if is_done(done_bitmap, global_id) and global_id not in summarized])
+    if missing > 0:
+        sys.stderr.write("Warning - {0} runs done by earlier jobs are not in the summary tables, they were run without --summarize.\n".format(missing))
+    if len(summarized) > 0:
+        if done_bitmap == None:
+            done_bitmap = bytearray((num_ids + 7) // 8)
+        for global_id in summarized:
+            if global_id < num_ids:
+                done_bitmap[global_id >> 3] |= 1 << (global_id & 7)
+    return (prior_stats, job, done_bitmap)
+
+def write_design_table(design_filename, exp_plan):
+    # The points of a sampling design by run number, as in the results.
+    try:
+        with open(design_filename, "w") as fout:
+            writer = csv.writer(fout, lineterminator = "\n")
+            writer.writerow(["run_number"] + [value_tuple[0] for value_tuple in exp_plan["value_tuples"]])
+            for exp_i in range(exp_plan["num_runs"]):
+                writer.writerow([str(exp_i).zfill(6)] + [value for name, value in planCombination(exp_plan, exp_i)])
     except IOError as ioe:
         sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
         exit(ioe.errno)
 
-def append_header(dat_filename, experiment_name, hdr_filename):
+def write_instance_xml(xml_filename, setup_xml):
     try:
-        with open(dat_filename, 'r') as datfile:
-            lines = datfile.readlines()
-            out_line = experiment_name + ",run_number,"
-            if len(lines) > 6:
-                out_line += lines[6]
-            else:
-                print "Cannot find header in NLOGO output .dat file!"
-            with open(hdr_filename, "a") as fout:
-                fout.write(out_line)
+        with open(xml_filename, 'w') as xmlfile:
+            xmlfile.write(setup_xml)
     except IOError as ioe:
-        print "Cannot find NLOGO output .dat file!"
+        sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
         exit(ioe.errno)
 
-def append_data_to_cvs(dat_filename, experiment_name, exp_i, csv_filename):
+def open_table(dat_filename):
+    return open(dat_filename, 'r')
+
+def table_step_column(header_lines):
+    # Position of the [step] column of the table, if any.
+    if len(header_lines) > 6:
+        fields = parse_table_line(header_lines[6])
+        if "[step]" in fields:
+            return fields.index("[step]")
+    return None
+
+def append_header(header_lines, experiment_name, hdr_filename, all_rows = False, rep = False):
+    out_line = experiment_name + ",run_number,"
+    if rep:
+        out_line += "rep,"
+    if all_rows:
+        out_line += "step,"
+    if len(header_lines) > 6:
+        out_line += header_lines[6]
+    else:
+        print("Cannot find header in NLOGO output .dat file!")
     try:
-        with open(dat_filename, 'r') as datfile:
-            lines = datfile.readlines()
-            out_line = experiment_name + "," + str(exp_i).zfill(6) + ","
-            if len(lines) > 7:
-                out_line += string.replace(lines[7],'"', '')
-            else:
-                out_line += '\n'
-            with open(csv_filename, "a") as fout:
-                fout.write(out_line)
+        with open(hdr_filename, "a") as fout:
+            fout.write(out_line)
     except IOError as ioe:
         sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
         exit(ioe.errno)
 
-def run_nlogo(java, nlogo_path, model_file, setup_file, output_file):
-    runstr =  java + " -Xmx2048m -Dfile.encoding=UTF-8"
+def append_data_to_cvs(line, experiment_name, exp_i, sink, step_col = None, rep = None):
+    # line is a row of the NetLogo table, or None if the run gave no rows.
+    # The repetition, if given, and the step, with a step column, are added
+    # after the run number.
+    out_line = experiment_name + "," + str(exp_i).zfill(6) + ","
+    if rep != None:
+        out_line += str(rep) + ","
+    if step_col != None:
+        fields = parse_table_line(line) if line != None else []
+        if step_col < len(fields):
+            out_line += fields[step_col]
+        out_line += ","
+    if line != None:
+        out_line += line.replace('"', '')
+    else:
+        out_line += '\n'
+    sink.write(out_line)
+
+def table_repetition(line):
+    # Repetition number (1, 2, ...) of a row of the table of a single
+    # combination, which is its run number.
+    if line == None:
+        return 1
+    try:
+        return int(line.split(",", 1)[0].strip('"'))
+    except ValueError:
+        return 1
+
+def batch_table_rows(table, num_combinations, reps_in_experiment):
+    # Give the data rows of a table together with the combination of the
+    # batch they belong to. NetLogo numbers the runs of a batch 1, 2, ...
+    # with the repetitions of each combination after each other, so the run
+    # number gives the combination. The run number is renumbered to what a
+    # run of the single combination would have given.
+    for line in table:
+        if num_combinations == 1:
+            yield (0, line)
+            continue
+        (run_field, rest) = line.split(",", 1)
+        run_number = int(run_field.strip('"'))
+        (comb_i, rep_i) = divmod(run_number - 1, reps_in_experiment)
+        if comb_i < num_combinations:
+            yield (comb_i, '"' + str(rep_i + 1) + '",' + rest)
+
+def run_nlogo(java, nlogo_path, model_file, setup_file, output_file, threads = None, xmx = 2048):
+    return start_nlogo(java, nlogo_path, model_file, setup_file, output_file, threads, xmx).wait()
+
+def jvm_args(xmx):
+    # Arguments of the JVM of NetLogo, launched or in a worker.
+    return ["-Xmx" + str(xmx) + "m", "-Dfile.encoding=UTF-8"]
+
+def start_nlogo(java, nlogo_path, model_file, setup_file, output_file, threads = None, xmx = 2048, err_file = None):
+    # Launch NetLogo and return the subprocess.Popen without waiting for it.
+    # It runs in a process group of its own, so kill_group stops all of it,
+    # with stderr going to err_file if given.
+    runstr =  java + " " + " ".join(jvm_args(xmx))
     runstr += " -classpath " + nlogo_path + " org.nlogo.headless.Main"
     runstr += " --model " + model_file
     runstr += " --setup-file " + setup_file
     runstr += " --table " + output_file
-    os.system(runstr)
+    if threads != None:
+        runstr += " --threads " + str(threads)
+    if err_file == None:
+        return subprocess.Popen(runstr, shell = True, preexec_fn = os.setsid)
+    with open(err_file, "w") as errf:
+        return subprocess.Popen(runstr, shell = True, preexec_fn = os.setsid, stderr = errf)
 
 if __name__ == "__main__":
     main()
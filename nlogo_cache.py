@@ -0,0 +1,334 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cache of NetLogo tables, addressed by the content of their inputs.  The key
+of a run is a hash of the model file, the NetLogo version, the setup file of
+the single combination (which holds every parameter value, the metrics, the
+time limit and the repetitions), the repetition block and the seed, so a
+study that is widened or extended only runs what is new.
+
+Entries are gzipped files, cache_dir/objects/ab/abcdef....gz, holding the
+table of one combination.  They are written to a temporary file and renamed,
+so readers never see half an entry.  The index, cache_dir/index, is a log of
+"time key size" lines, appended to under an exclusive flock on
+cache_dir/lock by all processes.  It records when every entry was stored or
+last used and is used to evict the least recently used entries when the
+total size goes over the limit.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import os
+import re
+import time
+import gzip
+import fcntl
+import hashlib
+import zipfile
+import tempfile
+
+
+def file_hash(fname):
+    sha = hashlib.sha1()
+    with open(fname, "rb") as fin:
+        for block in iter(lambda: fin.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def netlogo_version(nlogo_path):
+    """
+    Version of the NetLogo jar, from its manifest if it has one, else the
+    jar's name and size.
+
+    Parameters
+    ----------
+
+    nlogo_path : str
+       Path to the NetLogo jar.
+
+    Returns
+    -------
+
+    version : str
+    """
+    if nlogo_path == None:
+        return ""
+    try:
+        with zipfile.ZipFile(nlogo_path) as jar:
+            manifest = jar.read("META-INF/MANIFEST.MF").decode("utf-8", "replace")
+        match = re.search(r"^Implementation-Version:\s*(\S+)", manifest, re.MULTILINE)
+        if match != None:
+            return match.group(1)
+    except (IOError, KeyError, zipfile.BadZipfile):
+        pass
+    try:
+        return os.path.basename(nlogo_path) + ":" + str(os.path.getsize(nlogo_path))
+    except OSError:
+        return os.path.basename(nlogo_path)
+
+
+def cache_key(model_hash, version, setup_xml, repetition_block, seed = None):
+    """
+    Key of the table of a single combination.
+
+    Parameters
+    ----------
+
+    model_hash : str
+       Hash of the model file, see file_hash.
+
+    version : str
+       NetLogo version, see netlogo_version.
+
+    setup_xml : str
+       Setup file of the single combination, as given by
+       nlogo_io.renderExperiment.  It includes the number of repetitions.
+
+    repetition_block : int
+       Which block of repetitions of the combination the run is, when they
+       are split with --repetitions_per_run. Without a seed the blocks are
+       different runs of the same setup.
+
+    seed : int, optional
+       Random seed of the run, if it has one.
+
+    Returns
+    -------
+
+    key : str
+       Hex digest.
+    """
+    sha = hashlib.sha1()
+    for part in [model_hash, version, setup_xml, str(repetition_block), str(seed)]:
+        sha.update(part.encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Cache of NetLogo tables shared by all processes, see the module
+    documentation.
+
+    Parameters
+    ----------
+
+    cache_dir : str
+       Directory of the cache, created if it does not exist.
+
+    max_bytes : int
+       Size limit of the entries. The least recently used entries are
+       evicted when it is exceeded.
+
+    max_records : int, optional
+       Number of uses buffered before they are written to the index.
+    """
+
+    def __init__(self, cache_dir, max_bytes, max_records = 100):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.records = []
+        # Combinations served from the cache and run, see cached_tables.
+        self.hits = 0
+        self.misses = 0
+        self.index_filename = os.path.join(cache_dir, "index")
+        self.lock_filename = os.path.join(cache_dir, "lock")
+        try:
+            os.makedirs(os.path.join(cache_dir, "objects"))
+        except OSError:
+            if not os.path.isdir(os.path.join(cache_dir, "objects")):
+                raise
+
+    def entry_filename(self, key):
+        return os.path.join(self.cache_dir, "objects", key[:2], key + ".gz")
+
+    def lookup(self, key):
+        """
+        The table lines stored under key, or None if there is no entry.
+        """
+        try:
+            with gzip.open(self.entry_filename(key), "rb") as fin:
+                lines = [line.decode("utf-8") for line in fin]
+        except (IOError, OSError, EOFError):
+            # Missing, being evicted or damaged.
+            return None
+        self.record(key, 0)
+        return lines
+
+    def writer(self, key):
+        return CacheEntryWriter(self, key)
+
+    def record(self, key, size):
+        self.records.append("{0:.3f} {1} {2}\n".format(time.time(), key, size))
+        if len(self.records) >= self.max_records:
+            self.flush()
+
+    def flush(self):
+        # Append the uses to the index, and evict if the cache is too large.
+        if len(self.records) == 0:
+            return
+        with open(self.lock_filename, "a") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                with open(self.index_filename, "a") as fout:
+                    fout.write("".join(self.records))
+                added = sum([int(record.split()[2]) for record in self.records])
+                self.records = []
+                total = self.read_total() + added
+                if total > self.max_bytes:
+                    total = self.evict()
+                self.write_total(total)
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def read_total(self):
+        # Running total of the entry sizes, kept in cache_dir/size.
+        try:
+            with open(os.path.join(self.cache_dir, "size")) as fin:
+                return int(fin.read())
+        except (IOError, ValueError):
+            return 0
+
+    def write_total(self, total):
+        with open(os.path.join(self.cache_dir, "size"), "w") as fout:
+            fout.write(str(total) + "\n")
+
+    def evict(self):
+        # Called with the lock held. The index log gives the last use and
+        # size of every entry; entries are removed oldest first until the
+        # cache is below 90% of the limit, and the log is rewritten with one
+        # line per entry left. Returns the new total.
+        last_use = {}
+        sizes = {}
+        with open(self.index_filename) as fin:
+            for line in fin:
+                parts = line.split()
+                if len(parts) != 3:
+                    continue
+                last_use[parts[1]] = parts[0]
+                if int(parts[2]) > 0:
+                    sizes[parts[1]] = int(parts[2])
+        total = sum(sizes.values())
+        keys = sorted(sizes.keys(), key = lambda key: float(last_use[key]))
+        for key in keys:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(self.entry_filename(key))
+            except OSError:
+                pass
+            total -= sizes.pop(key)
+        (fd, tmp_name) = tempfile.mkstemp(prefix = "index_", dir = self.cache_dir)
+        with os.fdopen(fd, "w") as fout:
+            for key in sorted(sizes.keys(), key = lambda key: float(last_use[key])):
+                fout.write("{0} {1} {2}\n".format(last_use[key], key, sizes[key]))
+        os.rename(tmp_name, self.index_filename)
+        return total
+
+    def close(self):
+        self.flush()
+
+
+def cached_tables(cache, keys):
+    """
+    Look up the tables of all combinations of a batch.
+
+    Parameters
+    ----------
+
+    cache : ResultCache
+
+    keys : list
+       Keys of the combinations, see cache_key.
+
+    Returns
+    -------
+
+    entries : list or None
+       The table lines of each combination, or None unless all of them are
+       in the cache.
+    """
+    # Hits and misses count combinations. A batch with a miss is run as a
+    # whole, so all of its combinations are misses.
+    entries = []
+    for key in keys:
+        entry = cache.lookup(key)
+        if entry == None:
+            cache.misses += len(keys)
+            return None
+        entries.append(entry)
+    cache.hits += len(keys)
+    return entries
+
+
+def caching_rows(rows, writers):
+    # Pass on (combination, line) pairs, writing each line to the cache
+    # entry of its combination.
+    for comb_i, line in rows:
+        writers[comb_i].write(line)
+        yield (comb_i, line)
+
+
+class CacheEntryWriter(object):
+    """
+    Writes one entry of a ResultCache. Lines are streamed to a temporary
+    file, which becomes the entry on commit and is discarded otherwise.
+    discard may be called after commit, when it does nothing.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.filename = cache.entry_filename(key)
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        (fd, self.tmp_name) = tempfile.mkstemp(prefix = ".tmp_", dir = directory)
+        self.fout = gzip.GzipFile(fileobj = os.fdopen(fd, "wb"), mode = "wb")
+
+    def write(self, line):
+        self.fout.write(line.encode("utf-8"))
+
+    def commit(self):
+        self._close()
+        os.rename(self.tmp_name, self.filename)
+        self.tmp_name = None
+        self.cache.record(self.key, os.path.getsize(self.filename))
+
+    def discard(self):
+        self._close()
+        if self.tmp_name != None:
+            try:
+                os.remove(self.tmp_name)
+            except OSError:
+                pass
+            self.tmp_name = None
+
+    def _close(self):
+        if self.fout != None:
+            fileobj = self.fout.fileobj
+            self.fout.close()
+            fileobj.close()
+            self.fout = None
@@ -0,0 +1,315 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Backends running the processes of a study.  With the mpi backend the
+processes are the ranks of MPI.COMM_WORLD, started by mpirun.  With the
+local backend the processes are started with multiprocessing on the local
+machine, and communicate through a LocalComm, which provides the part of the
+mpi4py communicator interface the study uses (Get_rank, Get_size, bcast,
+gather, Barrier).  mpi4py is only imported when the mpi backend is used, so
+it need not be installed to run on a single machine.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import os
+import sys
+import atexit
+import mmap
+import signal
+import struct
+import tempfile
+import traceback
+import multiprocessing
+
+# Environment variables set by the common mpirun implementations (Open MPI,
+# MPICH/Hydra, Intel MPI, PMIx).
+MPIRUN_VARIABLES = ["OMPI_COMM_WORLD_SIZE", "PMI_SIZE", "PMIX_RANK", "MPI_LOCALNRANKS"]
+
+
+def under_mpirun():
+    for name in MPIRUN_VARIABLES:
+        if name in os.environ:
+            return True
+    return False
+
+
+def choose_backend(backend):
+    """
+    Resolve the auto backend. Processes started by mpirun use MPI, otherwise
+    the local backend is used.
+
+    Parameters
+    ----------
+
+    backend : str
+       mpi, local or auto.
+
+    Returns
+    -------
+
+    backend : str
+       mpi or local.
+    """
+    if backend != "auto":
+        return backend
+    if under_mpirun():
+        return "mpi"
+    return "local"
+
+
+def mpi_comm():
+    from mpi4py import MPI
+    return MPI.COMM_WORLD
+
+
+def run_mpi(target, args = ()):
+    """
+    Run target(comm, *args) as a process of MPI.COMM_WORLD.  If it fails,
+    with an exception or by exiting with a non zero code, the whole job is
+    aborted instead of leaving the other processes waiting for it in a
+    collective call.
+
+    Parameters
+    ----------
+
+    target : function
+       Function run by every process.
+
+    args : tuple, optional
+       Further arguments of target.
+    """
+    comm = mpi_comm()
+    signal.signal(signal.SIGTERM, terminated)
+    try:
+        target(comm, *args)
+    except SystemExit as se:
+        if se.code == None or se.code == 0 or comm.Get_size() == 1:
+            raise
+        if not isinstance(se.code, int):
+            sys.stderr.write(str(se.code) + "\n")
+        abort(comm, se.code if isinstance(se.code, int) else 1)
+    except BaseException:
+        if comm.Get_size() == 1:
+            raise
+        traceback.print_exc()
+        abort(comm, 1)
+
+
+def abort(comm, exit_code):
+    # Clean up this process, then stop all of them.
+    sys.stderr.write("Process {0} failed, aborting.\n".format(comm.Get_rank()))
+    sys.stderr.flush()
+    atexit._run_exitfuncs()
+    comm.Abort(exit_code)
+
+
+class LocalComm(object):
+    """
+    Communicator between processes on the local machine.  Every process has
+    a queue other processes send it messages through.  Collective calls are
+    numbered, and messages of a later call that arrive early are kept until
+    the process gets to it, so all processes must make the same collective
+    calls in the same order, as with MPI.
+
+    Create it in the parent process, with set_rank called in each child.
+
+    Parameters
+    ----------
+
+    size : int
+       Number of processes.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.rank = 0
+        self.queues = [multiprocessing.Queue() for rank in range(size)]
+        self.lock = multiprocessing.Lock()
+        self.seq = 0
+        self.pending = {}
+
+    def set_rank(self, rank):
+        self.rank = rank
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def send(self, obj, dest):
+        self.queues[dest].put((self.seq, self.rank, obj))
+
+    def recv(self, source):
+        key = (self.seq, source)
+        while key not in self.pending:
+            (seq, src, obj) = self.queues[self.rank].get()
+            self.pending[(seq, src)] = obj
+        return self.pending.pop(key)
+
+    def bcast(self, obj, root = 0):
+        if self.rank == root:
+            for rank in range(self.size):
+                if rank != root:
+                    self.send(obj, rank)
+        else:
+            obj = self.recv(root)
+        self.seq += 1
+        return obj
+
+    def gather(self, obj, root = 0):
+        result = None
+        if self.rank == root:
+            result = [obj if rank == root else self.recv(rank) for rank in range(self.size)]
+        else:
+            self.send(obj, root)
+        self.seq += 1
+        return result
+
+    def Barrier(self):
+        self.gather(None)
+        self.bcast(None)
+
+
+class LocalCounter(object):
+    """
+    The counterpart of nlogo_sched.SharedCounter for a LocalComm: counters
+    in a shared memory mapped file, incremented under the lock of the
+    communicator.  Creating and freeing the counter are collective.
+
+    Parameters
+    ----------
+
+    comm : LocalComm
+
+    num_counters : int
+       Number of independent counters, all starting at zero.
+    """
+
+    def __init__(self, comm, num_counters):
+        self.comm = comm
+        self.num_counters = num_counters
+        fname = None
+        if comm.Get_rank() == 0:
+            (fd, fname) = tempfile.mkstemp(prefix = "nlogo_counter_", dir = "/dev/shm" if os.path.isdir("/dev/shm") else None)
+            os.write(fd, b"\0" * 8 * max(1, num_counters))
+            os.close(fd)
+        self.fname = comm.bcast(fname, root = 0)
+        with open(self.fname, "r+b") as fin:
+            self.map = mmap.mmap(fin.fileno(), 8 * max(1, num_counters))
+
+    def next(self, counter):
+        with self.comm.lock:
+            value = struct.unpack_from("<q", self.map, 8 * counter)[0]
+            struct.pack_into("<q", self.map, 8 * counter, value + 1)
+        return value
+
+    def free(self):
+        self.map.close()
+        self.comm.Barrier()
+        if self.comm.Get_rank() == 0:
+            os.remove(self.fname)
+
+
+def shared_counter(comm, num_counters):
+    # A counter suited to the backend of comm.
+    if isinstance(comm, LocalComm):
+        return LocalCounter(comm, num_counters)
+    from nlogo_sched import SharedCounter
+    return SharedCounter(comm, num_counters)
+
+
+def terminated(signum, frame):
+    # Further signals, from mpirun, run_local or the batch system, must not
+    # interrupt the clean up that exiting starts.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(128 + signum)
+
+
+def local_process(target, comm, rank, args):
+    comm.set_rank(rank)
+    # Clean up when the others are stopped after a failure.
+    signal.signal(signal.SIGTERM, terminated)
+    try:
+        target(comm, *args)
+    finally:
+        # multiprocessing ends the process with os._exit, which skips the
+        # atexit handlers, such as the removal of the scratch directory.
+        atexit._run_exitfuncs()
+
+
+def run_local(target, processes, args = ()):
+    """
+    Run target(comm, *args) in a number of local processes, like mpirun
+    does for MPI programs.  If a process fails the others are terminated.
+
+    Parameters
+    ----------
+
+    target : function
+       Function run by every process.
+
+    processes : int
+       Number of processes.
+
+    args : tuple, optional
+       Further arguments of target.
+
+    Returns
+    -------
+
+    exit_code : int
+       0 if all processes succeeded, else the exit code of the first
+       process that failed.
+    """
+    comm = LocalComm(processes)
+    # Stopping this process stops the others too.
+    signal.signal(signal.SIGTERM, terminated)
+    procs = [multiprocessing.Process(target = local_process, args = (target, comm, rank, args)) \
+                 for rank in range(processes)]
+    for proc in procs:
+        proc.start()
+    exit_code = 0
+    stopped = []
+    try:
+        running = list(procs)
+        while len(running) > 0:
+            for proc in list(running):
+                proc.join(0.1)
+                if proc.exitcode == None:
+                    continue
+                running.remove(proc)
+                if proc.exitcode != 0 and exit_code == 0:
+                    exit_code = proc.exitcode if proc.exitcode > 0 else 1
+                    sys.stderr.write("Process {0} failed with exit code {1}, stopping the others.\n"\
+                                         .format(procs.index(proc), proc.exitcode))
+                    for other in running:
+                        other.terminate()
+                        stopped.append(other)
+    finally:
+        # Processes are only signalled once, so none is interrupted while
+        # it stops its runs.
+        for proc in procs:
+            if proc.is_alive():
+                if proc not in stopped:
+                    proc.terminate()
+                proc.join()
+    return exit_code
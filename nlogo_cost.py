@@ -0,0 +1,277 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Estimates of the run time of individual combinations, used to start the
+most expensive runs first.  An estimate comes either from an expression over
+the variables of the experiment given by the user, or from the NetLogo run
+times recorded in the trace files of an earlier job (--trace).
+
+The model learnt from traces is multiplicative: the log of the run time is
+the experiment's mean plus one effect for the value of each variable, the
+mean deviation of the runs that had that value.  Values not seen in the
+traces have no effect.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import re
+import ast
+import glob
+import json
+import math
+import numbers
+from nlogo_io import planCombination
+from nlogo_results import parse_value
+
+# Functions that can be called in a cost expression.
+COST_FUNCTIONS = {"abs" : abs, "min" : min, "max" : max,
+                  "log" : math.log, "exp" : math.exp, "sqrt" : math.sqrt}
+
+COST_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+              ast.Call, ast.Name, ast.Load, ast.operator, ast.unaryop, ast.boolop, ast.cmpop) + \
+              tuple([getattr(ast, name) for name in ["Num", "Str", "Constant"] if hasattr(ast, name)])
+
+
+def python_name(variable_name):
+    # NetLogo names like initial-number-sheep are written initial_number_sheep.
+    return re.sub(r"\W", "_", variable_name)
+
+
+def is_integer(value):
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
+def variable_value(text):
+    # Values as they appear in the setup file, true/false counting as 1/0.
+    if text == "true":
+        return 1.0
+    if text == "false":
+        return 0.0
+    value = parse_value(text)
+    if isinstance(value, str) and len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+def compile_cost_expression(expression):
+    """
+    Compile a cost expression such as "initial_number_sheep * max_steps".
+    Only arithmetic, comparisons, conditional expressions, numbers, strings,
+    the varied variables of the experiment and the functions in COST_FUNCTIONS are
+    allowed.  Characters in variable names that are not allowed in Python
+    names are written as underscores.
+
+    Parameters
+    ----------
+
+    expression : str
+       The expression.
+
+    Returns
+    -------
+
+    code : code object
+       Evaluated by expression_cost.
+
+    Raises
+    ------
+
+    ValueError
+       If the expression is not valid or uses anything not allowed.
+    """
+    try:
+        tree = ast.parse(expression, mode = "eval")
+    except SyntaxError as se:
+        raise ValueError("Invalid cost expression '{0}': {1}".format(expression, se.msg))
+    for node in ast.walk(tree):
+        if not isinstance(node, COST_NODES):
+            raise ValueError("'{0}' is not allowed in a cost expression".format(type(node).__name__))
+        if isinstance(node, ast.Call) and \
+                (not isinstance(node.func, ast.Name) or node.func.id not in COST_FUNCTIONS or len(node.keywords) > 0):
+            raise ValueError("Only the functions {0} can be called in a cost expression".format(", ".join(sorted(COST_FUNCTIONS))))
+        # Integers become floats, so a power too large overflows at once
+        # instead of computing a huge integer.
+        field = "value" if hasattr(ast, "Constant") and isinstance(node, ast.Constant) else "n"
+        if is_integer(getattr(node, field, None)):
+            setattr(node, field, float(getattr(node, field)))
+    return compile(tree, "<cost_expr>", "eval")
+
+
+def expression_cost(code, combination):
+    """
+    Evaluate a compiled cost expression for one combination.
+
+    Parameters
+    ----------
+
+    code : code object
+       As given by compile_cost_expression.
+
+    combination : list
+       List of (variable_name, value) tuples.
+
+    Returns
+    -------
+
+    cost : float
+    """
+    namespace = dict(COST_FUNCTIONS)
+    for name, value in combination:
+        value = variable_value(value)
+        namespace[python_name(name)] = float(value) if is_integer(value) else value
+    try:
+        return float(eval(code, {"__builtins__" : {}}, namespace))
+    except NameError as ne:
+        raise ValueError("Unknown variable in cost expression: {0}".format(ne))
+    except Exception as e:
+        # Division by zero, overflow, a function given a string, ...
+        raise ValueError("Cannot evaluate the cost expression for {0}: {1}".format(
+                ", ".join(["{0}={1}".format(name, value) for name, value in combination]), e))
+
+
+def read_trace_events(fname):
+    # Trace files have one event per line. A file from a job that was
+    # killed lacks the closing bracket, so the lines are parsed one by one.
+    events = []
+    with open(fname) as fin:
+        for line in fin:
+            line = line.strip().rstrip(",")
+            if line.startswith("{"):
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass
+    return events
+
+
+def learn_cost_model(trace_files, plan):
+    """
+    Learn per variable value effects on the run time from trace files.
+
+    Parameters
+    ----------
+
+    trace_files : list
+       Trace files (procNNNN.trace.json) of an earlier job of the same
+       experiments.
+
+    plan : list
+       Experiment plan as given by nlogo_io.experimentPlan.
+
+    Returns
+    -------
+
+    model : dict
+       For every experiment (by safe name) with timings, a dictionary with
+       the "mean" log run time and the "effects", a list with one
+       {value: effect} dictionary per variable.
+    """
+    by_name = dict([(exp_plan["safe_name"], exp_plan) for exp_plan in plan])
+    samples = {}
+    for fname in trace_files:
+        for event in read_trace_events(fname):
+            args = event.get("args", {})
+            exp_plan = by_name.get(args.get("experiment"))
+            if event.get("name") != "netlogo" or exp_plan == None or args.get("exit_code", 0) != 0:
+                continue
+            runs = max(1, args.get("runs", 1))
+            seconds = max(event.get("dur", 0), 1) / 1e6 / runs
+            for exp_i in range(args["run"], min(args["run"] + runs, exp_plan["num_runs"])):
+                samples.setdefault(exp_plan["safe_name"], []).append((exp_i, math.log(seconds)))
+
+    model = {}
+    for name in samples:
+        mean = sum([log_t for exp_i, log_t in samples[name]]) / len(samples[name])
+        sums = [{} for value_tuple in by_name[name]["value_tuples"]]
+        for exp_i, log_t in samples[name]:
+            for var_i, (var_name, value) in enumerate(planCombination(by_name[name], exp_i)):
+                (total, count) = sums[var_i].get(value, (0.0, 0))
+                sums[var_i][value] = (total + log_t - mean, count + 1)
+        effects = [dict([(value, total / count) for value, (total, count) in var_sums.items()]) \
+                       for var_sums in sums]
+        model[name] = {"mean" : mean, "effects" : effects}
+    return model
+
+
+def model_cost(model, experiment_name, combination):
+    """
+    Predicted run time of one combination.
+
+    Parameters
+    ----------
+
+    model : dict
+       As given by learn_cost_model.
+
+    experiment_name : str
+       Safe name of the experiment.
+
+    combination : list
+       List of (variable_name, value) tuples.
+
+    Returns
+    -------
+
+    cost : float
+       Predicted seconds, or 1.0 for experiments without timings.
+    """
+    exp_model = model.get(experiment_name)
+    if exp_model == None:
+        return 1.0
+    log_t = exp_model["mean"]
+    for var_i, (name, value) in enumerate(combination):
+        if var_i < len(exp_model["effects"]):
+            log_t += exp_model["effects"][var_i].get(value, 0.0)
+    return math.exp(log_t)
+
+
+class CostModel(object):
+    """
+    Run time estimates of combinations, from a cost expression if one is
+    given, else from a model learnt from traces.
+
+    Parameters
+    ----------
+
+    expression : str or None
+       Cost expression, see compile_cost_expression.
+
+    model : dict or None
+       As given by learn_cost_model.
+
+    experiments : list, optional
+       Safe names of the experiments the expression applies to. All other
+       experiments have the same cost for every combination. If None the
+       expression applies to all experiments.
+    """
+
+    def __init__(self, expression = None, model = None, experiments = None):
+        self.code = None
+        self.model = model if model != None else {}
+        self.experiments = experiments
+        if expression != None:
+            self.code = compile_cost_expression(expression)
+
+    def cost(self, experiment_name, combination):
+        if self.code != None:
+            if self.experiments != None and experiment_name not in self.experiments:
+                return 1.0
+            return expression_cost(self.code, combination)
+        return model_cost(self.model, experiment_name, combination)
@@ -28,8 +28,16 @@ __version__ = "0.3"
 
 
 import os.path
+import sys
 
 from string import Formatter
+from xml.dom import minidom
+from xml.sax.saxutils import escape
+from nlogo_sample import make_design, design_point
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 
 
@@ -60,6 +68,130 @@ def expandValueSets( value_tuples):
             for vlist in expandValueSets(value_tuples[1:]):
                 yield [(value_tuples[0][0], val)] + vlist
 
+def numCombinations(value_tuples):
+    """
+    Number of combinations expandValueSets would give.
+
+    Parameters
+    ----------
+
+    value_tuples : list
+       List of tuples on the form (variable_name, [value_0, ... , value_N]).
+
+    Returns
+    -------
+
+    n : int
+       Product of the number of values of all variables.
+    """
+    n = 1
+    for name, values in value_tuples:
+        n *= len(values)
+    return n
+
+def combinationAt(value_tuples, index):
+    """
+    Give combination number index of the variable values directly, without
+    generating the preceding ones. The order is the same as that of
+    expandValueSets, that is the combination is index written as a
+    mixed-radix number where the last variable varies fastest.
+
+    Parameters
+    ----------
+
+    value_tuples : list
+       List of tuples on the form (variable_name, [value_0, ... , value_N]).
+
+    index : int
+       Combination number, 0 <= index < numCombinations(value_tuples).
+
+    Returns
+    -------
+
+    combination : list
+       List of (variable_name, value) tuples, as yielded by expandValueSets.
+    """
+    combination = []
+    for name, values in reversed(value_tuples):
+        index, digit = divmod(index, len(values))
+        combination.append((name, values[digit]))
+    combination.reverse()
+    return combination
+
+def planCombination(exp_plan, index):
+    """
+    Give run number index of an experiment, a combination of its value sets
+    or a point of its sampling design.
+
+    Parameters
+    ----------
+
+    exp_plan : dict
+       Experiment as given by experimentPlan.
+
+    index : int
+       Run number, 0 <= index < exp_plan["num_runs"].
+
+    Returns
+    -------
+
+    combination : list
+       List of (variable_name, value) tuples.
+    """
+    if exp_plan.get("design") != None:
+        return design_point(exp_plan["design"], index)
+    return combinationAt(exp_plan["value_tuples"], index)
+
+def iterValueSets(value_tuples, start = 0, stop = None, step = 1):
+    """
+    Generator giving the combinations start, start+step, ... (up to but not
+    including stop) in the order of expandValueSets. Only the current
+    combination is kept in memory.
+
+    Parameters
+    ----------
+
+    value_tuples : list
+       List of tuples on the form (variable_name, [value_0, ... , value_N]).
+
+    start : int, optional
+       First combination number.
+
+    stop : int, optional
+       Combination number to stop before. Defaults to all combinations.
+
+    step : int, optional
+       Stride between combination numbers.
+
+    Yields
+    ------
+       : List of (variable_name, value) tuples for each combination.
+    """
+    if stop == None:
+        stop = numCombinations(value_tuples)
+    if start >= stop:
+        return
+    radices = [len(values) for name, values in value_tuples]
+    # Digits of the current index and of the step, last variable first.
+    digits = []
+    step_digits = []
+    index = start
+    remaining_step = step
+    for radix in reversed(radices):
+        index, digit = divmod(index, radix)
+        digits.append(digit)
+        remaining_step, digit = divmod(remaining_step, radix)
+        step_digits.append(digit)
+    n = len(radices)
+    for index in range(start, stop, step):
+        yield [(value_tuples[i][0], value_tuples[i][1][digits[n - 1 - i]]) \
+                   for i in range(n)]
+        # Mixed-radix addition of the step.
+        carry = 0
+        for d in range(n):
+            total = digits[d] + step_digits[d] + carry
+            carry, digits[d] = divmod(total, radices[n - 1 - d])
+
 def steppedValueSet(first, step, last):
     """
     Tries to mimic the functionality of BehaviorSpace SteppedValueSet class.
@@ -99,6 +231,167 @@ def steppedValueSet(first, step, last):
     return values
 
 
+def experimentsXML(nlogo_text):
+    """
+    Extract the behavior space experiments of a .nlogo file.
+
+    Parameters
+    ----------
+
+    nlogo_text : str
+       Full text of the .nlogo file.
+
+    Returns
+    -------
+
+    experiments_xml : str
+       The experiments sections of the file as an xml string that can be
+       parsed.
+    """
+    # An .nlogo file contain a lot of non-xml data
+    # this is a hack to ignore those lines and
+    # read the experiments data into an xml string
+    # that can be parsed.
+    experiments_xml = ""
+    alist = nlogo_text.split("<experiments>")
+    for elem in alist[1:]:
+        blist = elem.split("</experiments>")
+        experiments_xml += "<experiments>{0}</experiments>\n".format(blist[0])
+    return experiments_xml
+
+def experimentPlan(experiments_xml, experiment_names = None, repetitions_per_run = None, sampling = None):
+    """
+    Build a compact, picklable description of the experiments to run. This
+    is all the information needed to generate the individual runs, so it can
+    be produced once and shared instead of parsing the model file everywhere.
+
+    Parameters
+    ----------
+
+    experiments_xml : str
+       Experiments xml as given by experimentsXML.
+
+    experiment_names : list, optional
+       Names of the experiments to include. All experiments if None.
+
+    repetitions_per_run : int, optional
+       If set and > 0 the repetitions of each experiment are split into runs
+       of this many repetitions each.
+
+    sampling : dict, optional
+       If given, the runs of each experiment are the points of a sampling
+       design over its value sets instead of all their combinations. The
+       keys are method, samples and seed, see nlogo_sample.make_design.
+
+    Returns
+    -------
+
+    plan : list
+       One dictionary per experiment, in file order, with the keys
+       name - Name of the experiment in the model file.
+       safe_name - Name usable in file names and output rows.
+       value_tuples - List of (variable_name, [values]) of the varied variables.
+       reps_in_experiment - Repetitions done by each NetLogo run.
+       reps_of_experiment - Number of runs each combination is split into.
+       num_runs - Number of combinations (or design points).
+       offset - Global id of the first run of the experiment, the sum of
+                num_runs * reps_of_experiment of the preceding experiments.
+                Repetition block b of combination i has the global id
+                offset + i * reps_of_experiment + b.
+       template - xml of the experiment with the varied value sets removed.
+       design - The sampling design, if sampling is given, else None.
+
+    Raises
+    ------
+
+    ValueError
+       If the sampling design cannot be made.
+    """
+    plan = []
+    original_dom = minidom.parseString(experiments_xml)
+    for orig_experiment in original_dom.getElementsByTagName("experiment"):
+        if experiment_names != None \
+                and orig_experiment.getAttribute("name") not in experiment_names:
+            continue
+        experiment = orig_experiment.cloneNode(deep = True)
+
+        # Store tuples of varying variables and their possible values.
+        value_tuples = []
+        # And their ranges, for sampling.
+        value_ranges = []
+
+        # Number of repetieitons.
+        # In the experiment.
+        # Read original value first. Default is to have all internal.
+        reps_in_experiment = int(experiment.getAttribute("repetitions"))
+        # Repeats of the created experiment.
+        reps_of_experiment = 1
+        # Check if we should split experiments. An unset switch or value <= 0 means no splitting.
+        if repetitions_per_run != None and repetitions_per_run > 0:
+            original_reps = reps_in_experiment
+            if original_reps >= repetitions_per_run:
+                reps_in_experiment = int(repetitions_per_run)
+                reps_of_experiment = int(original_reps / reps_in_experiment)
+                if(original_reps % reps_in_experiment != 0):
+                    sys.stderr.write("Warning: Number of repetitions per experiment does not divide the number of repetitions in the nlogo file. New number of repetitions is {0} ({1} per experiment in {2} unique script(s)). Original number of repetitions per experiment: {3}.\n"\
+                                         .format((reps_in_experiment*reps_of_experiment),
+                                                 reps_in_experiment,
+                                                 reps_of_experiment,
+                                                 original_reps))
+
+        # Handle enumeratedValueSets
+        for evs in experiment.getElementsByTagName("enumeratedValueSet"):
+            values = evs.getElementsByTagName("value")
+            # If an enumeratedValueSet has more than a single value, it should
+            # be included in the value expansion tuples.
+            if len(values) > 1:
+                # A tuple is the name of the variable and
+                # A list of all the values.
+                value_tuples.append((evs.getAttribute("variable"),
+                                     [val.getAttribute("value") \
+                                          for val in values]
+                                     )
+                                    )
+                value_ranges.append(("values",) + value_tuples[-1])
+                # Remove the node.
+                experiment.removeChild(evs)
+
+        # Handle steppedValueSet
+        for svs in experiment.getElementsByTagName("steppedValueSet"):
+            first = float(svs.getAttribute("first"))
+            last = float(svs.getAttribute("last"))
+            step = float(svs.getAttribute("step"))
+            # Add values to the tuple list.
+            value_tuples.append((svs.getAttribute("variable"),
+                                 steppedValueSet(first, step, last)
+                                 )
+                                )
+            value_ranges.append(("range", svs.getAttribute("variable"), first, last,
+                                 first == int(first) and step == int(step)))
+            # Remove node.
+            experiment.removeChild(svs)
+
+        design = None
+        num_runs = numCombinations(value_tuples)
+        if sampling != None:
+            design = make_design(sampling["method"], sampling["samples"], sampling["seed"], value_ranges)
+            num_runs = sampling["samples"]
+
+        plan.append({
+                "name" : experiment.getAttribute("name"),
+                "safe_name" : experiment.getAttribute("name").replace(' ', '_').replace('/', '-').replace('\\','-'),
+                "value_tuples" : value_tuples,
+                "reps_in_experiment" : reps_in_experiment,
+                "reps_of_experiment" : reps_of_experiment,
+                "num_runs" : num_runs,
+                "offset" : 0,
+                "template" : experiment.toxml(),
+                "design" : design
+                })
+    for exp_i in range(1, len(plan)):
+        plan[exp_i]["offset"] = plan[exp_i - 1]["offset"] + plan[exp_i - 1]["num_runs"] * plan[exp_i - 1]["reps_of_experiment"]
+    return plan
+
 def saveExperimentToXMLFile(experiment, xmlfile):
     """
     Given an experiment XML node saves it to a file wrapped in an experiments tag.
@@ -122,6 +415,112 @@ def saveExperimentToXMLFile(experiment, xmlfile):
     xmlfile.write("""</experiments>\n""")
     
 
+def compileExperimentTemplate(template):
+    """
+    Render an experiment (with the varied value sets removed) once into a
+    setup document with slots for the repetitions, a seed command at the
+    start of the setup commands and the varied values, so that the setup for
+    an individual run is produced with string formatting alone.
+
+    Parameters
+    ----------
+
+    template : str
+       xml of the experiment node, as the template entry of experimentPlan.
+
+    Returns
+    -------
+
+    compiled : tuple
+       Pieces of the setup document, for use with renderExperiment.
+    """
+    experiment = minidom.parseString(template).documentElement
+    experiment.setAttribute("repetitions", "@REPETITIONS@")
+    document = experiment.ownerDocument
+    setups = experiment.getElementsByTagName("setup")
+    if len(setups) > 0:
+        setup = setups[0]
+    else:
+        setup = experiment.insertBefore(document.createElement("setup"), experiment.firstChild)
+    setup.insertBefore(document.createTextNode("@SEED@"), setup.firstChild)
+    experiment.appendChild(document.createComment("@VALUES@"))
+    xmlstr = StringIO()
+    saveExperimentToXMLFile(experiment, xmlstr)
+    (head, rest) = xmlstr.getvalue().split('"@REPETITIONS@"', 1)
+    (middle, rest) = rest.split("@SEED@", 1)
+    (setup_rest, tail) = rest.split("<!--@VALUES@-->", 1)
+    return (head + '"', '"' + middle, setup_rest, tail)
+
+def seedCommand(first_seed, combination_stride, repetitions):
+    """
+    NetLogo command seeding the random generator of each run of a setup
+    document from its behaviorspace-run-number, for use with
+    renderExperiment.  The runs of a setup are its combinations in turn,
+    each with its repetitions after each other; repetition j of combination c
+    gets the seed first_seed + c * combination_stride + j (modulo 2^31 - 1,
+    the range NetLogo accepts).
+
+    Parameters
+    ----------
+
+    first_seed : int
+       Seed of the first run.
+
+    combination_stride : int
+       Difference of the seeds of successive combinations.
+
+    repetitions : int
+       Number of repetitions NetLogo does of each combination.
+
+    Returns
+    -------
+
+    command : str
+    """
+    run_i = "(behaviorspace-run-number - 1)"
+    return "random-seed (({0} + (floor ({1} / {2})) * {3} + ({1} mod {2})) mod 2147483647)\n"\
+        .format(first_seed % 2147483647, run_i, repetitions, combination_stride)
+
+def renderExperiment(compiled, combination, repetitions, seed_command = ""):
+    """
+    Produce the setup document for a single run from a compiled template.
+    The result is the same as adding one single valued enumeratedValueSet per
+    variable to the experiment and saving it with saveExperimentToXMLFile.
+
+    Parameters
+    ----------
+
+    compiled : tuple
+       Template as given by compileExperimentTemplate.
+
+    combination : list
+       List of (variable_name, value) tuples, as yielded by expandValueSets.
+       If value is a list all of its values are given for the variable, and
+       NetLogo will run each of them.
+
+    repetitions : int
+       Number of repetitions NetLogo should do of the run.
+
+    seed_command : str, optional
+       NetLogo command put before the setup commands, see seedCommand.
+
+    Returns
+    -------
+
+    setup_xml : str
+       The setup document.
+    """
+    values = ""
+    for name, value in combination:
+        if not isinstance(value, list):
+            value = [value]
+        values += '<enumeratedValueSet variable="{0}">'.format(escape(name, {'"' : "&quot;"}))
+        for val in value:
+            values += '<value value="{0}"/>'.format(escape(str(val), {'"' : "&quot;"}))
+        values += '</enumeratedValueSet>'
+    return compiled[0] + str(repetitions) + compiled[1] + seed_command + compiled[2] + values + compiled[3]
+
+
 def createScriptFile(script_fp,
                      xmlfile, 
                      nlogofile,
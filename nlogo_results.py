@@ -0,0 +1,521 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Result sinks collecting the output rows of the individual runs.  Rows are
+buffered in memory and written in large appends, either by every process to
+its own file or by one writer process per node that receives the rows of the
+other processes on the node over MPI.  The columnar sink instead writes typed
+columns to NumPy .npz or Parquet files, one column per swept parameter and
+per column of the NetLogo table.
+
+Compressed csv output (procNNNN.csv.gz) is written in blocks, one gzip member
+per write, which together are an ordinary gzip file.  A sidecar index
+(procNNNN.csv.gz.idx) gives the byte offset and length of the block of every
+experiment and run number, so the rows of a run are found by decompressing
+one block.  Blocks are indexed after they have been written, and journaled
+after they have been indexed, so readers skip a block that a killed job left
+without its complete index and a restart runs it again.
+
+Sinks also keep the completion journal used for restarts.  Every writer
+appends the global ids of the combinations whose rows it has written to its
+own procNNNN.done file, as 8 byte integers.  On restart all journals are read
+into a bitmap of the finished combinations, regardless of how many processes
+wrote them.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import os
+import sys
+import csv
+import glob
+import time
+import gzip
+import struct
+import hashlib
+from io import BytesIO
+
+TAG_ROWS = 11
+TAG_DONE = 12
+
+
+class ResultSink(object):
+    """
+    Buffers output rows and appends them to a file when enough rows have
+    been collected, when enough time has passed, or when flushed.  Rows are
+    only written when all combinations of a unit are complete, together with
+    the journal of the completed combinations, so a killed job never leaves
+    rows of combinations that are not journaled.
+
+    Parameters
+    ----------
+
+    filename : str
+       File the rows are appended to.
+
+    max_rows : int, optional
+       Number of buffered rows that triggers a write, once the unit being
+       written is complete.
+
+    max_seconds : float, optional
+       Time since the last write that triggers a write.
+
+    journal : CompletionJournal, optional
+       Journal the ids given to complete_all() are added to once their rows
+       have been written.
+
+    compressed : bool, optional
+       Write the rows as indexed gzip blocks, see the module documentation.
+    """
+
+    def __init__(self, filename, max_rows = 1000, max_seconds = 60.0, journal = None, compressed = False):
+        self.filename = filename
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.journal = journal
+        self.compressed = compressed
+        self.rows = []
+        self.completed = []
+        self.last_flush = time.time()
+
+    def write(self, line):
+        self.rows.append(line)
+
+    def complete_all(self, global_ids):
+        # All rows of the combinations of a unit have been given to write.
+        # Rows are only written once every combination of the unit is in.
+        self.completed.extend(global_ids)
+        if len(self.rows) >= self.max_rows \
+                or time.time() - self.last_flush >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self.write_rows(self.rows)
+            self.rows = []
+        if self.journal != None and len(self.completed) > 0:
+            self.journal.append(self.completed)
+        self.completed = []
+        self.last_flush = time.time()
+
+    def write_rows(self, rows):
+        try:
+            if self.compressed:
+                write_block(self.filename, rows)
+            else:
+                with open(self.filename, "a") as fout:
+                    fout.write("".join(rows))
+        except IOError as ioe:
+            sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
+            sys.exit(ioe.errno)
+
+    def close(self):
+        self.flush()
+
+
+class NodeResultSink(ResultSink):
+    """
+    Result sink where one process per node (the leader, rank 0 of the node
+    communicator) writes the rows of all processes on the node to its file.
+    The other processes send their buffered rows to the leader with
+    non-blocking sends.  The leader picks up received rows whenever it
+    writes itself, so no process waits for another while runs are going on.
+
+    close() must be called by all processes of the node.
+
+    Parameters
+    ----------
+
+    node_comm : MPI communicator
+       Communicator of the processes sharing the node.
+
+    filename : str
+       File the leader writes to. Ignored on the other processes.
+
+    max_rows : int, optional
+       Number of buffered rows that triggers a write or send.
+
+    max_seconds : float, optional
+       Time since the last write that triggers a write or send.
+
+    journal : CompletionJournal, optional
+       Journal of the leader. Ignored on the other processes.
+
+    compressed : bool, optional
+       Write the rows as indexed gzip blocks.
+    """
+
+    def __init__(self, node_comm, filename, max_rows = 1000, max_seconds = 60.0, journal = None, compressed = False):
+        ResultSink.__init__(self, filename, max_rows, max_seconds, journal, compressed)
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.node_comm = node_comm
+        self.is_leader = node_comm.Get_rank() == 0
+        self.requests = []
+
+    def flush(self):
+        if self.is_leader:
+            self.receive_pending()
+            ResultSink.flush(self)
+        else:
+            if len(self.rows) > 0 or len(self.completed) > 0:
+                self.requests.append(self.node_comm.isend((self.rows, self.completed), dest = 0, tag = TAG_ROWS))
+                self.rows = []
+                self.completed = []
+            self.last_flush = time.time()
+
+    def receive_pending(self):
+        status = self.MPI.Status()
+        while self.node_comm.iprobe(source = self.MPI.ANY_SOURCE, tag = TAG_ROWS, status = status):
+            (rows, completed) = self.node_comm.recv(source = status.Get_source(), tag = TAG_ROWS)
+            self.rows += rows
+            self.completed += completed
+
+    def close(self):
+        self.flush()
+        if self.is_leader:
+            # Keep receiving until every other process has said it is done.
+            # Messages from one process arrive in order, so its rows are
+            # all in before its done message.
+            done = 0
+            status = self.MPI.Status()
+            while done < self.node_comm.Get_size() - 1:
+                msg = self.node_comm.recv(source = self.MPI.ANY_SOURCE, tag = self.MPI.ANY_TAG, status = status)
+                if status.Get_tag() == TAG_DONE:
+                    done += 1
+                else:
+                    self.rows += msg[0]
+                    self.completed += msg[1]
+                    if len(self.rows) >= self.max_rows:
+                        ResultSink.flush(self)
+            ResultSink.flush(self)
+        else:
+            self.requests.append(self.node_comm.isend(None, dest = 0, tag = TAG_DONE))
+            self.MPI.Request.waitall(self.requests)
+            self.requests = []
+
+
+def write_block(filename, rows):
+    """
+    Append rows to a compressed csv file as one gzip member, and the
+    experiment and run number of the rows, with the offset and length of the
+    member and its number of runs, to its index filename.idx.
+
+    Parameters
+    ----------
+
+    filename : str
+
+    rows : list
+       Lines starting with experiment,run_number,
+    """
+    data = "".join(rows)
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj = buf, mode = "wb", mtime = 0) as gzf:
+        gzf.write(data)
+    with open(filename, "ab") as fout:
+        fout.seek(0, os.SEEK_END)
+        offset = fout.tell()
+        fout.write(buf.getvalue())
+        length = fout.tell() - offset
+    # One index line per run of the block, in the order of first appearance.
+    runs = []
+    seen = set()
+    for row in rows:
+        run = tuple(row.split(",", 2)[:2])
+        if run not in seen:
+            seen.add(run)
+            runs.append(run)
+    with open(filename + ".idx", "a") as fout:
+        fout.write("".join(["{0},{1},{2},{3},{4}\n".format(experiment, run_number, offset, length, len(runs)) \
+                                for experiment, run_number in runs]))
+
+
+COLUMNAR_FORMATS = ["npz", "parquet"]
+
+
+def parse_value(text):
+    # Numbers become floats, anything else is kept as a string.
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return text
+
+
+def parse_table_line(line):
+    return next(csv.reader([line.rstrip("\r\n")]))
+
+
+class ColumnarSink(object):
+    """
+    Buffers results as typed columns and writes them per experiment, as a
+    series of NumPy .npz or Parquet part files, one per write.  The
+    experiment name is part of the file name instead of being repeated on
+    every row.
+
+    Columns are run_number, one per varied variable of the experiment, and
+    one per column of the NetLogo table except those two. The type of each
+    column (float or string) is decided from the rows of each part, so a
+    column may be a string column in some parts and float in others.
+
+    Rows are only written when a unit is complete.  Every part holds the
+    global ids of the combinations whose rows it has (global_ids in a npz
+    file, in the metadata of a Parquet file), which are journaled right
+    after it is written.  A part whose ids are not all journaled, left by a
+    killed job, is not collected, and its combinations are run again.
+
+    Parameters
+    ----------
+
+    basename : str
+       Path and file name prefix, e.g. output_dir/proc0000.  Files are named
+       basename_<experiment>_partNNNNN.npz (or .parquet).
+
+    output_format : str
+       One of COLUMNAR_FORMATS.
+
+    max_rows : int, optional
+       Number of buffered rows that triggers a write, once the unit being
+       written is complete.
+
+    max_seconds : float, optional
+       Time since the last write that triggers a write.
+
+    journal : CompletionJournal, optional
+       Journal the ids given to complete_all() are added to once their rows are
+       safely on disk.
+    """
+
+    def __init__(self, basename, output_format, max_rows = 1000, max_seconds = 60.0, journal = None):
+        try:
+            import numpy
+            self.np = numpy
+            if output_format == "parquet":
+                import pyarrow
+                import pyarrow.parquet
+                self.pa = pyarrow
+        except ImportError as ie:
+            sys.stderr.write("The {0} output format requires a module that is not installed: {1}\n".format(output_format, ie))
+            sys.exit(1)
+        self.basename = basename
+        self.output_format = output_format
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.journal = journal
+        self.completed = []
+        self.experiments = {}
+        # Experiments given rows since the last complete_all.
+        self.unit_experiments = set()
+        self.num_rows = 0
+        self.last_flush = time.time()
+
+    def write(self, experiment_name, exp_i, combination, header_lines, line, rep = None):
+        """
+        Add a row of the result of a run.
+
+        Parameters
+        ----------
+
+        experiment_name : str
+           Name of the experiment.
+
+        exp_i : int
+           Combination (run) number.
+
+        combination : list
+           List of (variable_name, value) tuples of the run.
+
+        header_lines : list
+           The first seven lines of the NetLogo table of the run, the last
+           one naming the columns.
+
+        line : str
+           A data row of the NetLogo table, or None if the run gave no rows.
+
+        rep : int, optional
+           Repetition number of the row, when the repetitions of the
+           experiment are split into several runs.
+        """
+        state = self.experiments.get(experiment_name)
+        if state == None:
+            param_names = [name for name, value in combination]
+            table_columns = []
+            if len(header_lines) > 6:
+                for col_i, name in enumerate(parse_table_line(header_lines[6])):
+                    if name != "[run number]" and name not in param_names:
+                        table_columns.append((col_i, name))
+            state = {"columns" : ["run_number"] + (["rep"] if rep != None else []) + param_names + \
+                         [name for col_i, name in table_columns],
+                     "table_columns" : table_columns,
+                     "rows" : [],
+                     "global_ids" : [],
+                     "part" : 0}
+            self.experiments[experiment_name] = state
+        if line != None:
+            fields = parse_table_line(line)
+            table_values = [parse_value(fields[col_i]) if col_i < len(fields) else None \
+                                for col_i, name in state["table_columns"]]
+        else:
+            table_values = [None] * len(state["table_columns"])
+        state["rows"].append([exp_i] + ([rep] if rep != None else []) + \
+                                 [parse_value(value) for name, value in combination] + table_values)
+        self.unit_experiments.add(experiment_name)
+        self.num_rows += 1
+
+    def complete_all(self, global_ids):
+        # The ids go with the parts of the experiments the unit wrote to.
+        for experiment_name in self.unit_experiments:
+            self.experiments[experiment_name]["global_ids"].extend(global_ids)
+        self.unit_experiments = set()
+        self.completed.extend(global_ids)
+        if self.num_rows >= self.max_rows \
+                or time.time() - self.last_flush >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        for experiment_name in self.experiments:
+            state = self.experiments[experiment_name]
+            if len(state["rows"]) > 0:
+                self.write_columns(experiment_name, state)
+                state["rows"] = []
+                state["global_ids"] = []
+        self.num_rows = 0
+        self.last_flush = time.time()
+        self.journal_completed()
+
+    def journal_completed(self):
+        if self.journal != None and len(self.completed) > 0:
+            self.journal.append(self.completed)
+        self.completed = []
+
+    def write_columns(self, experiment_name, state):
+        columns = list(zip(*state["rows"]))
+        num_ints = 2 if state["columns"][1:2] == ["rep"] else 1
+        types = ["int"] * num_ints + ["float" if all([isinstance(val, float) or val == None for val in column]) else "str" \
+                                          for column in columns[num_ints:]]
+        arrays = []
+        for column, col_type in zip(columns, types):
+            if col_type == "int":
+                arrays.append(self.np.array(column, dtype = self.np.int64))
+            elif col_type == "float":
+                arrays.append(self.np.array([val if isinstance(val, float) else float("nan") for val in column], dtype = self.np.float64))
+            else:
+                arrays.append(self.np.array(["" if val == None else str(val) for val in column]))
+        # Parts left by an earlier, restarted, job are kept.
+        fname = "{0}_{1}_part{2}.{3}".format(self.basename, experiment_name, str(state["part"]).zfill(5), self.output_format)
+        while os.path.exists(fname):
+            state["part"] += 1
+            fname = "{0}_{1}_part{2}.{3}".format(self.basename, experiment_name, str(state["part"]).zfill(5), self.output_format)
+        state["part"] += 1
+        # Written under a temporary name and renamed, so a killed job never
+        # leaves a part cut short.
+        tmp_name = fname + ".tmp"
+        if self.output_format == "npz":
+            with open(tmp_name, "wb") as fout:
+                self.np.savez(fout, columns = self.np.array(state["columns"]),
+                              global_ids = self.np.array(state["global_ids"], dtype = self.np.int64),
+                              **dict([("c" + str(i), arr) for i, arr in enumerate(arrays)]))
+        else:
+            table = self.pa.Table.from_arrays([self.pa.array(arr) for arr in arrays], names = state["columns"])
+            table = table.replace_schema_metadata({"global_ids" : ",".join([str(global_id) for global_id in state["global_ids"]])})
+            self.pa.parquet.write_table(table, tmp_name)
+        os.rename(tmp_name, fname)
+
+    def close(self):
+        self.flush()
+
+
+class CompletionJournal(object):
+    """
+    Append-only record of finished combinations, identified by their global
+    id (see the offset of nlogo_io.experimentPlan).
+
+    Parameters
+    ----------
+
+    filename : str
+       Journal file of this writer, normally procNNNN.done.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def append(self, global_ids):
+        try:
+            with open(self.filename, "ab") as fout:
+                fout.write(struct.pack("<{0}q".format(len(global_ids)), *global_ids))
+        except IOError as ioe:
+            sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
+            sys.exit(ioe.errno)
+
+
+def read_journals(output_dir, num_ids):
+    """
+    Read all procNNNN.done journals in a directory into a bitmap.
+
+    Parameters
+    ----------
+
+    output_dir : str
+       Directory holding the journals.
+
+    num_ids : int
+       Total number of global ids in the study.
+
+    Returns
+    -------
+
+    (bitmap, num_done) : tuple
+       bytearray with bit i set if id i is finished, and the number of
+       finished ids.
+    """
+    bitmap = bytearray((num_ids + 7) // 8)
+    num_done = 0
+    for fname in glob.glob(os.path.join(output_dir, "proc*.done")):
+        with open(fname, "rb") as fin:
+            data = fin.read()
+        # A record cut short by a killed job is ignored.
+        count = len(data) // 8
+        for global_id in struct.unpack("<{0}q".format(count), data[:count * 8]):
+            if global_id < num_ids and not bitmap[global_id >> 3] & (1 << (global_id & 7)):
+                bitmap[global_id >> 3] |= 1 << (global_id & 7)
+                num_done += 1
+    return (bitmap, num_done)
+
+
+def is_done(bitmap, global_id):
+    return bitmap != None and bitmap[global_id >> 3] & (1 << (global_id & 7)) != 0
+
+
+def study_signature(plan, seed = None):
+    """
+    Signature of the global id space of a plan, and the seed of its runs if
+    they have one, stored next to the journals so that they are not applied
+    to a different study.
+    """
+    desc = repr([(exp_plan["name"], exp_plan["num_runs"], exp_plan["reps_in_experiment"],
+                  exp_plan["reps_of_experiment"]) + \
+                     ((exp_plan["design"]["method"], exp_plan["design"]["seed"]) if exp_plan.get("design") != None else ()) \
+                     for exp_plan in plan])
+    if seed != None:
+        desc += " seed " + str(seed)
+    return hashlib.sha1(desc.encode("utf-8")).hexdigest()
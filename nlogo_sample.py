@@ -0,0 +1,275 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sampling designs as an alternative to the full factorial expansion of the
+value sets of an experiment.  A design has a fixed number of points, and
+every point is computed directly from its index, like combinationAt, so each
+process generates its own share without the others.
+
+Each varied variable is a dimension of the design.  A steppedValueSet is
+sampled over its range from first to last (rounded to integers if first
+and step are integers), an enumeratedValueSet picks one of its values.  The
+methods are
+
+* lhs - Latin hypercube. In every dimension each of the N strata of the
+  range holds one point, with the strata assigned to the points by a keyed
+  Feistel permutation of the indices.
+* sobol - Sobol low discrepancy sequence (up to MAX_SOBOL_DIMENSIONS
+  variables).  Best with N a power of two.
+* halton - Halton low discrepancy sequence, the radical inverses of the
+  index in the first primes.
+* random - Independent uniform points.
+
+lhs and random depend on the seed; all use a counter based generator, so the
+same seed gives the same design on every machine.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+SAMPLING_METHODS = ["lhs", "sobol", "halton", "random"]
+
+MASK64 = (1 << 64) - 1
+
+# Primitive polynomials (degree s, coefficients a) and initial direction
+# numbers m for the dimensions after the first, from Joe and Kuo's
+# new-joe-kuo-6.21201 table.
+SOBOL_TABLE = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+    (6, 19, [1, 1, 1, 15, 7, 5]),
+    (6, 22, [1, 3, 1, 15, 13, 25]),
+    (6, 25, [1, 1, 5, 5, 19, 61]),
+    ]
+
+MAX_SOBOL_DIMENSIONS = len(SOBOL_TABLE) + 1
+
+SOBOL_BITS = 52
+
+# Direction numbers by number of dimensions, computed when first used.
+SOBOL_DIRECTIONS = {}
+
+PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71,
+          73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131, 137, 139, 149, 151]
+
+
+def splitmix64(x):
+    # A well mixed 64 bit hash of x.
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def hash_words(*words):
+    h = 0
+    for word in words:
+        h = splitmix64(h ^ (word & MASK64))
+    return h
+
+
+def uniform(*words):
+    # A uniform number in [0, 1) determined by the words.
+    return (hash_words(*words) >> 11) / float(1 << 53)
+
+
+def feistel_permute(index, n, key):
+    """
+    Position of index in a pseudo random permutation of range(n), computed
+    without the permutation itself.  A balanced Feistel network permutes
+    the numbers of the smallest even number of bits covering n, and values
+    that fall outside range(n) are mapped again until they are inside (cycle
+    walking).
+
+    Parameters
+    ----------
+
+    index : int
+       0 <= index < n.
+
+    n : int
+       Size of the permutation.
+
+    key : int
+       Selects the permutation.
+
+    Returns
+    -------
+
+    position : int
+    """
+    bits = max(2, (n - 1).bit_length())
+    bits += bits % 2
+    half = bits // 2
+    mask = (1 << half) - 1
+    value = index
+    while True:
+        left = value >> half
+        right = value & mask
+        for round_i in range(4):
+            (left, right) = (right, left ^ (hash_words(key, round_i, right) & mask))
+        value = (left << half) | right
+        if value < n:
+            return value
+
+
+def sobol_directions(dimension):
+    # Direction numbers of a dimension (0 based), scaled to SOBOL_BITS bits.
+    if dimension == 0:
+        return [1 << (SOBOL_BITS - 1 - k) for k in range(SOBOL_BITS)]
+    (s, a, m) = SOBOL_TABLE[dimension - 1]
+    v = [m[k] << (SOBOL_BITS - 1 - k) for k in range(s)]
+    for k in range(s, SOBOL_BITS):
+        value = v[k - s] ^ (v[k - s] >> s)
+        for j in range(1, s):
+            if (a >> (s - 1 - j)) & 1:
+                value ^= v[k - j]
+        v.append(value)
+    return v
+
+
+def sobol_point(index, directions):
+    # Coordinates of Sobol point number index.
+    point = []
+    for v in directions:
+        x = 0
+        bit = 0
+        i = index
+        while i > 0:
+            if i & 1:
+                x ^= v[bit]
+            i >>= 1
+            bit += 1
+        point.append(x / float(1 << SOBOL_BITS))
+    return point
+
+
+def radical_inverse(index, base):
+    result = 0.0
+    f = 1.0 / base
+    while index > 0:
+        (index, digit) = divmod(index, base)
+        result += digit * f
+        f /= base
+    return result
+
+
+def make_design(method, samples, seed, value_ranges):
+    """
+    Description of a sampling design, stored in the experiment plan.
+
+    Parameters
+    ----------
+
+    method : str
+       One of SAMPLING_METHODS.
+
+    samples : int
+       Number of points.
+
+    seed : int
+       Seed of the lhs and random methods.
+
+    value_ranges : list
+       One tuple per varied variable, ("range", name, first, last, integer)
+       for a steppedValueSet and ("values", name, [values]) for an
+       enumeratedValueSet.
+
+    Returns
+    -------
+
+    design : dict
+
+    Raises
+    ------
+
+    ValueError
+       If the method is unknown or cannot handle that many variables.
+    """
+    if method not in SAMPLING_METHODS:
+        raise ValueError("Unknown sampling method '{0}'".format(method))
+    if method == "sobol" and len(value_ranges) > MAX_SOBOL_DIMENSIONS:
+        raise ValueError("sobol sampling supports at most {0} variables, use halton or lhs".format(MAX_SOBOL_DIMENSIONS))
+    if method == "halton" and len(value_ranges) > len(PRIMES):
+        raise ValueError("halton sampling supports at most {0} variables".format(len(PRIMES)))
+    return {"method" : method, "samples" : samples, "seed" : seed, "value_ranges" : value_ranges}
+
+
+def unit_point(design, index):
+    # Point number index of the design in the unit cube.
+    dims = len(design["value_ranges"])
+    method = design["method"]
+    seed = design["seed"]
+    if method == "lhs":
+        n = design["samples"]
+        return [(feistel_permute(index, n, hash_words(seed, dim)) + uniform(seed, dim, index, 1)) / n \
+                    for dim in range(dims)]
+    if method == "sobol":
+        if dims not in SOBOL_DIRECTIONS:
+            SOBOL_DIRECTIONS[dims] = [sobol_directions(dim) for dim in range(dims)]
+        return sobol_point(index, SOBOL_DIRECTIONS[dims])
+    if method == "halton":
+        return [radical_inverse(index + 1, PRIMES[dim]) for dim in range(dims)]
+    return [uniform(seed, dim, index, 2) for dim in range(dims)]
+
+
+def design_point(design, index):
+    """
+    Point number index of a design as variable values.
+
+    Parameters
+    ----------
+
+    design : dict
+       As given by make_design.
+
+    index : int
+       0 <= index < design["samples"].
+
+    Returns
+    -------
+
+    combination : list
+       List of (variable_name, value) tuples, like nlogo_io.combinationAt.
+    """
+    combination = []
+    for u, value_range in zip(unit_point(design, index), design["value_ranges"]):
+        if value_range[0] == "values":
+            values = value_range[2]
+            combination.append((value_range[1], values[min(int(u * len(values)), len(values) - 1)]))
+        else:
+            (kind, name, first, last, integer) = value_range
+            value = first + u * (last - first)
+            if integer:
+                value = int(min(round(value), last))
+            combination.append((name, value))
+    return combination
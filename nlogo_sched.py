@@ -0,0 +1,339 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scheduling of behavior space combinations among the MPI processes.  The
+static schedule hands rank r the combinations r, r+size, ... while the
+dynamic schedule lets ranks pull chunks of combination indices from a shared
+counter until the whole space is done.
+
+With a cost estimate for every unit of work the units are handed out most
+expensive first (longest job first), by the dynamic schedule in chunks of
+similar predicted cost, and the static schedule gives each unit to the
+process with the least predicted work so far (LPT).
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import heapq
+import bisect
+from array import array
+
+# Typecode of the arrays of unit indices and counters. Python 2 has no 'q',
+# its 'l' is 64 bits on the usual 64 bit systems.
+try:
+    array('q')
+    INDEX_TYPECODE = 'q'
+except ValueError:
+    INDEX_TYPECODE = 'l'
+
+# The indices of a number of units without a list of them, on Python 2 too.
+try:
+    index_range = xrange
+except NameError:
+    index_range = range
+
+
+def guided_chunks(num_runs, mpi_size, min_chunk = 1, costs = None):
+    """
+    Split a range of runs into chunks of decreasing size (guided
+    self-scheduling).  Each chunk takes a share of the remaining runs so
+    that large chunks are handed out first and small ones fill in the end.
+
+    Parameters
+    ----------
+
+    num_runs : int
+       Number of runs to split.
+
+    mpi_size : int
+       Number of processes pulling chunks.
+
+    min_chunk : int, optional
+       Smallest chunk size handed out.
+
+    costs : list, optional
+       Predicted cost of each run. If given the share is taken of the
+       remaining cost rather than of the number of runs, so a few expensive
+       runs make a chunk of their own.
+
+    Returns
+    -------
+
+    chunks : list
+       List of (start, stop) tuples covering range(num_runs) in order.
+    """
+    chunks = []
+    start = 0
+    min_chunk = max(1, min_chunk)
+    if costs != None:
+        remaining_cost = float(sum(costs))
+    while start < num_runs:
+        remaining = num_runs - start
+        if costs == None or remaining_cost <= 0:
+            size = max(min_chunk, remaining // (2 * mpi_size))
+            stop = min(num_runs, start + size)
+        else:
+            share = remaining_cost / (2 * mpi_size)
+            stop = start
+            chunk_cost = 0.0
+            while stop < num_runs and (stop - start < min_chunk or chunk_cost + costs[stop] <= share):
+                chunk_cost += costs[stop]
+                stop += 1
+            remaining_cost -= chunk_cost
+        chunks.append((start, stop))
+        start = stop
+    return chunks
+
+
+def order_by_cost(units, costs):
+    """
+    Sort units of work by decreasing predicted cost.  Units of equal cost
+    keep their order.
+
+    Parameters
+    ----------
+
+    units : sequence
+       Unit indices.
+
+    costs : list
+       Predicted cost of each unit.
+
+    Returns
+    -------
+
+    (units, costs) : tuple
+       An array of the unit indices and a list of their costs, most
+       expensive first.
+    """
+    order = sorted(range(len(units)), key = lambda position: -costs[position])
+    return (array(INDEX_TYPECODE, [units[position] for position in order]), [costs[position] for position in order])
+
+
+def lpt_partition(costs, mpi_size, mpi_rank):
+    """
+    Static partition by the longest processing time rule: units are taken
+    most expensive first and each goes to the process with the least
+    predicted work so far.  Every process computes the same partition.
+
+    Parameters
+    ----------
+
+    costs : list
+       Predicted cost of each unit, sorted in decreasing order.
+
+    mpi_size : int
+       Number of processes.
+
+    mpi_rank : int
+       Process to give the units of.
+
+    Returns
+    -------
+
+    positions : array
+       Positions in costs of the units of mpi_rank, most expensive first.
+    """
+    loads = [(0.0, rank) for rank in range(mpi_size)]
+    positions = array(INDEX_TYPECODE)
+    for position, cost in enumerate(costs):
+        (load, rank) = heapq.heappop(loads)
+        if rank == mpi_rank:
+            positions.append(position)
+        heapq.heappush(loads, (load + cost, rank))
+    return positions
+
+
+class SharedCounter(object):
+    """
+    A set of integer counters living in an MPI window on rank 0.  Any rank
+    can atomically fetch and increment a counter without the involvement of
+    rank 0, so there is no coordinator that has to stay responsive.
+
+    Creating and freeing the counter are collective operations.
+
+    Parameters
+    ----------
+
+    comm : MPI communicator
+
+    num_counters : int
+       Number of independent counters, all starting at zero.
+    """
+
+    def __init__(self, comm, num_counters):
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.datatype = MPI.INT64_T if INDEX_TYPECODE == 'q' else MPI.LONG
+        itemsize = self.datatype.Get_size()
+        if comm.Get_rank() == 0:
+            self.win = MPI.Win.Allocate(itemsize * num_counters, itemsize, comm = comm)
+            self.win.Lock(0)
+            self.win.Put([array(INDEX_TYPECODE, [0] * num_counters), self.datatype], 0)
+            self.win.Unlock(0)
+        else:
+            self.win = MPI.Win.Allocate(0, itemsize, comm = comm)
+        comm.Barrier()
+
+    def next(self, counter):
+        one = array(INDEX_TYPECODE, [1])
+        result = array(INDEX_TYPECODE, [0])
+        self.win.Lock(0)
+        self.win.Fetch_and_op([one, self.datatype], [result, self.datatype], 0, counter, self.MPI.SUM)
+        self.win.Unlock(0)
+        return result[0]
+
+    def free(self):
+        self.win.Free()
+
+
+def dynamic_indices(counter, counter_i, chunks):
+    """
+    Generator giving the run indices this process pulled from a shared
+    counter.  Chunks are claimed one at a time, so a fast process comes back
+    for more while a slow one is still busy.
+
+    Parameters
+    ----------
+
+    counter : SharedCounter
+       Counter shared by all processes.
+
+    counter_i : int
+       Which of the counters to use (one per index space).
+
+    chunks : list
+       Chunks as given by guided_chunks, identical on all processes.
+
+    Yields
+    ------
+       : Run indices in increasing order.
+    """
+    while True:
+        chunk_i = counter.next(counter_i)
+        if chunk_i >= len(chunks):
+            return
+        for run_i in range(chunks[chunk_i][0], chunks[chunk_i][1]):
+            yield run_i
+
+
+def num_batches(num_runs, inner_size, batch_size):
+    """
+    Number of batches an experiment is split into when up to batch_size
+    combinations are run by a single NetLogo invocation.  A batch only ever
+    varies the last (fastest varying) variable, so that it can be expressed
+    as one experiment with a single multi valued enumeratedValueSet.
+
+    Parameters
+    ----------
+
+    num_runs : int
+       Number of combinations in the experiment.
+
+    inner_size : int
+       Number of values of the last varied variable (1 if none is varied).
+
+    batch_size : int
+       Largest number of combinations in a batch.
+
+    Returns
+    -------
+
+    n : int
+       Number of batches.
+    """
+    batches_per_row = (inner_size + batch_size - 1) // batch_size
+    return (num_runs // inner_size) * batches_per_row
+
+
+def batch_range(batch_i, inner_size, batch_size):
+    """
+    Combinations included in a batch.
+
+    Parameters
+    ----------
+
+    batch_i : int
+       Batch number, 0 <= batch_i < num_batches(...).
+
+    inner_size : int
+       Number of values of the last varied variable (1 if none is varied).
+
+    batch_size : int
+       Largest number of combinations in a batch.
+
+    Returns
+    -------
+
+    (start, stop) : tuple
+       The batch holds combinations start up to, but not including, stop.
+    """
+    batches_per_row = (inner_size + batch_size - 1) // batch_size
+    (row, col) = divmod(batch_i, batches_per_row)
+    start = row * inner_size + col * batch_size
+    stop = min(start + batch_size, (row + 1) * inner_size)
+    return (start, stop)
+
+
+def pending_units(num_units, unit_done):
+    """
+    Compact list of the units of work that are not yet done.
+
+    Parameters
+    ----------
+
+    num_units : int
+       Number of units.
+
+    unit_done : function
+       Returns True if the unit with the given index is done.
+
+    Returns
+    -------
+
+    units : array
+       Indices of the units left, in increasing order.
+    """
+    return array(INDEX_TYPECODE, (unit_i for unit_i in index_range(num_units) if not unit_done(unit_i)))
+
+
+def locate_unit(unit_offsets, unit_i):
+    """
+    Find a unit in a global index space made of consecutive parts, such as
+    the units of the experiments of a study.
+
+    Parameters
+    ----------
+
+    unit_offsets : list
+       Global index of the first unit of each part, in increasing order and
+       starting at 0.
+
+    unit_i : int
+       Global index of the unit.
+
+    Returns
+    -------
+
+    location : tuple
+       (part, index of the unit within the part).
+    """
+    part = bisect.bisect_right(unit_offsets, unit_i) - 1
+    return (part, unit_i - unit_offsets[part])
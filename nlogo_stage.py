@@ -0,0 +1,314 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Staging of the model and NetLogo to node local storage.  Without it every
+JVM of the study loads the model, the NetLogo jar and its libraries from
+the shared file system, all at the same time.  With it rank 0 reads them
+once, packs them into a tar archive and broadcasts it to one leader process
+per node, which unpacks it into a directory on node local storage used by
+all processes of the node.
+
+Staged are the model file, the files it includes (__includes) and the
+directories of its extensions next to it, and the NetLogo jar with the
+jars on its class path and the extensions directory next to it.  If some
+of these lie outside the directory of the model or jar, that one is left
+where it is.  Data files the model reads (file-open, import-world, gis:load-
+dataset, ...) cannot be found in the code reliably and are only staged when
+they match one of the patterns given.  Files the model writes next to itself
+end up in the staged copy and are removed with it.
+
+The archive is written to a temporary file on rank 0 and broadcast in
+pieces into a temporary file on every leader, so it is never held in memory
+as a whole.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import os
+import re
+import sys
+import glob
+import atexit
+import shutil
+import tarfile
+import zipfile
+import tempfile
+from nlogo_comm import LocalComm
+
+# Size of the pieces the archive is broadcast in, well below the 2 GB limit
+# of a single MPI message.
+CHUNK_BYTES = 1 << 26
+
+
+def relative_inside(path, directory):
+    # path relative to directory, or None if it is not inside it.
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(directory))
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep) or os.path.isabs(rel):
+        return None
+    return rel
+
+
+def model_files(nlogo_file, patterns = None):
+    """
+    Files a model needs, relative to its directory.
+
+    Parameters
+    ----------
+
+    nlogo_file : str
+       Path to the model.
+
+    patterns : list, optional
+       Glob patterns, relative to the directory of the model, of further
+       files or directories to stage, such as data files the model reads.
+
+    Returns
+    -------
+
+    files : list
+       Paths relative to the directory of the model, the model first, or
+       None if some of them are outside it.
+    """
+    model_dir = os.path.dirname(os.path.abspath(nlogo_file))
+    with open(nlogo_file) as fin:
+        code = fin.read().split("@#$#@#$#@")[0]
+    code = re.sub(r";[^\n]*", "", code)
+    files = [os.path.basename(nlogo_file)]
+    for includes in re.findall(r"__includes\s*\[([^\]]*)\]", code, re.IGNORECASE):
+        for include in re.findall(r'"([^"]*)"', includes):
+            rel = relative_inside(os.path.join(model_dir, include), model_dir)
+            if rel == None:
+                return None
+            files.append(rel)
+    for extensions in re.findall(r"\bextensions\s*\[([^\]]*)\]", code, re.IGNORECASE):
+        for name in extensions.split():
+            if os.path.isdir(os.path.join(model_dir, name)):
+                files.append(name)
+    if patterns != None:
+        for pattern in patterns:
+            matches = sorted(glob.glob(os.path.join(model_dir, pattern)))
+            if len(matches) == 0:
+                sys.stderr.write("Warning - No files to stage match '{0}'\n".format(pattern))
+            for path in matches:
+                rel = relative_inside(path, model_dir)
+                if rel == None:
+                    return None
+                if rel not in files:
+                    files.append(rel)
+    return files
+
+
+def netlogo_files(nlogo_path):
+    """
+    Files of NetLogo, relative to the directory of the jar: the jar, the
+    entries of the Class-Path of its manifest and the extensions directory.
+
+    Parameters
+    ----------
+
+    nlogo_path : str
+       Path to the NetLogo jar.
+
+    Returns
+    -------
+
+    files : list
+       Paths relative to the directory of the jar, the jar first, or None if
+       some of them are outside it.
+    """
+    jar_dir = os.path.dirname(os.path.abspath(nlogo_path))
+    files = [os.path.basename(nlogo_path)]
+    with zipfile.ZipFile(nlogo_path) as jar:
+        try:
+            manifest = jar.read("META-INF/MANIFEST.MF").decode("utf-8", "replace")
+        except KeyError:
+            manifest = ""
+    # Long manifest lines continue on lines starting with a space.
+    manifest = manifest.replace("\r\n", "\n").replace("\n ", "")
+    match = re.search(r"^Class-Path:(.*)$", manifest, re.MULTILINE)
+    if match != None:
+        for entry in match.group(1).split():
+            path = os.path.join(jar_dir, entry.replace("%20", " "))
+            if not os.path.exists(path):
+                continue
+            rel = relative_inside(path, jar_dir)
+            if rel == None:
+                return None
+            files.append(rel)
+    if os.path.isdir(os.path.join(jar_dir, "extensions")):
+        files.append("extensions")
+    return files
+
+
+def stage_archive(archive, nlogo_file, nlogo_path, patterns = None):
+    """
+    Pack what is staged into a tar archive.
+
+    Parameters
+    ----------
+
+    archive : file
+       Binary file the archive is written to.
+
+    nlogo_file : str
+
+    nlogo_path : str
+
+    patterns : list, optional
+       Patterns of further files of the model, see model_files.
+
+    Returns
+    -------
+
+    staged : tuple
+       (model, jar), the paths of the model and the jar in the archive, or
+       None for what is not staged.
+    """
+    staged = [None, None]
+    with tarfile.open(fileobj = archive, mode = "w") as tar:
+        files = model_files(nlogo_file, patterns)
+        if files == None:
+            sys.stderr.write("Warning - Not staging the model, it uses files outside its directory.\n")
+        else:
+            model_dir = os.path.dirname(os.path.abspath(nlogo_file))
+            for rel in files:
+                tar.add(os.path.join(model_dir, rel), arcname = os.path.join("model", rel))
+            staged[0] = os.path.join("model", files[0])
+        if nlogo_path != None and os.path.isfile(nlogo_path):
+            files = netlogo_files(nlogo_path)
+            if files == None:
+                sys.stderr.write("Warning - Not staging NetLogo, its class path is outside the directory of the jar.\n")
+            else:
+                jar_dir = os.path.dirname(os.path.abspath(nlogo_path))
+                for rel in files:
+                    tar.add(os.path.join(jar_dir, rel), arcname = os.path.join("netlogo", rel))
+                staged[1] = os.path.join("netlogo", files[0])
+    return tuple(staged)
+
+
+def bcast_file(comm, fileobj, root = 0):
+    # Broadcast the contents of the file of the root with the buffer
+    # interface, one piece at a time, and append them to fileobj on the
+    # other processes. Returns fileobj, or None if it is None or could not
+    # be written, which does not stop the broadcast.
+    from mpi4py import MPI
+    is_root = comm.Get_rank() == root
+    size = None
+    if is_root:
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(0)
+    size = comm.bcast(size, root = root)
+    for start in range(0, size, CHUNK_BYTES):
+        if is_root:
+            chunk = bytearray(fileobj.read(CHUNK_BYTES))
+        else:
+            chunk = bytearray(min(CHUNK_BYTES, size - start))
+        comm.Bcast([chunk, MPI.BYTE], root = root)
+        if not is_root and fileobj != None:
+            try:
+                fileobj.write(chunk)
+            except (IOError, OSError) as err:
+                sys.stderr.write("Warning - Not staging on this node: {0}\n".format(err))
+                fileobj.close()
+                fileobj = None
+    return fileobj
+
+
+def stage_files(comm, stage_dir, nlogo_file, nlogo_path, patterns = None):
+    """
+    Stage the model and NetLogo to node local storage, see the module
+    documentation.  Collective over comm.  The staged copies are removed
+    when the leader of the node exits.
+
+    Parameters
+    ----------
+
+    comm : MPI communicator or LocalComm
+
+    stage_dir : str
+       Node local directory the copies are put in (in a subdirectory).
+
+    nlogo_file : str
+       Path to the model.
+
+    nlogo_path : str
+       Path to the NetLogo jar.
+
+    patterns : list, optional
+       Patterns of further files of the model, see model_files.
+
+    Returns
+    -------
+
+    paths : tuple
+       (nlogo_file, nlogo_path) to use for the runs, the given ones for what
+       could not be staged.
+    """
+    mpi_rank = comm.Get_rank()
+    # The processes of a LocalComm all are on this node.
+    if isinstance(comm, LocalComm):
+        node_comm = comm
+        leader_comm = None
+    else:
+        from mpi4py import MPI
+        node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key = mpi_rank)
+        is_leader = node_comm.Get_rank() == 0
+        leader_comm = comm.Split(0 if is_leader else MPI.UNDEFINED, key = mpi_rank)
+
+    paths = None
+    if node_comm.Get_rank() == 0:
+        # Rank 0 is the leader of its node, it writes the archive to its
+        # file and the other leaders receive it into theirs.
+        try:
+            archive = tempfile.TemporaryFile(prefix = "nlogo_stage_", dir = stage_dir)
+        except (IOError, OSError) as err:
+            sys.stderr.write("Warning - Not staging on this node: {0}\n".format(err))
+            archive = None
+        staged = None
+        if mpi_rank == 0 and archive != None:
+            try:
+                staged = stage_archive(archive, nlogo_file, nlogo_path, patterns)
+            except (IOError, OSError, zipfile.BadZipfile) as err:
+                sys.stderr.write("Warning - Not staging: {0}\n".format(err))
+        if leader_comm != None:
+            staged = leader_comm.bcast(staged, root = 0)
+            if staged != None:
+                archive = bcast_file(leader_comm, archive)
+            leader_comm.Free()
+        if staged != None and archive != None:
+            try:
+                directory = tempfile.mkdtemp(prefix = "nlogo_stage_", dir = stage_dir)
+                atexit.register(shutil.rmtree, directory, True)
+                archive.seek(0)
+                with tarfile.open(fileobj = archive, mode = "r") as tar:
+                    tar.extractall(directory)
+                paths = tuple([os.path.join(directory, path) if path != None else None for path in staged])
+            except (IOError, OSError, tarfile.TarError) as err:
+                sys.stderr.write("Warning - Not staging on this node: {0}\n".format(err))
+        if archive != None:
+            archive.close()
+    paths = node_comm.bcast(paths, root = 0)
+    if node_comm is not comm:
+        node_comm.Free()
+
+    if paths == None:
+        return (nlogo_file, nlogo_path)
+    return (paths[0] if paths[0] != None else nlogo_file, paths[1] if paths[1] != None else nlogo_path)
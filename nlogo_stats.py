@@ -0,0 +1,366 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Online statistics of the reporters of every combination over its
+repetitions.  Each process keeps, per combination (and step, with all rows)
+and metric column, the count, mean and sum of squared deviations (Welford)
+with the minimum and maximum, and a small mergeable sketch of the values for
+quantiles.  All of these merge exactly (the sketch approximately once it
+holds more than 2 * SKETCH_SIZE values), so the statistics of the processes
+are combined with a reduction at the end and rank 0 writes one summary table
+per experiment.
+
+For restarts every process appends the statistics of the runs it finished
+since it last saved, with their global ids, to a checkpoint file whenever
+its result sink journals finished runs.  A restarted study merges all these
+deltas saved by the earlier jobs and skips their runs.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import os
+import sys
+import csv
+import glob
+import math
+import pickle
+from nlogo_comm import LocalComm
+from nlogo_results import parse_table_line
+from nlogo_io import planCombination
+
+SKETCH_SIZE = 64
+
+DEFAULT_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+class ReporterStats(object):
+    """
+    Statistics of the values of one reporter: count, mean, sum of squared
+    deviations from the mean, minimum, maximum and a quantile sketch.  The
+    sketch is a list of [mean, weight] centroids, exact (one centroid per
+    value) up to 2 * SKETCH_SIZE values, after which neighbouring centroids
+    are merged, into about SKETCH_SIZE centroids.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.centroids = []
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min == None else min(self.min, value)
+        self.max = value if self.max == None else max(self.max, value)
+        self.centroids.append([value, 1])
+        if len(self.centroids) > 2 * SKETCH_SIZE:
+            self.compress()
+
+    def merge(self, other):
+        # Chan et al.'s update of the mean and squared deviations.
+        if other.n == 0:
+            return
+        if self.n == 0:
+            (self.n, self.mean, self.m2, self.min, self.max) = (other.n, other.mean, other.m2, other.min, other.max)
+            self.centroids = [list(centroid) for centroid in other.centroids]
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+        self.min = other.min if self.min == None else min(self.min, other.min)
+        self.max = other.max if self.max == None else max(self.max, other.max)
+        self.centroids.extend([list(centroid) for centroid in other.centroids])
+        if len(self.centroids) > 2 * SKETCH_SIZE:
+            self.compress()
+
+    def compress(self):
+        # As in a t-digest, centroids near the middle may hold more values
+        # than those in the tails, so the tails stay accurate.
+        self.centroids.sort()
+        merged = []
+        rank = 0.0
+        for value, weight in self.centroids:
+            if len(merged) > 0:
+                last = merged[-1]
+                q = (rank + (last[1] + weight) / 2.0) / self.n
+                if last[1] + weight <= max(1.0, math.pi * self.n * math.sqrt(q * (1.0 - q)) / SKETCH_SIZE):
+                    last[0] += (value - last[0]) * weight / (last[1] + weight)
+                    last[1] += weight
+                    continue
+                rank += last[1]
+            merged.append([value, weight])
+        self.centroids = merged
+
+    def variance(self):
+        if self.n < 2:
+            return None
+        return self.m2 / (self.n - 1)
+
+    def quantile(self, q):
+        """
+        The q quantile, interpolated linearly between the values (numpy's
+        default) while the sketch is exact and between the centroids after.
+        """
+        if self.n == 0:
+            return None
+        self.centroids.sort()
+        # Every centroid stands at the middle of the ranks of its values,
+        # the minimum and maximum at the first and last rank.
+        position = q * (self.n - 1)
+        points = [(self.min, 0.0)]
+        rank = 0.0
+        for value, weight in self.centroids:
+            points.append((value, rank + (weight - 1) / 2.0))
+            rank += weight
+        points.append((self.max, self.n - 1.0))
+        for (prev_value, prev_center), (value, center) in zip(points[:-1], points[1:]):
+            if center >= position:
+                if center == prev_center:
+                    return value
+                return prev_value + (position - prev_center) / (center - prev_center) * (value - prev_value)
+        return self.max
+
+
+class StudyStats(object):
+    """
+    Statistics of the reporters of all combinations a process has run, by
+    (experiment, run number, step) with step None unless all rows are kept.
+    The rows of a unit of work are added to a pending dictionary, which is
+    staged once the unit is complete and joins the statistics when they are
+    saved, after the rows of the unit have been written.  Failed or
+    unfinished units leave no trace.
+
+    Parameters
+    ----------
+
+    checkpoint_filename : str, optional
+       File the statistics are saved to by save.
+    """
+
+    def __init__(self, checkpoint_filename = None):
+        self.checkpoint_filename = checkpoint_filename
+        self.entries = {}
+        self.reporters = {}
+        self.ids = []
+        self.staged = []
+
+    def add_row(self, pending, experiment_name, exp_i, header_lines, line, all_rows = False):
+        """
+        Add a row of the NetLogo table of a run to pending, a dictionary
+        kept by the caller until the unit is complete. Only the numeric
+        values of the columns after [step], the metrics, are used.
+        """
+        if line == None or len(header_lines) < 7:
+            return
+        if experiment_name not in self.reporters:
+            names = parse_table_line(header_lines[6])
+            first = names.index("[step]") + 1 if "[step]" in names else len(names)
+            self.reporters[experiment_name] = (first, names[first:])
+        (first, names) = self.reporters[experiment_name]
+        fields = parse_table_line(line)
+        step = None
+        if all_rows and first > 0 and first - 1 < len(fields):
+            step = fields[first - 1]
+        entry = pending.setdefault((experiment_name, exp_i, step), {})
+        for name, text in zip(names, fields[first:]):
+            try:
+                value = float(text)
+            except ValueError:
+                continue
+            if math.isnan(value) or math.isinf(value):
+                continue
+            entry.setdefault(name, ReporterStats()).add(value)
+
+    def stage(self, pending, global_ids):
+        # The unit of pending is complete, its combinations are global_ids.
+        self.staged.append((pending, global_ids))
+
+    def commit(self):
+        for pending, global_ids in self.staged:
+            self.merge_entries(pending)
+            self.ids.extend(global_ids)
+        self.staged = []
+
+    def merge_entries(self, entries):
+        # The statistics of entries are copied, not shared.
+        for key, entry in entries.items():
+            mine = self.entries.setdefault(key, {})
+            for name, stats in entry.items():
+                mine.setdefault(name, ReporterStats()).merge(stats)
+
+    def merge(self, other):
+        self.merge_entries(other.entries)
+        for experiment_name, reporters in other.reporters.items():
+            self.reporters.setdefault(experiment_name, reporters)
+        self.ids.extend(other.ids)
+        return self
+
+    def __add__(self, other):
+        # Merges other into this, for the reduction.
+        return self.merge(other)
+
+    def __getstate__(self):
+        return {"entries" : self.entries, "reporters" : self.reporters, "ids" : self.ids}
+
+    def __setstate__(self, state):
+        self.checkpoint_filename = None
+        self.entries = state["entries"]
+        self.reporters = state["reporters"]
+        self.ids = state["ids"]
+        self.staged = []
+
+    def save(self):
+        # Append the staged units to the checkpoint file, as one delta with
+        # the statistics and ids of just these units, and commit them. The
+        # file is only ever appended to, so saving costs as much as the
+        # units it adds. A delta cut short by a kill is dropped when the
+        # file is loaded, and its runs were not journaled yet.
+        if self.checkpoint_filename != None:
+            delta = StudyStats()
+            delta.reporters = self.reporters
+            for pending, global_ids in self.staged:
+                delta.merge_entries(pending)
+                delta.ids.extend(global_ids)
+            if len(delta.ids) > 0:
+                with open(self.checkpoint_filename, "ab") as fout:
+                    pickle.dump(delta, fout, pickle.HIGHEST_PROTOCOL)
+        self.commit()
+
+
+class StatsJournal(object):
+    """
+    Stands in for the CompletionJournal of a result sink and saves the
+    statistics before the ids are journaled.  Units are staged before their
+    ids are given to the sink, so the saved statistics never miss a
+    journaled run, and the sink has written the rows of all staged units.
+    """
+
+    def __init__(self, stats, journal):
+        self.stats = stats
+        self.journal = journal
+
+    def append(self, global_ids):
+        self.stats.save()
+        self.journal.append(global_ids)
+
+
+def load_checkpoints(output_dir):
+    """
+    Merge the statistics saved by earlier jobs of a study, all the deltas
+    of every checkpoint file.
+
+    Parameters
+    ----------
+
+    output_dir : str
+
+    Returns
+    -------
+
+    stats : StudyStats or None
+       None if there are none.
+    """
+    stats = None
+    for fname in sorted(glob.glob(os.path.join(output_dir, "proc*.stats"))):
+        with open(fname, "rb") as fin:
+            while True:
+                try:
+                    saved = pickle.load(fin)
+                except EOFError:
+                    break
+                except Exception:
+                    # Whatever a delta cut short makes of the unpickler.
+                    sys.stderr.write("Warning - Ignoring the incomplete end of '{0}'\n".format(fname))
+                    break
+                stats = saved if stats == None else stats.merge(saved)
+    return stats
+
+
+def reduce_stats(comm, stats):
+    """
+    Combine the statistics of all processes on rank 0, with an MPI
+    reduction (a gather for a LocalComm). Collective.
+
+    Returns
+    -------
+
+    stats : StudyStats or None
+       The combined statistics on rank 0, None elsewhere.
+    """
+    if isinstance(comm, LocalComm):
+        parts = comm.gather(stats, root = 0)
+        if parts == None:
+            return None
+        for part in parts[1:]:
+            parts[0].merge(part)
+        return parts[0]
+    from mpi4py import MPI
+    return comm.reduce(stats, op = MPI.SUM, root = 0)
+
+
+def write_summary(summary_filename, exp_plan, stats, quantiles = DEFAULT_QUANTILES):
+    """
+    Write the summary table of an experiment: one row per run number (and
+    step) and reporter, with the varied variables and the statistics of the
+    reporter over the repetitions.
+
+    Parameters
+    ----------
+
+    summary_filename : str
+
+    exp_plan : dict
+       Entry of the experiment plan.
+
+    stats : StudyStats
+       Combined statistics of the study.
+
+    quantiles : list, optional
+       Quantiles to give, between 0 and 1.
+    """
+    experiment_name = exp_plan["safe_name"]
+    names = [name for name, value in planCombination(exp_plan, 0)]
+    keys = [key for key in stats.entries if key[0] == experiment_name]
+    with_step = any([key[2] != None for key in keys])
+    keys.sort(key = lambda key: (key[1], float(key[2]) if key[2] != None else 0.0))
+    reporters = stats.reporters.get(experiment_name, (0, []))[1]
+    with open(summary_filename, "w") as fout:
+        writer = csv.writer(fout, lineterminator = "\n")
+        writer.writerow(["run_number"] + (["step"] if with_step else []) + names + \
+                            ["reporter", "n", "mean", "variance", "min", "max"] + ["q" + str(q) for q in quantiles])
+        for key in keys:
+            combination = [value for name, value in planCombination(exp_plan, key[1])]
+            entry = stats.entries[key]
+            for name in reporters:
+                if name not in entry:
+                    continue
+                reporter = entry[name]
+                variance = reporter.variance()
+                writer.writerow([str(key[1]).zfill(6)] + ([key[2]] if with_step else []) + combination + \
+                                    [name, reporter.n, repr(reporter.mean), "" if variance == None else repr(variance),
+                                     repr(reporter.min), repr(reporter.max)] + \
+                                    [repr(reporter.quantile(q)) for q in quantiles])
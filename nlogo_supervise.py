@@ -0,0 +1,159 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Supervision of NetLogo runs.  Every run is started in its own process group
+so that it can be stopped as a whole (the shell, java and anything java
+started) when it takes too long.  Failed runs are retried after a growing
+delay, with more memory if java ran out of it, and the runs that fail for
+good are recorded in a failure table instead of stopping the study.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import os
+import sys
+import time
+import signal
+
+FAILURE_COLUMNS = ["experiment", "run_number", "block", "attempts", "exit_code", "reason", "seconds"]
+
+
+def kill_group(proc, grace = 5.0):
+    """
+    Stop a run started in its own process group, with SIGTERM and after
+    grace seconds SIGKILL.
+
+    Parameters
+    ----------
+
+    proc : subprocess.Popen
+
+    grace : float, optional
+       Seconds the processes get to exit after SIGTERM.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        return
+    deadline = time.time() + grace
+    while proc.poll() == None and time.time() < deadline:
+        time.sleep(0.05)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proc.wait()
+
+
+def read_tail(fname, max_lines = 20):
+    # The last lines of a file, empty if there is none.
+    try:
+        with open(fname) as fin:
+            return fin.readlines()[-max_lines:]
+    except IOError:
+        return []
+
+
+def out_of_memory(lines):
+    for line in lines:
+        if "OutOfMemoryError" in line:
+            return True
+    return False
+
+
+class RunTimer(object):
+    """
+    Time limits of NetLogo runs.  The limit of a run is a fixed number of
+    seconds per repetition of a combination or, once this process has seen
+    enough runs of the experiment succeed, a multiple of their median time.
+    A NetLogo invocation of several combinations or repetitions gets the
+    limit of all of them.
+
+    Parameters
+    ----------
+
+    timeout : float, optional
+       Seconds per run, used until there are observed times (or always,
+       without factor).
+
+    factor : float, optional
+       Limit as a multiple of the median observed time.
+
+    min_samples : int, optional
+       Number of observed invocations the median needs.
+
+    max_samples : int, optional
+       Number of most recent invocations kept per experiment.
+    """
+
+    def __init__(self, timeout = None, factor = None, min_samples = 3, max_samples = 100):
+        self.timeout = timeout
+        self.factor = factor
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.samples = {}
+
+    def observe(self, experiment_name, seconds, runs):
+        samples = self.samples.setdefault(experiment_name, [])
+        samples.append(seconds / max(1, runs))
+        if len(samples) > self.max_samples:
+            del samples[0]
+
+    def limit(self, experiment_name, runs):
+        """
+        Seconds an invocation of runs runs of the experiment may take, or
+        None if there is no limit.
+        """
+        per_run = self.timeout
+        samples = self.samples.get(experiment_name, [])
+        if self.factor != None and len(samples) >= self.min_samples:
+            per_run = self.factor * sorted(samples)[len(samples) // 2]
+        if per_run == None:
+            return None
+        return per_run * max(1, runs)
+
+
+class FailureTable(object):
+    """
+    Runs that failed for good, one row per combination and repetition block,
+    appended to a csv file (normally procNNNN.failed.csv) as they happen.
+
+    Parameters
+    ----------
+
+    filename : str
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.num_failed = 0
+
+    def record(self, experiment_name, exp_i, block, attempts, exit_code, reason, seconds):
+        line = ",".join([experiment_name, str(exp_i).zfill(6), str(block), str(attempts), str(exit_code),
+                         reason, "{0:.1f}".format(seconds)]) + "\n"
+        try:
+            new_file = not os.path.isfile(self.filename)
+            with open(self.filename, "a") as fout:
+                if new_file:
+                    fout.write(",".join(FAILURE_COLUMNS) + "\n")
+                fout.write(line)
+        except IOError as ioe:
+            sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
+        self.num_failed += 1
@@ -0,0 +1,196 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Timing of the phases of every run.  Each process writes its own trace file in
+the Chrome trace event format (a JSON array of complete events, one per
+line), which can be opened in chrome://tracing or https://ui.perfetto.dev to
+see all processes on one timeline.  At the end the per process totals are
+gathered on rank 0 and summarised.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """
+    Records the phases of the runs of one process.
+
+    Parameters
+    ----------
+
+    filename : str or None
+       Trace file to write. If None nothing is written, but the totals used
+       for the summary are still kept.
+
+    mpi_rank : int
+       Rank of the process, used as the process id of the events.
+
+    max_events : int, optional
+       Number of events buffered before they are written.
+    """
+
+    def __init__(self, filename, mpi_rank, max_events = 1000):
+        self.filename = filename
+        self.mpi_rank = mpi_rank
+        self.max_events = max_events
+        self.events = []
+        self.first = True
+        self.start = time.time()
+        # Disjoint intervals of time spent on units of work. Units in
+        # progress at the same time, in slots, are only counted once.
+        self.intervals = []
+        self.max_intervals = max_events
+        self.runs = 0
+        self.failed = 0
+        self.phase_totals = {}
+        if self.filename != None:
+            try:
+                with open(self.filename, "w") as fout:
+                    fout.write("[\n")
+            except IOError as ioe:
+                sys.stderr.write(ioe.strerror + " '{0}'\n".format(ioe.filename))
+                sys.exit(ioe.errno)
+
+    @contextmanager
+    def phase(self, name, **args):
+        """
+        Time a phase. Used as a context manager which gives a dictionary
+        where results such as exit codes can be added to the event.
+        """
+        begin = time.time()
+        try:
+            yield args
+        finally:
+            self.event(name, begin, time.time(), **args)
+
+    def event(self, name, begin, end, tid = 0, **args):
+        """
+        Record a phase that ran from begin to end, such as a NetLogo run
+        that went on while others were handled. tid is the lane the event
+        is shown in.
+        """
+        self.phase_totals[name] = self.phase_totals.get(name, 0.0) + end - begin
+        if self.filename != None:
+            self.events.append({"name" : name, "ph" : "X", "pid" : self.mpi_rank, "tid" : tid,
+                                "ts" : int(begin * 1e6),
+                                "dur" : int((end - begin) * 1e6),
+                                "args" : args})
+            if len(self.events) >= self.max_events:
+                self.flush()
+
+    def unit_done(self, begin, end, runs, failed = 0):
+        # Time spent on a unit of work, from begin to end, counts as busy.
+        self.intervals.append((begin, end))
+        if len(self.intervals) > self.max_intervals:
+            self.intervals = union_intervals(self.intervals)
+            self.max_intervals = max(self.max_intervals, 2 * len(self.intervals))
+        self.runs += runs
+        self.failed += failed
+
+    def busy(self):
+        return sum([end - begin for begin, end in union_intervals(self.intervals)])
+
+    def flush(self):
+        if self.filename == None or len(self.events) == 0:
+            return
+        text = ""
+        for event in self.events:
+            if not self.first:
+                text += ",\n"
+            self.first = False
+            text += json.dumps(event, separators = (",", ":"))
+        self.events = []
+        with open(self.filename, "a") as fout:
+            fout.write(text)
+
+    def close(self):
+        self.flush()
+        if self.filename != None:
+            with open(self.filename, "a") as fout:
+                fout.write("\n]\n")
+
+    def totals(self):
+        return {"rank" : self.mpi_rank,
+                "wall" : time.time() - self.start,
+                "busy" : self.busy(),
+                "runs" : self.runs,
+                "failed" : self.failed,
+                "phases" : self.phase_totals}
+
+
+def union_intervals(intervals):
+    """
+    Sorted disjoint intervals covering the same time as a list of (begin,
+    end) intervals.
+    """
+    merged = []
+    for begin, end in sorted(intervals):
+        if len(merged) > 0 and begin <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((begin, end))
+    return merged
+
+
+def summarize(all_totals):
+    """
+    Summary of the totals of all processes.
+
+    Parameters
+    ----------
+
+    all_totals : list
+       Tracer.totals() of every process.
+
+    Returns
+    -------
+
+    text : str
+       Human readable summary.
+    """
+    wall = max([tot["wall"] for tot in all_totals])
+    # Busy time is a union of intervals within the time of the process, so
+    # it is at most the wall time, the clamp only absorbs clock rounding.
+    busy = [min(tot["busy"], wall) for tot in all_totals]
+    mean_busy = sum(busy) / len(busy)
+    runs = sum([tot["runs"] for tot in all_totals])
+    failed = sum([tot["failed"] for tot in all_totals])
+    lines = ["{0:>6} {1:>10} {2:>10} {3:>8}".format("rank", "busy [s]", "idle [s]", "runs")]
+    for tot, rank_busy in zip(all_totals, busy):
+        lines.append("{0:>6} {1:>10.2f} {2:>10.2f} {3:>8}".format(tot["rank"], rank_busy,
+                                                                  wall - rank_busy, tot["runs"]))
+    phases = {}
+    for tot in all_totals:
+        for name in tot["phases"]:
+            phases[name] = phases.get(name, 0.0) + tot["phases"][name]
+    lines.append("")
+    lines.append("Wall time {0:.2f} s, {1} runs ({2} failed), {3:.2f} runs/s".format(wall, runs, failed,
+                                                                                  runs / wall if wall > 0 else 0.0))
+    if mean_busy > 0:
+        lines.append("Load imbalance (max busy / mean busy) {0:.3f}, efficiency (mean busy / wall) {1:.3f}"\
+                         .format(max(busy) / mean_busy, mean_busy / wall if wall > 0 else 0.0))
+    lines.append("Time per phase summed over processes: " + \
+                     ", ".join(["{0} {1:.2f} s".format(name, phases[name]) for name in sorted(phases)]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,361 @@
+#!python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Persistent NetLogo worker.  Instead of starting a new JVM, loading NetLogo
+and compiling the model for every behavior space combination, a worker
+process keeps one JVM (hosted through JPype) with the model already open and
+accepts setup xml documents over a pipe.  Each request is one line of JSON on
+the worker's stdin, each reply one line of JSON on its stdout.  The reply
+holds the lines of the run in the same layout as the file NetLogo writes with
+--table, so results can be handled exactly like a .dat file.
+
+The client side is the NetLogoWorker class which starts the worker process
+and talks to it.  The server side is started by running this file.
+"""
+
+__author__ = "Aaron Fisher <funktektronic@gmail.com>"
+
+__license__ = "GPL3"
+
+__version__ = "0.3"
+
+import sys
+import os
+import json
+import glob
+import argparse
+import subprocess
+from decimal import Decimal
+from xml.dom import minidom
+from nlogo_io import *
+
+
+class NetLogoWorker(object):
+    """
+    Client side handle of a persistent NetLogo worker process.
+
+    Parameters
+    ----------
+
+    java : str
+       Command used to launch java.  Only used to locate the JVM library
+       that the worker loads.
+
+    nlogo_path : str
+       Path to the NetLogo.jar file.
+
+    model_file : str
+       Path to the .nlogo model file the worker should keep open.
+
+    jvm_args : list, optional
+       Extra arguments for the JVM.
+    """
+
+    def __init__(self, java, nlogo_path, model_file, jvm_args = None):
+        self.java = java
+        self.nlogo_path = nlogo_path
+        self.model_file = model_file
+        self.jvm_args = list(jvm_args) if jvm_args != None else ["-Xmx2048m"]
+        self.proc = None
+
+    def start(self):
+        cmd = [sys.executable, os.path.abspath(__file__),
+               "--java", self.java,
+               "--nlogo_path", self.nlogo_path]
+        for jvm_arg in self.jvm_args:
+            cmd.append("--jvm_arg=" + jvm_arg)
+        cmd.append(self.model_file)
+        self.proc = subprocess.Popen(cmd, stdin = subprocess.PIPE,
+                                     stdout = subprocess.PIPE,
+                                     universal_newlines = True)
+        # The worker announces itself once the model is loaded.
+        reply = self._read_reply()
+        if reply.get("status") != 0:
+            self.close()
+            raise RuntimeError("NetLogo worker failed to start: {0}".format(reply.get("error")))
+
+    def run(self, setup_xml):
+        """
+        Run the experiment in a setup xml document.
+
+        Parameters
+        ----------
+
+        setup_xml : str
+           The same text that would be given to NetLogo with --setup-file.
+
+        Returns
+        -------
+
+        lines : list
+           Lines of the run in NetLogo table format.
+        """
+        if self.proc == None:
+            self.start()
+        try:
+            self.proc.stdin.write(json.dumps({"setup" : setup_xml}) + "\n")
+            self.proc.stdin.flush()
+            reply = self._read_reply()
+        except (IOError, RuntimeError):
+            # The worker is gone, the next run starts a new one.
+            status = self.proc.wait()
+            self.close()
+            raise RuntimeError("NetLogo worker exited unexpectedly (status {0})".format(status))
+        if reply.get("status") != 0:
+            raise RuntimeError("NetLogo worker run failed: {0}".format(reply.get("error")))
+        return reply["lines"]
+
+    def close(self):
+        if self.proc != None:
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+            self.proc.wait()
+            self.proc = None
+
+    def _read_reply(self):
+        line = self.proc.stdout.readline()
+        if line == "":
+            raise RuntimeError("NetLogo worker exited unexpectedly (status {0})".format(self.proc.poll()))
+        return json.loads(line)
+
+
+def find_libjvm(java):
+    """
+    Find the JVM shared library belonging to a java launcher.
+
+    Parameters
+    ----------
+
+    java : str
+       Command or path used to launch java.
+
+    Returns
+    -------
+
+    path : str or None
+       Path to libjvm, or None if it could not be found next to the launcher.
+    """
+    if os.path.dirname(java) == "":
+        for path_dir in os.environ.get("PATH", "").split(os.pathsep):
+            if os.path.isfile(os.path.join(path_dir, java)):
+                java = os.path.join(path_dir, java)
+                break
+    java_home = os.path.dirname(os.path.dirname(os.path.realpath(java)))
+    for pattern in ["lib/server/libjvm.*", "jre/lib/*/server/libjvm.*",
+                    "lib/*/server/libjvm.*", "jre/bin/server/jvm.dll",
+                    "bin/server/jvm.dll"]:
+        found = glob.glob(os.path.join(java_home, pattern))
+        if len(found) > 0:
+            return found[0]
+    return None
+
+
+def table_line(values):
+    # NetLogo quotes every field of its table output.
+    return ",".join(['"' + str(val).replace('"', '""') + '"' for val in values]) + "\n"
+
+
+def logo_value(text):
+    """
+    A value of a value set as NetLogo writes it in its table: numbers as
+    org.nlogo.api.Dump does, whole numbers without a fraction and others
+    like Java's Double.toString.  Anything else is kept as it is.
+
+    Parameters
+    ----------
+
+    text : str or float
+       Value of an enumeratedValueSet, or of a steppedValueSet.
+
+    Returns
+    -------
+
+    value : str
+    """
+    try:
+        number = float(text)
+    except (TypeError, ValueError):
+        return str(text)
+    if number != number or number in (float("inf"), float("-inf")):
+        return str(text)
+    if number == int(number) and abs(number) < 2 ** 53:
+        return str(int(number))
+    if 1e-3 <= abs(number) < 1e7:
+        return repr(number)
+    # Scientific notation, d.dddE-n, from the shortest digits of repr.
+    (sign, digits, exponent) = Decimal(repr(number)).as_tuple()
+    exponent += len(digits) - 1
+    digits = "".join([str(digit) for digit in digits]).rstrip("0") or "0"
+    return "{0}{1}.{2}E{3}".format("-" if sign else "", digits[0], digits[1:] or "0", exponent)
+
+
+def node_text(experiment, tag):
+    nodes = experiment.getElementsByTagName(tag)
+    if len(nodes) == 0 or nodes[0].firstChild == None:
+        return ""
+    return nodes[0].firstChild.data.strip()
+
+
+class ExperimentRunner(object):
+    """
+    Runs BehaviorSpace experiments inside an open HeadlessWorkspace, mimicking
+    what org.nlogo.headless.Main does for a setup file.
+    """
+
+    def __init__(self, jpype, workspace, model_file):
+        self.workspace = workspace
+        self.model_file = model_file
+        try:
+            self.dump = jpype.JClass("org.nlogo.api.Dump")
+        except Exception:
+            self.dump = None
+        try:
+            self.version = str(jpype.JClass("org.nlogo.api.Version").version())
+        except Exception:
+            self.version = "NetLogo"
+
+    def report(self, reporter):
+        value = self.workspace.report(reporter)
+        if self.dump != None:
+            return str(self.dump.logoObject(value, True, False))
+        return str(value)
+
+    def run(self, setup_xml):
+        dom = minidom.parseString(setup_xml)
+        experiment = dom.getElementsByTagName("experiment")[0]
+        repetitions = int(experiment.getAttribute("repetitions") or "1")
+        every_step = experiment.getAttribute("runMetricsEveryStep") == "true"
+        setup = node_text(experiment, "setup")
+        go = node_text(experiment, "go")
+        final = node_text(experiment, "final")
+        exit_condition = node_text(experiment, "exitCondition")
+        time_limit = 0
+        for tl in experiment.getElementsByTagName("timeLimit"):
+            time_limit = int(tl.getAttribute("steps"))
+        metrics = [node.firstChild.data.strip() \
+                       for node in experiment.getElementsByTagName("metric")]
+
+        # Value sets in the order they appear, as NetLogo does in the table.
+        value_tuples = []
+        for node in experiment.childNodes:
+            if node.nodeName == "enumeratedValueSet":
+                value_tuples.append((node.getAttribute("variable"),
+                                     [val.getAttribute("value") \
+                                          for val in node.getElementsByTagName("value")]))
+            elif node.nodeName == "steppedValueSet":
+                value_tuples.append((node.getAttribute("variable"),
+                                     steppedValueSet(float(node.getAttribute("first")),
+                                                     float(node.getAttribute("step")),
+                                                     float(node.getAttribute("last")))))
+
+        lines = ['"BehaviorSpace results ({0})"\n'.format(self.version),
+                 table_line([self.model_file]),
+                 table_line([experiment.getAttribute("name")]),
+                 table_line([""]),
+                 table_line(["min-pxcor", "max-pxcor", "min-pycor", "max-pycor"]),
+                 table_line([self.report(r) for r in ["min-pxcor", "max-pxcor", "min-pycor", "max-pycor"]]),
+                 table_line(["[run number]"] + [name for name, vals in value_tuples] + ["[step]"] + metrics)]
+
+        if len(value_tuples) > 0:
+            combinations = expandValueSets(value_tuples)
+        else:
+            combinations = [[]]
+        run_number = 0
+        for combination in combinations:
+            for rep in range(repetitions):
+                run_number += 1
+                self.set_run_number(run_number)
+                for name, val in combination:
+                    self.workspace.command("set {0} {1}".format(name, val))
+                if setup != "":
+                    self.workspace.command(setup)
+                prefix = [run_number] + [logo_value(val) for name, val in combination]
+                step = 0
+                if every_step:
+                    lines.append(table_line(prefix + [step] + [self.report(m) for m in metrics]))
+                while time_limit == 0 or step < time_limit:
+                    if exit_condition != "" and self.report(exit_condition) == "true":
+                        break
+                    self.workspace.command(go)
+                    step += 1
+                    if every_step:
+                        lines.append(table_line(prefix + [step] + [self.report(m) for m in metrics]))
+                if not every_step:
+                    lines.append(table_line(prefix + [step] + [self.report(m) for m in metrics]))
+                if final != "":
+                    self.workspace.command(final)
+        return lines
+
+    def set_run_number(self, run_number):
+        # behaviorspace-run-number is only settable through the workspace.
+        try:
+            self.workspace.behaviorSpaceRunNumber(run_number)
+        except Exception:
+            pass
+
+
+def serve(argument_ns):
+    # Keep the original stdout for the protocol, anything the JVM or the
+    # model prints goes to stderr instead.
+    protocol_out = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    try:
+        import jpype
+    except ImportError:
+        protocol_out.write(json.dumps({"status" : 1, "error" : "The persistent worker requires the jpype module."}) + "\n")
+        protocol_out.flush()
+        return 1
+
+    try:
+        jvm_path = find_libjvm(argument_ns.java)
+        if jvm_path == None:
+            jvm_path = jpype.getDefaultJVMPath()
+        jpype.startJVM(jvm_path, "-Djava.awt.headless=true", "-Dfile.encoding=UTF-8",
+                       "-Djava.class.path=" + argument_ns.nlogo_path, *argument_ns.jvm_arg)
+        workspace = jpype.JClass("org.nlogo.headless.HeadlessWorkspace").newInstance()
+        workspace.open(argument_ns.model_file)
+        runner = ExperimentRunner(jpype, workspace, argument_ns.model_file)
+    except Exception as e:
+        protocol_out.write(json.dumps({"status" : 1, "error" : str(e)}) + "\n")
+        protocol_out.flush()
+        return 1
+
+    protocol_out.write(json.dumps({"status" : 0}) + "\n")
+    protocol_out.flush()
+
+    for line in iter(sys.stdin.readline, ""):
+        request = json.loads(line)
+        try:
+            reply = {"status" : 0, "lines" : runner.run(request["setup"])}
+        except Exception as e:
+            reply = {"status" : 1, "error" : str(e)}
+        protocol_out.write(json.dumps(reply) + "\n")
+        protocol_out.flush()
+
+    workspace.dispose()
+    return 0
+
+
+if __name__ == "__main__":
+    aparser = argparse.ArgumentParser(description = "Persistent NetLogo worker reading setup xml documents from stdin.")
+    aparser.add_argument("model_file", help = "Netlogo .nlogo model file to keep open.")
+    aparser.add_argument("--java", help = "Command to launch java.", default = "java")
+    aparser.add_argument("--nlogo_path", help = "Path to the nlogo java file.")
+    aparser.add_argument("--jvm_arg", action = "append", default = [], help = "Extra argument for the JVM. May be repeated.")
+    sys.exit(serve(aparser.parse_args()))
@@ -0,0 +1,60 @@
+"""
+Stands in for java running NetLogo headless in the tests: it writes the
+table of the experiment in the setup file, with values computed from the
+combination.  With NETLOGO_STUB_KILL_AT=N the Nth run (counted in the file
+NETLOGO_STUB_COUNT) kills the study process that launched it after writing
+its table, as a job killed by the batch system.
+"""
+
+import os
+import sys
+import signal
+import itertools
+from xml.dom import minidom
+
+
+def study_pid():
+    # The process running mpirun_nlogo.py, the parent of the shell (if it
+    # did not exec this script) that launched the run.
+    pid = os.getppid()
+    for i in range(2):
+        with open("/proc/{0}/cmdline".format(pid), "rb") as fin:
+            if b"mpirun_nlogo.py" in fin.read():
+                return pid
+        with open("/proc/{0}/stat".format(pid)) as fin:
+            pid = int(fin.read().rsplit(")", 1)[1].split()[1])
+    return None
+
+
+def main(args):
+    setup_file = args[args.index("--setup-file") + 1]
+    table_file = args[args.index("--table") + 1]
+    experiment = minidom.parse(setup_file).getElementsByTagName("experiment")[0]
+    repetitions = int(experiment.getAttribute("repetitions"))
+    value_sets = [(node.getAttribute("variable"), [value.getAttribute("value") for value in node.getElementsByTagName("value")]) \
+                      for node in experiment.childNodes if node.nodeName == "enumeratedValueSet"]
+    with open(table_file, "w") as fout:
+        fout.write('"BehaviorSpace results (NetLogo 5.3.1)"\n"model.nlogo"\n"{0}"\n"date"\n'.format(experiment.getAttribute("name")))
+        fout.write('"min-pxcor","max-pxcor","min-pycor","max-pycor"\n"-16","16","-16","16"\n')
+        fout.write(",".join(['"{0}"'.format(name) for name in ["[run number]"] + [name for name, values in value_sets] + ["[step]", "count turtles"]]) + "\n")
+        run_number = 0
+        for combination in itertools.product(*[values for name, values in value_sets]):
+            for rep in range(repetitions):
+                run_number += 1
+                value = sum([float(value) for value in combination]) + rep
+                fout.write(",".join(['"{0}"'.format(field) for field in [run_number] + list(combination) + [10, value]]) + "\n")
+    if "NETLOGO_STUB_KILL_AT" in os.environ:
+        count_file = os.environ["NETLOGO_STUB_COUNT"]
+        count = 1
+        if os.path.isfile(count_file):
+            with open(count_file) as fin:
+                count = int(fin.read()) + 1
+        with open(count_file, "w") as fout:
+            fout.write(str(count))
+        if count == int(os.environ["NETLOGO_STUB_KILL_AT"]):
+            os.kill(study_pid(), signal.SIGKILL)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,79 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from nlogo_results import ColumnarSink, CompletionJournal
+from collect_data import collect_columnar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+HEADER_LINES = ['"BehaviorSpace results (NetLogo 5.3.1)"\n', '"model.nlogo"\n', '"exp"\n', '"date"\n',
+                '"min-pxcor","max-pxcor"\n', '"-16","16"\n', '"[run number]","a","[step]","count turtles"\n']
+
+
+@unittest.skipIf(numpy == None, "needs numpy")
+class ColumnarSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_study(self, output_format, basename, global_id_offset = 0):
+        # Two experiments, one combination of each per unit, written in one
+        # part per experiment.
+        sink = ColumnarSink(os.path.join(self.directory, basename), output_format, max_rows = 100,
+                            journal = CompletionJournal(os.path.join(self.directory, basename + ".done")))
+        for exp_i in range(3):
+            for experiment_name, global_id in [("one", exp_i), ("two", 10 + exp_i)]:
+                line = '"{0}","{1}","10","{2}"\n'.format(exp_i + 1, exp_i, exp_i * 2)
+                sink.write(experiment_name, exp_i + 1, [("a", str(exp_i))], HEADER_LINES, line)
+                sink.complete_all([global_id + global_id_offset])
+        sink.close()
+
+    def test_part_ids_of_experiment(self):
+        self.write_study("npz", "proc0000")
+        with numpy.load(os.path.join(self.directory, "proc0000_one_part00000.npz")) as npz:
+            self.assertEqual(npz["global_ids"].tolist(), [0, 1, 2])
+        with numpy.load(os.path.join(self.directory, "proc0000_two_part00000.npz")) as npz:
+            self.assertEqual(npz["global_ids"].tolist(), [10, 11, 12])
+
+    def check_collect(self, output_format):
+        # The same runs written again by another process after a restart
+        # are collected once.
+        self.write_study(output_format, "proc0000")
+        self.write_study(output_format, "proc0001")
+        out_names = collect_columnar(self.directory, self.directory, output_format)
+        self.assertEqual(len(out_names), 2)
+        for out_name in out_names:
+            if output_format == "npz":
+                with numpy.load(out_name) as npz:
+                    run_numbers = npz["c0"].tolist()
+            else:
+                run_numbers = pyarrow.parquet.read_table(out_name).column("run_number").to_pylist()
+            self.assertEqual(run_numbers, [1, 2, 3])
+
+    def test_collect_npz(self):
+        self.check_collect("npz")
+
+    @unittest.skipIf(pyarrow == None, "needs pyarrow")
+    def test_collect_parquet(self):
+        self.check_collect("parquet")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from nlogo_sched import guided_chunks, order_by_cost, lpt_partition
+
+
+class LptPartitionTest(unittest.TestCase):
+
+    def test_every_unit_once(self):
+        rng = random.Random(1)
+        costs = sorted([rng.uniform(1.0, 100.0) for i in range(200)], reverse = True)
+        for mpi_size in [1, 3, 8]:
+            positions = []
+            for mpi_rank in range(mpi_size):
+                positions.extend(lpt_partition(costs, mpi_size, mpi_rank))
+            self.assertEqual(sorted(positions), list(range(len(costs))))
+
+    def test_balanced(self):
+        # Every load of the LPT rule is within the largest cost of the
+        # smallest load.
+        rng = random.Random(2)
+        costs = sorted([rng.expovariate(1.0) for i in range(500)], reverse = True)
+        loads = [sum([costs[position] for position in lpt_partition(costs, 7, mpi_rank)]) for mpi_rank in range(7)]
+        self.assertLessEqual(max(loads) - min(loads), costs[0])
+
+    def test_most_expensive_first(self):
+        (units, costs) = order_by_cost([5, 6, 7, 8], [1.0, 3.0, 2.0, 3.0])
+        self.assertEqual(list(units), [6, 8, 7, 5])
+        self.assertEqual(costs, [3.0, 3.0, 2.0, 1.0])
+        self.assertEqual(list(lpt_partition(costs, 2, 0)), [0, 2])
+        self.assertEqual(list(lpt_partition(costs, 2, 1)), [1, 3])
+
+
+    def test_expensive_runs_in_small_chunks(self):
+        costs = [100.0] * 4 + [1.0] * 96
+        chunks = guided_chunks(100, 4, 1, costs)
+        self.assertEqual(chunks[:4], [(0, 1), (1, 2), (2, 3), (3, 4)])
+        self.assertEqual(chunks[-1][1], 100)
+        for (start, stop), (next_start, next_stop) in zip(chunks[:-1], chunks[1:]):
+            self.assertEqual(stop, next_start)
+
+
+if __name__ == "__main__":
+    unittest.main()
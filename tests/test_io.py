@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from nlogo_io import expandValueSets, numCombinations, combinationAt
+
+
+class CombinationAtTest(unittest.TestCase):
+
+    def check(self, value_tuples):
+        combinations = list(expandValueSets(value_tuples))
+        self.assertEqual(len(combinations), numCombinations(value_tuples))
+        for index, combination in enumerate(combinations):
+            self.assertEqual(combinationAt(value_tuples, index), combination)
+
+    def test_order_of_expand_value_sets(self):
+        self.check([("a", ["1", "2", "3"]), ("c", ["7"]), ("b", [0.0, 0.5, 1.0, 1.5])])
+
+    def test_single_variable(self):
+        self.check([("x", ["10", "20"])])
+
+    def test_many_variables(self):
+        self.check([("v" + str(i), [str(j) for j in range(i + 1)]) for i in range(5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, os.pardir))
+
+MODEL = """to setup
+end
+@#$#@#$#@
+<experiments>
+  <experiment name="exp one" repetitions="2" runMetricsEveryStep="false">
+    <setup>setup</setup>
+    <go>go</go>
+    <timeLimit steps="10"/>
+    <metric>count turtles</metric>
+    <enumeratedValueSet variable="a">
+      <value value="1"/>
+      <value value="2"/>
+      <value value="3"/>
+    </enumeratedValueSet>
+    <enumeratedValueSet variable="b">
+      <value value="0"/>
+      <value value="0.5"/>
+      <value value="1"/>
+      <value value="1.5"/>
+    </enumeratedValueSet>
+  </experiment>
+  <experiment name="exp2" repetitions="3" runMetricsEveryStep="false">
+    <setup>setup</setup>
+    <go>go</go>
+    <timeLimit steps="10"/>
+    <metric>count turtles</metric>
+    <enumeratedValueSet variable="x">
+      <value value="10"/>
+      <value value="20"/>
+    </enumeratedValueSet>
+  </experiment>
+</experiments>
+@#$#@#$#@
+NetLogo 5.3.1
+"""
+
+# Rows of the study with --repetitions_per_run 1, one per repetition.
+NUM_ROWS = 12 * 2 + 2 * 3
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_journals(self):
+        from nlogo_results import CompletionJournal, read_journals, is_done
+        CompletionJournal(os.path.join(self.directory, "proc0000.done")).append([0, 5, 9])
+        CompletionJournal(os.path.join(self.directory, "proc0003.done")).append([5, 2])
+        # A record cut short by a kill is ignored.
+        with open(os.path.join(self.directory, "proc0003.done"), "ab") as fout:
+            fout.write(b"\x07\x00\x00")
+        (bitmap, num_done) = read_journals(self.directory, 10)
+        self.assertEqual(num_done, 4)
+        self.assertEqual([global_id for global_id in range(10) if is_done(bitmap, global_id)], [0, 2, 5, 9])
+
+    def test_pending_units(self):
+        from nlogo_sched import pending_units
+        units = pending_units(20, lambda unit_i: unit_i % 3 == 0)
+        self.assertEqual(list(units), [unit_i for unit_i in range(20) if unit_i % 3 != 0])
+
+
+@unittest.skipUnless(os.path.isdir("/proc") and hasattr(os, "setsid"), "needs Linux")
+class KillRestartTest(unittest.TestCase):
+    """
+    A study killed in the middle and run again has every row exactly once.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.model = os.path.join(self.directory, "model.nlogo")
+        with open(self.model, "w") as fout:
+            fout.write(MODEL)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_study(self, extra_args, env = None):
+        java = '"{0}" "{1}"'.format(sys.executable, os.path.join(TESTS_DIR, "netlogo_stub.py"))
+        with open(os.devnull, "w") as devnull:
+            return subprocess.call([sys.executable, os.path.join(TESTS_DIR, os.pardir, "mpirun_nlogo.py"),
+                                    "--all_experiments", "--backend", "local", "--processes", "2",
+                                    "--java", java, "--nlogo_path", "NetLogo.jar", "--repetitions_per_run", "1",
+                                    "--flush_rows", "1", "--output_dir", self.directory] + extra_args + [self.model],
+                                   cwd = self.directory, env = env, stdout = devnull, stderr = devnull)
+
+    def keys(self, fnames):
+        keys = []
+        for fname in fnames:
+            with open(fname) as fin:
+                keys.extend([tuple(line.split(",")[:3]) for line in fin])
+        return keys
+
+    def check_restart(self, extra_args, kill_at):
+        env = dict(os.environ)
+        env["NETLOGO_STUB_KILL_AT"] = str(kill_at)
+        env["NETLOGO_STUB_COUNT"] = os.path.join(self.directory, "count")
+        self.assertNotEqual(self.run_study(extra_args, env), 0)
+        self.assertEqual(self.run_study(extra_args), 0)
+
+    def test_csv(self):
+        for kill_at in [3, 10]:
+            for fname in os.listdir(self.directory):
+                if fname.startswith("proc") or fname == "count":
+                    os.remove(os.path.join(self.directory, fname))
+            self.check_restart([], kill_at)
+            keys = self.keys([os.path.join(self.directory, fname) for fname in os.listdir(self.directory) \
+                                  if fname.startswith("proc") and fname.endswith(".csv")])
+            self.assertEqual(len(keys), NUM_ROWS)
+            self.assertEqual(len(set(keys)), NUM_ROWS)
+
+    def test_compressed(self):
+        from collect_data import read_index, read_blocks
+        self.check_restart(["--output_format", "csv.gz"], 7)
+        lines = []
+        for fname in os.listdir(self.directory):
+            if fname.startswith("proc") and fname.endswith(".csv.gz"):
+                fname = os.path.join(self.directory, fname)
+                for data in read_blocks(fname, read_index(fname)):
+                    lines.extend(data.decode("utf-8").splitlines())
+        keys = [tuple(line.split(",")[:3]) for line in lines]
+        self.assertEqual(len(keys), NUM_ROWS)
+        self.assertEqual(len(set(keys)), NUM_ROWS)
+
+    def test_columnar_batches(self):
+        # Part files whose ids are journaled hold every row once, when a
+        # unit of several combinations fills the sink half way.
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("needs numpy")
+        from collect_data import read_journals, journaled
+        self.check_restart(["--output_format", "npz", "--batch_size", "4"], 2)
+        done = read_journals(self.directory)
+        keys = []
+        for fname in os.listdir(self.directory):
+            if fname.startswith("proc") and fname.endswith(".npz"):
+                with numpy.load(os.path.join(self.directory, fname)) as npz:
+                    if journaled(done, npz["global_ids"].tolist()):
+                        experiment = fname.split("_", 1)[1].rsplit("_part", 1)[0]
+                        keys.extend([(experiment, run_number, rep) for run_number, rep in zip(npz["c0"].tolist(), npz["c1"].tolist())])
+        self.assertEqual(len(keys), NUM_ROWS)
+        self.assertEqual(len(set(keys)), NUM_ROWS)
+
+
+if __name__ == "__main__":
+    unittest.main()
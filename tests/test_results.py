@@ -0,0 +1,78 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from nlogo_results import write_block
+from collect_data import read_index, read_blocks, lookup
+
+
+def rows_of(experiment, run_numbers, reps = 2):
+    return ["{0},{1},{2},{3}\n".format(experiment, str(run).zfill(6), rep, run * 10 + rep) \
+                for run in run_numbers for rep in range(reps)]
+
+
+class CompressedIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "proc0000.csv.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_blocks_round_trip(self):
+        blocks = [rows_of("exp_one", [0, 1]), rows_of("exp_one", [2]), rows_of("exp2", [0, 1, 2])]
+        for rows in blocks:
+            write_block(self.filename, rows)
+        index = read_index(self.filename)
+        self.assertEqual([len(runs) for offset, length, runs in index], [2, 1, 3])
+        self.assertEqual(index[2][2], [(b"exp2", 0), (b"exp2", 1), (b"exp2", 2)])
+        for data, rows in zip(read_blocks(self.filename, index), blocks):
+            self.assertEqual(data.decode("utf-8"), "".join(rows))
+
+    def test_lookup(self):
+        write_block(self.filename, rows_of("exp_one", [0, 1]))
+        write_block(self.filename, rows_of("exp_one", [2, 3]))
+        write_block(self.filename, rows_of("exp2", [1]))
+        self.assertEqual([line.decode("utf-8") for line in lookup(self.directory, "exp_one", 3)],
+                         rows_of("exp_one", [3]))
+        self.assertEqual([line.decode("utf-8") for line in lookup(self.directory, "exp2", 1)],
+                         rows_of("exp2", [1]))
+        self.assertEqual(lookup(self.directory, "exp2", 5), [])
+
+    def test_lookup_rewritten_run(self):
+        # A restarted job writes a run again, in a later block or further
+        # down a plain csv file.  The first copy is returned once.
+        write_block(self.filename, rows_of("exp_one", [0, 1]))
+        write_block(self.filename, rows_of("exp_one", [1, 2], reps = 3))
+        self.assertEqual([line.decode("utf-8") for line in lookup(self.directory, "exp_one", 1)],
+                         rows_of("exp_one", [1]))
+        self.assertEqual([line.decode("utf-8") for line in lookup(self.directory, "exp_one", 2)],
+                         rows_of("exp_one", [2], reps = 3))
+        os.remove(self.filename)
+        os.remove(self.filename + ".idx")
+        with open(os.path.join(self.directory, "proc0001.csv"), "w") as fout:
+            fout.write("".join(rows_of("exp_one", [3, 4]) + rows_of("exp_one", [3, 4, 5], reps = 3)))
+        self.assertEqual([line.decode("utf-8") for line in lookup(self.directory, "exp_one", 4)],
+                         rows_of("exp_one", [4]))
+
+    def test_incomplete_blocks_skipped(self):
+        # A job killed while writing the index leaves a block with fewer
+        # index lines than runs, or a line cut short.
+        write_block(self.filename, rows_of("exp_one", [0, 1]))
+        write_block(self.filename, rows_of("exp_one", [2, 3]))
+        with open(self.filename + ".idx") as fin:
+            lines = fin.readlines()
+        with open(self.filename + ".idx", "w") as fout:
+            fout.write("".join(lines[:3]) + lines[3][:5])
+        index = read_index(self.filename)
+        self.assertEqual([runs for offset, length, runs in index], [[(b"exp_one", 0), (b"exp_one", 1)]])
+        self.assertEqual(lookup(self.directory, "exp_one", 2), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from nlogo_sched import guided_chunks, dynamic_indices
+
+
+class ListCounter(object):
+    # Stands in for SharedCounter in a single process.
+
+    def __init__(self, num_counters):
+        self.values = [0] * num_counters
+
+    def next(self, counter):
+        value = self.values[counter]
+        self.values[counter] += 1
+        return value
+
+
+class GuidedChunksTest(unittest.TestCase):
+
+    def check_cover(self, chunks, num_runs):
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], num_runs)
+        for (start, stop), (next_start, next_stop) in zip(chunks[:-1], chunks[1:]):
+            self.assertEqual(stop, next_start)
+            self.assertLess(start, stop)
+
+    def test_guided_chunks_cover_runs(self):
+        for num_runs in [1, 7, 100, 1001]:
+            self.check_cover(guided_chunks(num_runs, 4, 2), num_runs)
+
+    def test_decreasing_sizes(self):
+        sizes = [stop - start for start, stop in guided_chunks(1000, 4, 3)]
+        self.assertEqual(sizes, sorted(sizes, reverse = True))
+        self.assertEqual(sizes[0], 1000 // 8)
+        self.assertGreaterEqual(min(sizes[:-1]), 3)
+
+    def test_dynamic_indices(self):
+        # Processes taking turns pull every run exactly once.
+        chunks = guided_chunks(50, 3)
+        counter = ListCounter(2)
+        pulled = [dynamic_indices(counter, 1, chunks) for mpi_rank in range(3)]
+        indices = []
+        while len(pulled) > 0:
+            for generator in list(pulled):
+                try:
+                    indices.append(next(generator))
+                except StopIteration:
+                    pulled.remove(generator)
+        self.assertEqual(sorted(indices), list(range(50)))
+        self.assertEqual(counter.values[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import math
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from nlogo_stats import ReporterStats, StudyStats, load_checkpoints
+
+
+def exact_quantile(values, q):
+    # Linear interpolation between the sorted values, numpy's default.
+    values = sorted(values)
+    position = q * (len(values) - 1)
+    low = int(math.floor(position))
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (position - low) * (values[high] - values[low])
+
+
+def stats_of(values):
+    stats = ReporterStats()
+    for value in values:
+        stats.add(value)
+    return stats
+
+
+class ReporterStatsTest(unittest.TestCase):
+
+    def assertClose(self, a, b, tolerance = 1e-9):
+        self.assertLessEqual(abs(a - b), tolerance * max(1.0, abs(a), abs(b)))
+
+    def test_merge_matches_single_pass(self):
+        rng = random.Random(3)
+        values = [rng.gauss(100.0, 15.0) for i in range(1000)]
+        single = stats_of(values)
+        merged = ReporterStats()
+        for start in range(0, len(values), 137):
+            merged.merge(stats_of(values[start:start + 137]))
+        self.assertEqual(merged.n, single.n)
+        self.assertClose(merged.mean, single.mean)
+        self.assertClose(merged.variance(), single.variance())
+        self.assertEqual((merged.min, merged.max), (single.min, single.max))
+        # The sketch merges approximately, within a small part of the range.
+        for q in [0.05, 0.25, 0.5, 0.75, 0.95]:
+            self.assertClose(merged.quantile(q), single.quantile(q), 0.01)
+
+    def test_exact_while_small(self):
+        rng = random.Random(4)
+        values = [rng.uniform(0.0, 1.0) for i in range(100)]
+        stats = stats_of(values[:50])
+        stats.merge(stats_of(values[50:]))
+        mean = sum(values) / len(values)
+        self.assertClose(stats.mean, mean)
+        self.assertClose(stats.variance(), sum([(value - mean) ** 2 for value in values]) / (len(values) - 1))
+        for q in [0.0, 0.1, 0.5, 0.9, 1.0]:
+            self.assertClose(stats.quantile(q), exact_quantile(values, q))
+
+    def test_merge_into_empty(self):
+        stats = ReporterStats()
+        stats.merge(stats_of([1.0, 2.0, 4.0]))
+        self.assertEqual((stats.n, stats.min, stats.max), (3, 1.0, 4.0))
+        self.assertClose(stats.mean, 7.0 / 3.0)
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_deltas_and_cut_short_end(self):
+        stats = StudyStats(os.path.join(self.directory, "proc0000.job0000.stats"))
+        for unit in range(5):
+            pending = {("exp", unit, None) : {"x" : stats_of([float(unit), float(unit) + 1.0])}}
+            stats.stage(pending, [unit])
+            stats.save()
+        loaded = load_checkpoints(self.directory)
+        self.assertEqual(sorted(loaded.ids), list(range(5)))
+        self.assertEqual(loaded.entries[("exp", 3, None)]["x"].max, 4.0)
+        # A delta cut short by a kill is dropped.
+        with open(stats.checkpoint_filename, "rb") as fin:
+            data = fin.read()
+        with open(stats.checkpoint_filename, "ab") as fout:
+            fout.write(data[:len(data) // 7])
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, "w")
+        try:
+            loaded = load_checkpoints(self.directory)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        self.assertEqual(sorted(loaded.ids), list(range(5)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from nlogo_worker import ExperimentRunner, logo_value
+
+SETUP_XML = """<?xml version="1.0" encoding="us-ascii"?>
+<experiments>
+  <experiment name="exp" repetitions="1" runMetricsEveryStep="false">
+    <setup>setup</setup>
+    <go>go</go>
+    <timeLimit steps="2"/>
+    <metric>count turtles</metric>
+    <enumeratedValueSet variable="a">
+      <value value="1.0"/>
+      <value value="0.5"/>
+    </enumeratedValueSet>
+    <steppedValueSet variable="b" first="0" step="1" last="1"/>
+  </experiment>
+</experiments>
+"""
+
+
+class NoJPype(object):
+
+    def JClass(self, name):
+        raise RuntimeError(name)
+
+
+class FakeWorkspace(object):
+
+    def __init__(self):
+        self.commands = []
+
+    def command(self, command):
+        self.commands.append(command)
+
+    def report(self, reporter):
+        return 0
+
+
+class LogoValueTest(unittest.TestCase):
+
+    def test_numbers(self):
+        for value, text in [("1.0", "1"), (2.0, "2"), ("-3", "-3"), (0.1, "0.1"), (0.5, "0.5"),
+                            (1e-5, "1.0E-5"), (0.0005, "5.0E-4"), (12345678.5, "1.23456785E7"), (1e20, "1.0E20")]:
+            self.assertEqual(logo_value(value), text)
+
+    def test_other_values(self):
+        for value in ['"abc"', "true", "[1 2]"]:
+            self.assertEqual(logo_value(value), value)
+
+
+class ExperimentRunnerTest(unittest.TestCase):
+
+    def test_table_values(self):
+        # Values are written as NetLogo writes them, as by a launched java.
+        lines = ExperimentRunner(NoJPype(), FakeWorkspace(), "model.nlogo").run(SETUP_XML)
+        self.assertEqual(lines[6], '"[run number]","a","b","[step]","count turtles"\n')
+        self.assertEqual(lines[7:], ['"1","1","0","2","0"\n', '"2","1","1","2","0"\n',
+                                     '"3","0.5","0","2","0"\n', '"4","0.5","1","2","0"\n'])
+
+
+if __name__ == "__main__":
+    unittest.main()